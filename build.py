@@ -2,19 +2,15 @@
 # License, v. 2.0. If a copy of the MPL was not distributed with this
 # file, You can obtain one at http://mozilla.org/MPL/2.0/.
 
+# Note: Only modules needed to parse the command line are imported here, as
+# build.py is imported on every start. Commands import what they need
+# themselves (see tests/test_build.py).
 import argparse
 import logging
-import io
-import json
 import os
-import re
-import shutil
-from urllib import urlencode
-import urllib2
+import sys
+from collections import OrderedDict
 from functools import partial
-from StringIO import StringIO
-from zipfile import ZipFile
-from buildtools.localeTools import read_locale_config
 
 KNOWN_PLATFORMS = {'chrome', 'gecko', 'edge', 'generic'}
 
@@ -22,10 +18,19 @@ MAIN_PARSER = argparse.ArgumentParser(
     description=__doc__,
     formatter_class=argparse.RawDescriptionHelpFormatter)
 
+MAIN_PARSER.add_argument('-v', '--verbose', action='store_true',
+                         help='Print additional information while running')
+
 SUB_PARSERS = MAIN_PARSER.add_subparsers(title='Commands', dest='action',
                                          metavar='[command]')
 
-ALL_COMMANDS = []
+# Registered commands by their name on the command line.
+ALL_COMMANDS = OrderedDict()
+
+# Commands which the client forwards to a running daemon (see daemon.py).
+# Everything else (e.g. release automation, which asks questions) runs in the
+# client.
+FORWARDED_COMMANDS = {'build', 'build-matrix', 'devenv'}
 
 
 def make_argument(*args, **kwargs):
@@ -44,7 +49,7 @@ def argparse_command(valid_platforms=None, multi_platform=False,
 
         short_desc, long_desc = func.__doc__.split('\n\n', 1)
 
-        ALL_COMMANDS.append({
+        ALL_COMMANDS[func.__name__.replace('_', '-')] = {
             'name': func.__name__,
             'description': long_desc,
             'help_text': short_desc,
@@ -53,7 +58,7 @@ def argparse_command(valid_platforms=None, multi_platform=False,
             'function': func,
             'arguments': arguments,
             'no_platform': no_platform,
-        })
+        }
         return func_wrapper
     return wrapper
 
@@ -71,7 +76,36 @@ def make_subcommand(name, description, help_text, function, arguments):
     return new_parser
 
 
-def build_available_subcommands(base_dir):
+def _add_subcommand(types, command_params):
+    platforms = types.intersection(command_params['valid_platforms'])
+    arguments = command_params['arguments']
+    kwargs = {key: command_params[key]
+              for key in ['name', 'description', 'help_text', 'function']}
+
+    if len(platforms) > 1:
+        if command_params['multi_platform']:
+            help_text = ('Multiple types may be specifed (each preceded '
+                         'by -t/--type)')
+            action = 'append'
+        else:
+            help_text = None
+            action = 'store'
+        if not command_params['no_platform']:
+            arguments += (
+                make_argument('-t', '--type', dest='platform',
+                              required=True, choices=platforms,
+                              action=action, help=help_text),
+            )
+        make_subcommand(arguments=arguments, **kwargs)
+    elif len(platforms) == 1:
+        sub_parser = make_subcommand(arguments=arguments, **kwargs)
+        sub_parser.set_defaults(platform=platforms.pop())
+    else:
+        return False
+    return True
+
+
+def build_available_subcommands(base_dir, command=None):
     """Build subcommands, which are available for the repository in base_dir.
 
     Search 'base_dir' for existing metadata.<type> files and make <type> an
@@ -79,56 +113,81 @@ def build_available_subcommands(base_dir):
     platforms.
 
     If no valid platform is found for a subcommand, it get's omitted.
+
+    If 'command' is given, only the subcommand of that name is built, as
+    setting up the arguments of all the others would only slow down the
+    start. All subcommands are built if there is no such subcommand, so that
+    argparse can list them. This can be called again for other commands.
     """
-    if build_available_subcommands._result is not None:
+    types = build_available_subcommands._types
+    if types is None:
         # Tests might run this code multiple times, make sure the collection
         # of platforms is only run once.
-        return build_available_subcommands._result
-
-    types = set()
-    for p in KNOWN_PLATFORMS:
-        if os.path.exists(os.path.join(base_dir, 'metadata.' + p)):
-            types.add(p)
+        types = set()
+        for p in KNOWN_PLATFORMS:
+            if os.path.exists(os.path.join(base_dir, 'metadata.' + p)):
+                types.add(p)
+
+        if len(types) == 0:
+            logging.error('No metadata file found in this repository. '
+                          'Expecting one or more of {} to be present.'.format(
+                              ', '.join('metadata.' + p
+                                        for p in KNOWN_PLATFORMS)))
+        build_available_subcommands._types = types
 
     if len(types) == 0:
-        logging.error('No metadata file found in this repository. Expecting '
-                      'one or more of {} to be present.'.format(
-                          ', '.join('metadata.' + p for p in KNOWN_PLATFORMS)))
-        build_available_subcommands._result = False
         return False
 
-    for command_params in ALL_COMMANDS:
-        multi_platform = command_params.pop('multi_platform')
-        no_platform = command_params.pop('no_platform')
-        platforms = types.intersection(command_params.pop('valid_platforms'))
-        if len(platforms) > 1:
-            if multi_platform:
-                help_text = ('Multiple types may be specifed (each preceded '
-                             'by -t/--type)')
-                action = 'append'
-            else:
-                help_text = None
-                action = 'store'
-            if not no_platform:
-                command_params['arguments'] += (
-                    make_argument('-t', '--type', dest='platform',
-                                  required=True, choices=platforms,
-                                  action=action, help=help_text),
-                )
-            make_subcommand(**command_params)
-        elif len(platforms) == 1:
-            sub_parser = make_subcommand(**command_params)
-            sub_parser.set_defaults(platform=platforms.pop())
-
-    build_available_subcommands._result = True
+    built = build_available_subcommands._built
+    if command in built:
+        return True
+    if (command in ALL_COMMANDS and
+            _add_subcommand(types, ALL_COMMANDS[command])):
+        built.add(command)
+        return True
+
+    for name, command_params in ALL_COMMANDS.iteritems():
+        if name not in built:
+            _add_subcommand(types, command_params)
+            built.add(name)
     return True
 
 
-build_available_subcommands._result = None
+build_available_subcommands._types = None
+build_available_subcommands._built = set()
+
+
+jobs_argument = make_argument(
+    '-j', '--jobs', type=int, default=1,
+    help='Number of parallel jobs to use (default: 1)',
+)
+
+io_threads_argument = make_argument(
+    '--io-threads', dest='io_threads', type=int, default=1,
+    help='Number of threads to read files with, which helps on slow '
+         '(e.g. network) filesystems (default: 1)',
+)
+
+memory_budget_argument = make_argument(
+    '--memory-budget', dest='memory_budget', type=int, metavar='MB',
+    help='Write generated files to temporary files rather than keeping '
+         'them in memory, once they take up more than MB megabytes',
+)
+
+no_cache_argument = make_argument(
+    '--no-cache', dest='cache', action='store_false',
+    help='Neither use nor update the build cache',
+)
+
+bundler_argument = make_argument(
+    '--bundler', choices=['webpack', 'python'],
+    help='Bundler to create the bundles with, overriding the bundler option '
+         'in the general section of the metadata (default: webpack)',
+)
 
 
 @argparse_command(
-    valid_platforms={'chrome', 'gecko', 'edge'},
+    valid_platforms={'chrome', 'gecko', 'edge'}, multi_platform=True,
     arguments=(
         make_argument(
             '-b', '--build-num', dest='build_num',
@@ -141,35 +200,141 @@ build_available_subcommands._result = None
         make_argument(
             '-r', '--release', action='store_true',
             help='Create a release build'),
+        make_argument(
+            '--reproducible', action='store_true',
+            help='Create a package which is identical for identical input, '
+                 'using SOURCE_DATE_EPOCH (if set) as timestamp'),
+        make_argument(
+            '--rebuild', action='store_true',
+            help='Run the whole build, even if nothing changed since a '
+                 'previous build'),
+        jobs_argument,
+        io_threads_argument,
+        memory_budget_argument,
+        no_cache_argument,
+        bundler_argument,
         make_argument('output_file', nargs='?'),
     ),
 )
-def build(base_dir, build_num, key_file, release, output_file, platform,
-          **kwargs):
+def build(base_dir, build_num, key_file, release, reproducible, rebuild,
+          output_file, platform, jobs, io_threads, memory_budget, cache,
+          bundler, **kwargs):
     """
     Create a build.
 
     Creates an extension build with given file name. If output_file is missing
-    a default name will be chosen.
+    a default name will be chosen. If several types are given, the builds
+    for all of them are created in one go.
     """
-    kwargs = {}
-    if platform == 'edge':
-        import buildtools.packagerEdge as packager
-    else:
-        import buildtools.packagerChrome as packager
+    if isinstance(platform, basestring):
+        platform = [platform]
+    if output_file and len(set(platform)) > 1:
+        logging.error('An output file can only be given for a single type')
+        return
+    if reproducible and 'edge' in platform:
+        logging.error('Reproducible builds are not supported for edge')
+        return
+
+    import buildtools.packagerChrome as packager
 
+    kwargs = {}
     kwargs['keyFile'] = key_file
     kwargs['outFile'] = output_file
     kwargs['releaseBuild'] = release
     kwargs['buildNum'] = build_num
+    kwargs['reproducible'] = reproducible
+    kwargs['rebuild'] = rebuild
+    kwargs['jobs'] = jobs
+    kwargs['io_threads'] = io_threads
+    if memory_budget is not None:
+        kwargs['memory_budget'] = memory_budget * 1024 * 1024
+    kwargs['cache'] = cache
+    kwargs['bundler'] = bundler
+
+    packager.createBuilds(base_dir, platform, **kwargs)
+
 
-    packager.createBuild(base_dir, type=platform, **kwargs)
+BUILD_VARIANTS = {
+    'devbuild': {'releaseBuild': False, 'signed': False},
+    'release': {'releaseBuild': True, 'signed': False},
+    'signed-devbuild': {'releaseBuild': False, 'signed': True},
+    'signed-release': {'releaseBuild': True, 'signed': True},
+}
+
+
+@argparse_command(
+    valid_platforms={'chrome', 'gecko'},
+    arguments=(
+        make_argument(
+            '-b', '--build-num', dest='build_num',
+            help='Use given build number for development builds (if omitted '
+                 'the build number will be retrieved from Mercurial)'),
+        make_argument(
+            '-k', '--key', dest='key_file',
+            help='File containing private key and certificates required to '
+                  'sign the signed variants'),
+        make_argument(
+            '--reproducible', action='store_true',
+            help='Create packages which are identical for identical input, '
+                 'using SOURCE_DATE_EPOCH (if set) as timestamp'),
+        make_argument(
+            '--rebuild', action='store_true',
+            help='Run the whole build, even if nothing changed since a '
+                 'previous build'),
+        jobs_argument,
+        io_threads_argument,
+        memory_budget_argument,
+        no_cache_argument,
+        bundler_argument,
+        make_argument('variants', nargs='+', metavar='variant',
+                      choices=sorted(BUILD_VARIANTS),
+                      help='Variant to build, one of: {}'.format(
+                          ', '.join(sorted(BUILD_VARIANTS)))),
+    ),
+)
+def build_matrix(base_dir, build_num, key_file, reproducible, rebuild,
+                 variants, platform, jobs, io_threads, memory_budget, cache,
+                 bundler, **kwargs):
+    """
+    Create several variants of a build.
+
+    Creates the given variants of the build in one go, e.g. a development
+    build, an unsigned release build and a signed release build. Files which
+    don't differ between the variants are only created once, and all packages
+    are written at the same time. Default file names are used for all
+    packages.
+    """
+    build_variants = []
+    for name in sorted(set(variants), key=variants.index):
+        variant = BUILD_VARIANTS[name]
+        if variant['signed'] and key_file is None:
+            logging.error('You must specify a key file for the {} '
+                          'variant'.format(name))
+            return
+        build_variants.append({
+            'releaseBuild': variant['releaseBuild'],
+            'buildNum': None if variant['releaseBuild'] else build_num,
+            'keyFile': key_file if variant['signed'] else None,
+        })
+
+    if memory_budget is not None:
+        memory_budget *= 1024 * 1024
+
+    import buildtools.packagerChrome as packager
+    packager.createBuildMatrix(base_dir, platform, build_variants,
+                               jobs=jobs, io_threads=io_threads, cache=cache,
+                               memory_budget=memory_budget,
+                               reproducible=reproducible, rebuild=rebuild,
+                               bundler=bundler)
 
 
 @argparse_command(
     valid_platforms={'chrome', 'gecko', 'edge'},
+    arguments=(jobs_argument, io_threads_argument, memory_budget_argument,
+               no_cache_argument, bundler_argument),
 )
-def devenv(base_dir, platform, **kwargs):
+def devenv(base_dir, platform, jobs, io_threads, memory_budget, cache,
+           bundler, **kwargs):
     """
     Set up a development environment.
 
@@ -181,18 +346,24 @@ def devenv(base_dir, platform, **kwargs):
     else:
         import buildtools.packagerChrome as packager
 
-    file = StringIO()
-    packager.createBuild(base_dir, type=platform, outFile=file, devenv=True,
-                         releaseBuild=True)
+    if memory_budget is not None:
+        memory_budget *= 1024 * 1024
+
+    result = packager.create_build_result(
+        base_dir, type=platform, devenv=True, releaseBuild=True, jobs=jobs,
+        io_threads=io_threads, cache=cache, memory_budget=memory_budget,
+        bundler=bundler,
+    )
 
+    import shutil
     from buildtools.packager import getDevEnvPath
     devenv_dir = getDevEnvPath(base_dir, platform)
 
     shutil.rmtree(devenv_dir, ignore_errors=True)
-
-    file.seek(0)
-    with ZipFile(file, 'r') as zip_file:
-        zip_file.extractall(devenv_dir)
+    try:
+        result.files.write_to_directory(devenv_dir)
+    finally:
+        result.close()
 
 
 project_key_argument = make_argument(
@@ -210,12 +381,13 @@ def setuptrans(base_dir, project_key, platform, **kwargs):
     Set up translation languages for the project on crowdin.com.
     """
     from buildtools.packager import readMetadata
+    import buildtools.localeTools as localeTools
     metadata = readMetadata(base_dir, platform)
 
     basename = metadata.get('general', 'basename')
-    locale_config = read_locale_config(base_dir, platform, metadata)
+    locale_config = localeTools.read_locale_config(base_dir, platform,
+                                                   metadata)
 
-    import buildtools.localeTools as localeTools
     localeTools.setupTranslations(locale_config, basename, project_key)
 
 
@@ -229,15 +401,16 @@ def translate(base_dir, project_key, platform, **kwargs):
     Update the translation master files in the project on crowdin.com.
     """
     from buildtools.packager import readMetadata
+    import buildtools.localeTools as localeTools
     metadata = readMetadata(base_dir, platform)
 
     basename = metadata.get('general', 'basename')
-    locale_config = read_locale_config(base_dir, platform, metadata)
+    locale_config = localeTools.read_locale_config(base_dir, platform,
+                                                   metadata)
 
     default_locale_dir = os.path.join(locale_config['base_path'],
                                       locale_config['default_locale'])
 
-    import buildtools.localeTools as localeTools
     localeTools.updateTranslationMaster(locale_config, metadata,
                                         default_locale_dir, basename,
                                         project_key)
@@ -253,12 +426,13 @@ def uploadtrans(base_dir, project_key, platform, **kwargs):
     Upload already existing translations to the project on crowdin.com.
     """
     from buildtools.packager import readMetadata
+    import buildtools.localeTools as localeTools
     metadata = readMetadata(base_dir, platform)
 
     basename = metadata.get('general', 'basename')
-    locale_config = read_locale_config(base_dir, platform, metadata)
+    locale_config = localeTools.read_locale_config(base_dir, platform,
+                                                   metadata)
 
-    import buildtools.localeTools as localeTools
     for locale, locale_dir in locale_config['locales'].iteritems():
         if locale != locale_config['default_locale'].replace('_', '-'):
             localeTools.uploadTranslations(locale_config, metadata, locale_dir,
@@ -275,16 +449,19 @@ def gettranslations(base_dir, project_key, platform, **kwargs):
     Download updated translations from crowdin.com.
     """
     from buildtools.packager import readMetadata
+    import buildtools.localeTools as localeTools
     metadata = readMetadata(base_dir, platform)
 
     basename = metadata.get('general', 'basename')
-    locale_config = read_locale_config(base_dir, platform, metadata)
+    locale_config = localeTools.read_locale_config(base_dir, platform,
+                                                   metadata)
 
-    import buildtools.localeTools as localeTools
     localeTools.getTranslations(locale_config, basename, project_key)
 
 
 def valid_version_format(value):
+    import re
+
     if re.search(r'[^\d\.]', value):
         raise argparse.ArgumentTypeError('Wrong version number format')
 
@@ -330,6 +507,35 @@ def release(base_dir, downloads_repository, key_file, platform, version,
                           downloads_repository)
 
 
+@argparse_command(
+    no_platform=True,
+    arguments=(
+        make_argument(
+            '--stop', action='store_true',
+            help='Stop the build daemon running for this repository'),
+    ),
+)
+def daemon(base_dir, stop, **kwargs):
+    """
+    Run a build daemon.
+
+    Keeps running in the foreground, and runs the build, build-matrix and
+    devenv commands given for this repository in the meantime, which saves
+    the time needed to start up for each of them.
+    """
+    import buildtools.daemon as daemon
+
+    if stop:
+        if not daemon.stop(base_dir):
+            logging.error('No build daemon is running')
+        return
+
+    try:
+        daemon.BuildDaemon(base_dir).serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
 @argparse_command(no_platform=True)
 def lint_gitlab_ci(base_dir, **kwargs):
     """Lint the .gitlab-ci.yaml file.
@@ -337,7 +543,12 @@ def lint_gitlab_ci(base_dir, **kwargs):
     Test the .gitlab-ci.yaml file for validity. (Note: You need to have PyYAML
     installed.)
     """
+    import io
+    import json
+    from urllib import urlencode
+    import urllib2
     import yaml
+
     filename = '.gitlab-ci.yml'
     try:
         with io.open(os.path.join(base_dir, filename), 'rt') as fp:
@@ -351,13 +562,40 @@ def lint_gitlab_ci(base_dir, **kwargs):
         print 'No valid {} found.'.format(filename)
 
 
+def get_command(args):
+    """Get the command given by the arguments of build.py, if any."""
+    # The first positional argument is the command, as the main parser only
+    # has flags. The help lists all commands, so they are needed for it.
+    for arg in args:
+        if arg in {'-h', '--help'}:
+            return None
+        if not arg.startswith('-'):
+            return arg
+    return None
+
+
 def process_args(base_dir, *args):
-    if build_available_subcommands(base_dir):
+    # If no args are provided, this module is run directly from the command
+    # line.
+    args = list(args or sys.argv[1:])
+    command = get_command(args)
+    if command in FORWARDED_COMMANDS:
+        # These are run by the build daemon if it is running for this
+        # repository, which saves starting up (see daemon.py).
+        from buildtools.daemon import forward
+
+        exit_code = forward(base_dir, args)
+        if exit_code is not None:
+            if exit_code != 0:
+                sys.exit(exit_code)
+            return
+
+    if build_available_subcommands(base_dir, command):
         MAIN_PARSER.set_defaults(base_dir=base_dir)
 
-        # If no args are provided, this module is run directly from the command
-        # line. argparse will take care of consuming sys.argv.
-        arguments = MAIN_PARSER.parse_args(args if len(args) > 0 else None)
+        arguments = MAIN_PARSER.parse_args(args)
+        if arguments.verbose:
+            logging.basicConfig(level=logging.INFO)
 
         function = arguments.function
         del arguments.function
@@ -0,0 +1,351 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+# Note: Caches are kept for each repository being built, so that they are
+# shared between all builds (and platforms) of that repository. They are kept
+# outside of the repository though, so that they never show up as untracked
+# files in it.
+
+import errno
+import glob
+import hashlib
+import json
+import os
+import tempfile
+import threading
+import time
+
+CHUNK_SIZE = 64 * 1024
+
+# Files being written have this suffix until they are complete.
+TEMP_SUFFIX = '.tmp'
+
+# Files modified less than this many seconds before they were hashed might
+# be modified again without their mtime changing, so their hash is not
+# recorded (much like Git's handling of "racily clean" files).
+RACY_INTERVAL = 2
+
+
+def get_cache_dir():
+    """Get the directory the caches of all repositories are kept in.
+
+    It can be given with the BUILDTOOLS_CACHE_DIR environment variable,
+    otherwise the user's cache directory is used.
+    """
+    path = os.environ.get('BUILDTOOLS_CACHE_DIR')
+    if path:
+        return path
+    user_cache = (os.environ.get('XDG_CACHE_HOME') or
+                  os.path.join(os.path.expanduser('~'), '.cache'))
+    return os.path.join(user_cache, 'buildtools')
+
+
+def get_cache_path(base_dir, *parts):
+    # The directory of each repository is named after its location.
+    base_dir = os.path.realpath(base_dir)
+    name = '{}-{}'.format(os.path.basename(base_dir),
+                          hashlib.sha1(base_dir).hexdigest()[:12])
+    return os.path.join(get_cache_dir(), name, *parts)
+
+
+def iter_file_chunks(path):
+    with open(path, 'rb') as file:
+        for chunk in iter(lambda: file.read(CHUNK_SIZE), ''):
+            yield chunk
+
+
+def hash_file(path):
+    digest = hashlib.sha1()
+    for chunk in iter_file_chunks(path):
+        digest.update(chunk)
+    return digest.hexdigest()
+
+
+def get_path_hash(path, index=None):
+    """Get the hash of a file, or None if it doesn't exist.
+
+    Directories are all considered the same, as their content is not
+    looked at.
+    """
+    if os.path.isdir(path):
+        return 'directory'
+    if not os.path.exists(path):
+        return None
+    if index:
+        return index.get_hash(path)
+    return hash_file(path)
+
+
+def get_code_files():
+    """Get the paths of the files of buildtools which go into builds.
+
+    These are its scripts and templates, and the package.json listing the
+    Node.js modules it uses. Caches of build results have to be invalidated
+    once any of them changes.
+    """
+    base_dir = os.path.dirname(os.path.abspath(__file__))
+    paths = glob.glob(os.path.join(base_dir, '*.py'))
+    paths += glob.glob(os.path.join(base_dir, '*.js'))
+    paths += glob.glob(os.path.join(base_dir, 'templates', '*'))
+    paths.append(os.path.join(base_dir, 'package.json'))
+    return sorted(paths)
+
+
+def _write_atomically(path, data):
+    # Write to a temporary file first and move it into place afterwards,
+    # so that concurrent builds (or threads) never see incomplete files.
+    fd, tmp_path = tempfile.mkstemp(prefix='.', suffix=TEMP_SUFFIX,
+                                    dir=os.path.dirname(path))
+    with os.fdopen(fd, 'wb') as file:
+        file.write(data)
+    try:
+        os.rename(tmp_path, path)
+    except OSError:
+        # On Windows, rename() fails if the file exists already, e.g.
+        # because another build just wrote it.
+        _remove(tmp_path)
+        return False
+    return True
+
+
+def _makedirs(path):
+    try:
+        os.makedirs(path)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+
+
+def _remove(path):
+    try:
+        os.remove(path)
+    except OSError as e:
+        if e.errno != errno.ENOENT:
+            raise
+
+
+class ContentCache(object):
+    """A directory of blobs, addressed by hex digests, with LRU eviction.
+
+    The key of a blob is expected to be the hash of whatever it was derived
+    from, so that blobs never need to be invalidated, only evicted. Reading
+    a blob marks it as recently used by updating its mtime, and once the total
+    size of all blobs exceeds max_size, the least recently used ones are
+    removed.
+    """
+
+    def __init__(self, path, max_size):
+        self.path = path
+        self.max_size = max_size
+        self._size = None
+        # Blobs are stored from several threads, e.g. while packages are
+        # written in parallel.
+        self._lock = threading.Lock()
+
+    def _get_path(self, key):
+        return os.path.join(self.path, key[:2], key[2:])
+
+    def __contains__(self, key):
+        return os.path.exists(self._get_path(key))
+
+    def get(self, key):
+        path = self._get_path(key)
+        try:
+            with open(path, 'rb') as file:
+                data = file.read()
+            os.utime(path, None)
+        except (IOError, OSError) as e:
+            if e.errno != errno.ENOENT:
+                raise
+            return None
+        return data
+
+    def set(self, key, data, replace=False):
+        """Store data under key.
+
+        Unless replace is True, blobs which exist already are kept as they
+        are, as they are expected to have the same content anyway.
+        """
+        path = self._get_path(key)
+        exists = os.path.exists(path)
+        if exists and not replace:
+            return
+
+        _makedirs(os.path.dirname(path))
+        if not _write_atomically(path, data):
+            return
+
+        with self._lock:
+            if self._size is None:
+                self._size = sum(size for _, size, _ in self._list_blobs())
+            elif not exists:
+                self._size += len(data)
+            if self._size > self.max_size:
+                self._prune()
+
+    def _list_blobs(self):
+        if not os.path.isdir(self.path):
+            return
+        for dirname in os.listdir(self.path):
+            dirpath = os.path.join(self.path, dirname)
+            if not os.path.isdir(dirpath):
+                continue
+            for filename in os.listdir(dirpath):
+                if filename.endswith(TEMP_SUFFIX):
+                    continue
+                path = os.path.join(dirpath, filename)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                yield stat.st_mtime, stat.st_size, path
+
+    def prune(self):
+        """Evict the least recently used blobs until max_size is respected.
+
+        Only evicts down to 90% of max_size, so that storing one more blob
+        doesn't immediately lead to another pruning.
+        """
+        with self._lock:
+            self._prune()
+
+    def _prune(self):
+        blobs = sorted(self._list_blobs())
+        size = sum(size for _, size, _ in blobs)
+        for _, blob_size, path in blobs:
+            if size <= self.max_size * 0.9:
+                break
+            _remove(path)
+            size -= blob_size
+        self._size = size
+
+
+def _get_stat_key(stat):
+    mtime_ns = getattr(stat, 'st_mtime_ns', None)
+    if mtime_ns is None:
+        mtime_ns = int(stat.st_mtime * 1e9)
+    return [stat.st_size, mtime_ns, stat.st_ino]
+
+
+def _get_path_key(path):
+    try:
+        return _get_stat_key(os.stat(path))
+    except OSError:
+        return None
+
+
+class ResidentCache(object):
+    """In-memory cache for values derived from files.
+
+    This is meant for long-running processes (see daemon.py). Values are
+    kept along with the size, mtime and inode of the files they have been
+    derived from, and are dropped as soon as any of these changed (or any
+    of the files has been created or removed).
+    """
+
+    def __init__(self):
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+        if entry is None:
+            return None
+
+        states, value = entry
+        if any(_get_path_key(path) != state for path, state in states):
+            with self._lock:
+                if self._entries.get(key) is entry:
+                    del self._entries[key]
+            return None
+        return value
+
+    def set(self, key, value, paths=()):
+        states = []
+        for path in paths:
+            state = _get_path_key(path)
+            # As with StatIndex, files which have just been modified might
+            # be modified again without their mtime changing.
+            if state and time.time() - state[1] / 1e9 < RACY_INTERVAL:
+                return
+            states.append((path, state))
+
+        with self._lock:
+            self._entries[key] = (states, value)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+class StatIndex(object):
+    """Persistent index of the content hashes of files.
+
+    Hashes are recorded along with the size, mtime and inode of the files,
+    so that as long as these don't change, the hash of a file can be looked
+    up without opening it.
+    """
+
+    VERSION = 1
+
+    def __init__(self, path):
+        self.path = path
+        self._entries = None
+        self._used = set()
+        self._modified = False
+        self._lock = threading.Lock()
+
+    def _load(self):
+        with self._lock:
+            if self._entries is None:
+                self._entries = self._read()
+
+    def _read(self):
+        try:
+            with open(self.path, 'rb') as file:
+                data = json.load(file)
+        except (IOError, ValueError):
+            return {}
+        if data.get('version') != self.VERSION:
+            return {}
+        return data['files']
+
+    def get_hash(self, path, stat=None):
+        """Get the hex SHA-1 digest of the file's content."""
+        if self._entries is None:
+            self._load()
+        if stat is None:
+            stat = os.stat(path)
+
+        path = os.path.abspath(path)
+        key = _get_stat_key(stat)
+        self._used.add(path)
+
+        entry = self._entries.get(path)
+        if entry and entry[:3] == key:
+            return entry[3]
+
+        content_hash = hash_file(path)
+        if time.time() - stat.st_mtime >= RACY_INTERVAL:
+            self._entries[path] = key + [content_hash]
+            self._modified = True
+        return content_hash
+
+    def save(self):
+        """Write the index to disk, if anything changed.
+
+        Entries for files which have been removed are dropped.
+        """
+        if not self._modified:
+            return
+
+        entries = {path: entry for path, entry in self._entries.iteritems()
+                   if path in self._used or os.path.exists(path)}
+        _makedirs(os.path.dirname(self.path))
+        _write_atomically(self.path, json.dumps({
+            'version': self.VERSION,
+            'files': entries,
+        }))
+        self._modified = False
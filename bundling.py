@@ -0,0 +1,328 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+# Note: Bundles are created by webpack, running in a Node.js worker process
+# (see webpack_runner.js). Requests and responses are exchanged as frames,
+# each one consisting of the length of its payload (4 bytes, big endian) and
+# the payload. Messages are JSON, while the content of bundles is sent as it
+# is, in a frame of its own, right after the message about the bundle.
+
+import atexit
+import hashlib
+import json
+import os
+import Queue
+import struct
+import subprocess
+import sys
+import threading
+
+from buildcache import ContentCache, get_cache_path, get_path_hash
+
+WEBPACK_RUNNER = os.path.join(os.path.dirname(__file__), 'webpack_runner.js')
+
+BUNDLE_CACHE_SIZE = 64 * 1024 * 1024
+
+_FRAME_HEADER = struct.Struct('>I')
+
+
+def write_frame(file, payload):
+    file.write(_FRAME_HEADER.pack(len(payload)) + payload)
+    file.flush()
+
+
+def read_frame(file):
+    """Read a frame from file, returns None at the end of the file."""
+    header = file.read(_FRAME_HEADER.size)
+    if not header:
+        return None
+    if len(header) == _FRAME_HEADER.size:
+        size, = _FRAME_HEADER.unpack(header)
+        payload = file.read(size)
+        if len(payload) == size:
+            return payload
+    raise EOFError('Frame cut short')
+
+
+def write_message(file, message):
+    write_frame(file, json.dumps(message, separators=(',', ':')))
+
+
+def read_message(file):
+    """Read a message from file, returns None at the end of the file."""
+    payload = read_frame(file)
+    return None if payload is None else json.loads(payload)
+
+
+def _get_process_context():
+    # What a process started now inherits, apart from its standard streams.
+    return dict(os.environ), os.getcwd()
+
+
+class WebpackWorker(object):
+    """A Node.js process, which creates bundles with webpack on request.
+
+    Starting Node.js and loading webpack takes much longer than creating the
+    bundles, so the process is started once needed, and then kept running
+    for all further bundles created by this process (e.g. by the build
+    daemon). If it died in the meantime, or if the environment variables or
+    the working directory (which the build daemon sets for each request)
+    changed, another one is started.
+    """
+
+    def __init__(self, command=None):
+        self.command = command or ['node', WEBPACK_RUNNER]
+        self._process = None
+        self._context = None
+        self._lock = threading.Lock()
+
+    def _start(self):
+        # Other workers mustn't inherit our pipes, otherwise the process
+        # wouldn't notice when its input is closed.
+        self._context = _get_process_context()
+        self._process = subprocess.Popen(self.command, stdin=subprocess.PIPE,
+                                         stdout=subprocess.PIPE,
+                                         close_fds=True)
+
+    def _stop(self):
+        process, self._process = self._process, None
+        # The process exits once its input is closed.
+        process.stdin.close()
+        return process.wait()
+
+    def _iter_response(self, configuration):
+        write_message(self._process.stdin, configuration)
+        while True:
+            message = read_message(self._process.stdout)
+            if message is None:
+                raise EOFError('Worker exited')
+            if 'bundle' not in message:
+                yield None, message
+                return
+            content = read_frame(self._process.stdout)
+            if content is None:
+                raise EOFError('Worker exited')
+            message['content'] = content
+            yield message.pop('bundle'), message
+
+    def iter_bundles(self, configuration):
+        """Create the bundles described by configuration.
+
+        Bundles are yielded as soon as they have been created, while the
+        others are still being worked on. Yields the name of each bundle along
+        with a dictionary holding its content, the files included in it, the
+        files webpack depends on for it, and the seconds it took to compile.
+        """
+        with self._lock:
+            created = set()
+            finished = False
+            try:
+                for attempt in range(2):
+                    if self._process and (
+                            self._process.poll() is not None or
+                            self._context != _get_process_context()):
+                        self._stop()
+                    if self._process is None:
+                        self._start()
+                    try:
+                        for name, bundle in self._iter_response(configuration):
+                            if name is None:
+                                finished = True
+                                if 'error' in bundle:
+                                    raise Exception(
+                                        'Creating bundles failed:\n' +
+                                        bundle['error'],
+                                    )
+                                return
+                            if name not in created:
+                                created.add(name)
+                                yield name, bundle
+                    except (IOError, EOFError):
+                        # Either the process had exited since the last
+                        # request or it crashed, so we try once more with a
+                        # new one, skipping the bundles we got already.
+                        returncode = self._stop()
+                finished = True
+                raise subprocess.CalledProcessError(returncode, self.command)
+            finally:
+                # If we were interrupted, the rest of the response would be
+                # read as the response to the next request.
+                if not finished and self._process is not None:
+                    self._process.kill()
+                    self._stop()
+
+    def run(self, configuration):
+        """Create the bundles described by configuration.
+
+        Returns a dictionary mapping the name of each bundle to what
+        iter_bundles() yields along with it.
+        """
+        return dict(self.iter_bundles(configuration))
+
+    def close(self):
+        """Stop the process, if it is running."""
+        if self._process is not None:
+            self._stop()
+
+
+_webpack_workers = []
+_webpack_workers_lock = threading.Lock()
+
+
+def get_webpack_workers(count):
+    """Get count webpack workers, which are started once they are used."""
+    with _webpack_workers_lock:
+        while len(_webpack_workers) < count:
+            worker = WebpackWorker()
+            atexit.register(worker.close)
+            _webpack_workers.append(worker)
+        return _webpack_workers[:count]
+
+
+def iter_concurrently(iterators):
+    """Iterate over all iterators at once, each in a thread of its own.
+
+    Items are yielded in the order they become available. If any of the
+    iterators fails, its exception is raised here, once the items it yielded
+    before have been consumed.
+    """
+    if len(iterators) == 1:
+        for item in iterators[0]:
+            yield item
+        return
+
+    queue = Queue.Queue()
+    done = object()
+
+    def consume(iterator):
+        try:
+            for item in iterator:
+                queue.put((item, None))
+            queue.put((done, None))
+        except Exception:
+            queue.put((done, sys.exc_info()))
+
+    for iterator in iterators:
+        thread = threading.Thread(target=consume, args=(iterator,))
+        thread.daemon = True
+        thread.start()
+
+    remaining = len(iterators)
+    while remaining:
+        item, exc_info = queue.get()
+        if item is not done:
+            yield item
+            continue
+        if exc_info:
+            raise exc_info[0], exc_info[1], exc_info[2]
+        remaining -= 1
+
+
+def balance(times, count):
+    """Split items into up to count groups, which take about the same time.
+
+    times gives the seconds each item took the last time, or None if that
+    isn't known, in which case it is assumed to take as long as the average
+    item. The items taking longest are distributed first, each to the group
+    with the least work so far. Returns lists of indexes into times, each in
+    ascending order, for the groups which got any items.
+    """
+    known = [time for time in times if time is not None]
+    default = sum(known) / len(known) if known else 1.0
+    times = [default if time is None else time for time in times]
+
+    groups = [[] for i in range(max(1, min(count, len(times))))]
+    loads = [0.0] * len(groups)
+    for i in sorted(range(len(times)), key=lambda i: -times[i]):
+        least = loads.index(min(loads))
+        groups[least].append(i)
+        loads[least] += times[i]
+    return [sorted(group) for group in groups if group]
+
+
+class BundleCache(object):
+    """Keeps the bundles created on disk, to use them for later builds.
+
+    Each bundle is stored along with the state of the files webpack looked at
+    or looked for, and of the directories they are in, as well as of the
+    directories modules are resolved in. A bundle is only used as long as all
+    of these are unchanged. Files added to or removed from any of the
+    directories might change how modules are resolved (e.g. with the legacy
+    prefix syntax), so they invalidate the bundle as well.
+    """
+
+    VERSION = 1
+
+    def __init__(self, cache, index=None):
+        self.cache = cache
+        self.index = index
+
+    def _get_key(self, extension_path, bundle):
+        # The bundle comes with the rendered info module as well as the
+        # module resolution settings.
+        return hashlib.sha1(json.dumps(
+            [self.VERSION, extension_path, bundle], sort_keys=True,
+        )).hexdigest()
+
+    def _get_state(self, bundle, dependencies):
+        directories = {path for path in bundle['resolve_paths']
+                       if os.path.isabs(path)}
+        directories.update(os.path.dirname(path) for path in dependencies)
+
+        listings = {}
+        for directory in directories:
+            try:
+                listings[directory] = sorted(os.listdir(directory))
+            except OSError:
+                listings[directory] = None
+        return {
+            'files': {path: get_path_hash(path, self.index)
+                      for path in dependencies},
+            'directories': listings,
+        }
+
+    def get(self, extension_path, bundle):
+        """Get the output for bundle, if it is still up to date."""
+        data = self.cache.get(self._get_key(extension_path, bundle))
+        if data is None:
+            return None
+        record = json.loads(data)
+        output = record['output']
+        if self._get_state(bundle, output['dependencies']) != record['state']:
+            return None
+        # Like the content webpack_runner.js sends, we return bytes.
+        output['content'] = output['content'].encode('utf-8')
+        return output
+
+    def set(self, extension_path, bundle, output):
+        state = self._get_state(bundle, output['dependencies'])
+        self.cache.set(self._get_key(extension_path, bundle), json.dumps({
+            'output': output,
+            'state': state,
+        }), replace=True)
+
+    def _get_time_key(self, extension_path, bundle):
+        # Unlike the bundle itself, the time it takes to compile it hardly
+        # depends on its exact configuration (e.g. the version).
+        return hashlib.sha1(json.dumps(
+            [self.VERSION, 'time', extension_path, bundle['bundle_name']],
+        )).hexdigest()
+
+    def get_time(self, extension_path, bundle):
+        """Get the seconds compiling bundle took last time, or None."""
+        data = self.cache.get(self._get_time_key(extension_path, bundle))
+        return None if data is None else float(data)
+
+    def set_time(self, extension_path, bundle, time):
+        self.cache.set(self._get_time_key(extension_path, bundle), repr(time),
+                       replace=True)
+
+
+def get_bundle_cache(base_dir, index=None):
+    # The StatIndex of the build is passed in, so that the hashes of the
+    # files bundled are known to (and saved along with) the build's index.
+    return BundleCache(
+        ContentCache(get_cache_path(base_dir, 'bundles'), BUNDLE_CACHE_SIZE),
+        index,
+    )
@@ -50,16 +50,19 @@ class ChainedConfigParser(ConfigParser.SafeConfigParser):
       option_source(section, option) method is provided to get the path
       of the configuration file defining this option (for relative paths).
       Items returned by the items() function also have a source attribute
-      serving the same purpose.
+      serving the same purpose. The filenames attribute lists all files
+      which have been read (or attempted to read) so far.
     """
 
     def __init__(self):
         ConfigParser.SafeConfigParser.__init__(self)
         self._origin = {}
+        self.filenames = []
 
     def _make_parser(self, filename):
         parser = ConfigParser.SafeConfigParser()
         parser.optionxform = lambda option: option
+        self.filenames.append(filename)
 
         with io.open(filename, encoding='utf-8') as file:
             parser.readfp(file, filename)
@@ -0,0 +1,251 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+# Note: This is a bundler for CommonJS modules, which doesn't need Node.js.
+# Modules are resolved like webpack_runner.js resolves them, but they are
+# wrapped into the bundle as they are, so it is only suitable for modules
+# which don't need to be compiled (e.g. no ES modules).
+
+import json
+import os
+import posixpath
+import re
+
+INFO_MODULE = os.path.join(os.path.dirname(__file__), 'info.js')
+
+# The defaults of webpack.
+EXTENSIONS = ['.js', '.json']
+MAIN_FIELDS = ['browser', 'module', 'main']
+
+# Requests for other modules, and everything they might appear in without
+# actually being one (i.e. comments and strings).
+_TOKEN_REGEXP = re.compile(r'''
+    //[^\n]*
+  | /\*.*?\*/
+  | "(?:[^"\\\n]|\\.)*"
+  | '(?:[^'\\\n]|\\.)*'
+  | `(?:[^`\\]|\\.)*`
+  | (?<![\w$.])require\s*\(\s*(?:
+        "(?P<double>(?:[^"\\\n]|\\.)*)"
+      | '(?P<single>(?:[^'\\\n]|\\.)*)'
+    )\s*\)
+''', re.S | re.X)
+
+_RUNTIME_START = '''(function(modules)
+{
+  var installed = [];
+
+  function load(id)
+  {
+    if (!installed[id])
+    {
+      var module = installed[id] = {id: id, exports: {}};
+      var dependencies = modules[id][1];
+      modules[id][0].call(module.exports, module, module.exports, request =>
+      {
+        if (!Object.prototype.hasOwnProperty.call(dependencies, request))
+          throw new Error("Cannot find module '" + request + "'");
+        return load(dependencies[request]);
+      });
+    }
+    return installed[id].exports;
+  }
+
+  for (let id of %s)
+    load(id);
+})([
+'''
+
+_RUNTIME_END = '''
+]);
+'''
+
+
+def _get_requests(source):
+    for match in _TOKEN_REGEXP.finditer(source):
+        request = match.group('double')
+        if request is None:
+            request = match.group('single')
+        if request is not None:
+            yield request.decode('string_escape')
+
+
+class _Resolver(object):
+    """Resolves modules like webpack, with our module resolution settings.
+
+    Keeps track of all files looked at, or looked for.
+    """
+
+    def __init__(self, resolve_paths, aliases):
+        self.resolve_paths = resolve_paths
+        self.aliases = aliases
+        self.dependencies = set()
+
+    def _is_file(self, path):
+        self.dependencies.add(path)
+        return os.path.isfile(path)
+
+    def _resolve_file(self, path):
+        for candidate in [path] + [path + ext for ext in EXTENSIONS]:
+            if self._is_file(candidate):
+                return candidate
+        return None
+
+    def _resolve_directory(self, path):
+        description = os.path.join(path, 'package.json')
+        if self._is_file(description):
+            with open(description, 'rb') as file:
+                package = json.load(file)
+            for field in MAIN_FIELDS:
+                main = package.get(field)
+                if isinstance(main, basestring):
+                    main = os.path.join(path, main.encode('utf-8'))
+                    resolved = self._resolve_path(os.path.normpath(main))
+                    if resolved:
+                        return resolved
+        return self._resolve_file(os.path.join(path, 'index'))
+
+    def _resolve_path(self, path):
+        return self._resolve_file(path) or self._resolve_directory(path)
+
+    def _get_module_directories(self, directory):
+        for module_path in self.resolve_paths:
+            if os.path.isabs(module_path):
+                yield module_path
+                continue
+            # Like node_modules, relative paths are looked up in all parent
+            # directories.
+            while True:
+                yield os.path.join(directory, module_path)
+                parent = os.path.dirname(directory)
+                if parent == directory:
+                    break
+                directory = parent
+
+    def _resolve_alias(self, request, directory):
+        for name, target in sorted(self.aliases.iteritems()):
+            if name.endswith('$'):
+                if request != name[:-1]:
+                    continue
+                aliased = target
+            elif request == name or request.startswith(name + '/'):
+                aliased = target + request[len(name):]
+            else:
+                continue
+            # An alias doesn't apply to what the module is aliased to.
+            if request == target or request.startswith(target + '/'):
+                continue
+            return self.resolve(aliased, directory)
+        return None
+
+    def _resolve_legacy(self, request):
+        # Our old module system in packagerChrome.py used to prefix module
+        # names with the name of their parent directory and an underscore -
+        # but only when that directory wasn't called "lib".
+        prefix, underscore, name = request.partition('_')
+        if not underscore or prefix == 'lib':
+            return None
+        return posixpath.normpath(posixpath.join(prefix, name))
+
+    def resolve(self, request, directory):
+        """Get the file request refers to, when required from directory."""
+        resolved = self._resolve_alias(request, directory)
+        if resolved:
+            return resolved
+
+        legacy_request = self._resolve_legacy(request)
+        if legacy_request:
+            resolved = self.resolve(legacy_request, directory)
+            if resolved:
+                return resolved
+
+        if (os.path.isabs(request) or request in {'.', '..'} or
+                request.startswith(('./', '../'))):
+            return self._resolve_path(
+                os.path.normpath(os.path.join(directory, request)),
+            )
+        for module_directory in self._get_module_directories(directory):
+            resolved = self._resolve_path(
+                os.path.normpath(os.path.join(module_directory, request)),
+            )
+            if resolved:
+                return resolved
+        return None
+
+
+def create_bundle(extension_path, bundle):
+    """Create a bundle, as described by a bundle of the configuration.
+
+    Returns its content, the files included in it, and the files the bundler
+    depends on for it, like the webpack bundler does.
+    """
+    resolver = _Resolver(bundle['resolve_paths'], bundle['aliases'])
+    ids = {}
+    modules = []
+
+    def add_module(request, directory):
+        path = resolver.resolve(request, directory)
+        if path is None:
+            raise Exception(
+                "Creating bundles failed:\nModule not found: Error: Can't "
+                "resolve '{}' in '{}'".format(request, directory),
+            )
+        if path in ids:
+            return ids[path]
+
+        ids[path] = len(modules)
+        module = {'path': path, 'dependencies': {}}
+        modules.append(module)
+        if path == INFO_MODULE:
+            module['source'] = bundle['info_module']
+            return ids[path]
+
+        with open(path, 'rb') as file:
+            source = file.read()
+        if path.endswith('.json'):
+            json.loads(source)
+            module['source'] = 'module.exports = ' + source + ';'
+            return ids[path]
+
+        module['source'] = source
+        for dependency in _get_requests(source):
+            module['dependencies'][dependency] = add_module(
+                dependency, os.path.dirname(path),
+            )
+        return ids[path]
+
+    entries = [add_module(entry, extension_path)
+               for entry in bundle['entry_points']]
+
+    chunks = [_RUNTIME_START % json.dumps(entries)]
+    for i, module in enumerate(modules):
+        if i:
+            chunks.append(',\n')
+        chunks.append('[function(module, exports, require)\n{\n')
+        chunks.append(module['source'])
+        chunks.append('\n}, ')
+        chunks.append(json.dumps(module['dependencies'], sort_keys=True))
+        chunks.append(']')
+    chunks.append(_RUNTIME_END)
+
+    return {
+        'content': ''.join(chunks),
+        'included': [os.path.relpath(module['path'], extension_path)
+                     for module in modules
+                     if module['path'] != INFO_MODULE],
+        'dependencies': sorted(resolver.dependencies),
+    }
+
+
+def iter_bundles(configuration, cache=None, jobs=1):
+    """Create the bundles described by configuration.
+
+    Yields the name of each bundle along with its content, the files
+    included in it, and the files the bundler depends on for it. Unlike with
+    webpack, creating bundles takes only milliseconds, so neither a cache nor
+    parallel jobs are used.
+    """
+    for bundle in configuration['bundles']:
+        yield (os.path.normpath(bundle['bundle_name']),
+               create_bundle(configuration['extension_path'], bundle))
@@ -0,0 +1,303 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+# Note: The daemon serves a single repository. Requests are handled one after
+# another, as each of them changes process-wide state (working directory,
+# environment, standard streams) while it runs. The client side is kept free
+# of any imports beyond the standard library (and build.py, which is loaded
+# anyway), so that forwarding a command costs little more than starting
+# Python. Commands which aren't forwarded don't even load this module.
+
+import errno
+import glob
+import hashlib
+import json
+import logging
+import os
+import socket
+import stat
+import sys
+import tempfile
+import threading
+import traceback
+
+from build import FORWARDED_COMMANDS, get_command
+
+SOCKET_NAME = 'daemon.sock'
+
+# Unix domain socket paths are limited to about 100 bytes on most systems.
+MAX_SOCKET_PATH = 100
+
+# Set while the daemon runs, so that it never forwards commands to itself.
+_serving = False
+
+# Stages write their output from multiple threads (see stages.py), but
+# messages mustn't interleave.
+_send_lock = threading.Lock()
+
+
+def _is_private(path):
+    # Anybody who can replace the socket could collect the environment sent
+    # along with each command, or make up its output.
+    info = os.lstat(path)
+    return info.st_uid == os.getuid() and not info.st_mode & 0o022
+
+
+def _get_private_dir():
+    # The temporary directory is shared with other users, so the socket is
+    # kept in a directory only the current user has access to.
+    path = os.path.join(tempfile.gettempdir(),
+                        'buildtools-{}'.format(os.getuid()))
+    try:
+        os.mkdir(path, 0o700)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+    info = os.lstat(path)
+    if (not stat.S_ISDIR(info.st_mode) or info.st_uid != os.getuid() or
+            stat.S_IMODE(info.st_mode) != 0o700):
+        raise Exception(path + ' is not private to the current user')
+    return path
+
+
+def get_socket_path(base_dir):
+    from buildcache import get_cache_path
+
+    base_dir = os.path.abspath(base_dir)
+    path = get_cache_path(base_dir, SOCKET_NAME)
+    if len(path) > MAX_SOCKET_PATH:
+        path = os.path.join(_get_private_dir(), '{}.sock'.format(
+            hashlib.sha1(base_dir).hexdigest()[:16],
+        ))
+    return path
+
+
+def _connect(path):
+    if not hasattr(socket, 'AF_UNIX') or not os.path.exists(path):
+        return None
+    if not (_is_private(path) and _is_private(os.path.dirname(path))):
+        logging.warning('Ignoring build daemon socket %s, as other users '
+                        'have access to it', path)
+        return None
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(path)
+    except socket.error as e:
+        sock.close()
+        if e.errno in {errno.ECONNREFUSED, errno.ENOENT}:
+            return None
+        raise
+    return sock
+
+
+def _send(file, **message):
+    data = json.dumps(message) + '\n'
+    with _send_lock:
+        file.write(data)
+        file.flush()
+
+
+def forward(base_dir, args):
+    """Run the command given by args in the daemon, if it is running.
+
+    Returns the exit code of the command, or None if it has to run in this
+    process instead.
+    """
+    if _serving or get_command(args) not in FORWARDED_COMMANDS:
+        return None
+    sock = _connect(get_socket_path(base_dir))
+    if sock is None:
+        return None
+
+    try:
+        file = sock.makefile('r+b')
+        _send(file, action='run', args=list(args), cwd=os.getcwd(),
+              env=dict(os.environ))
+        for line in file:
+            message = json.loads(line)
+            if 'output' in message:
+                stream = getattr(sys, message['stream'])
+                stream.write(message['output'].encode('utf-8'))
+                stream.flush()
+            elif 'exit' in message:
+                return message['exit']
+    except socket.error:
+        pass
+    finally:
+        sock.close()
+    # The daemon went away or is outdated
+    return None
+
+
+def stop(base_dir):
+    """Stop the daemon, returns False if it wasn't running."""
+    sock = _connect(get_socket_path(base_dir))
+    if sock is None:
+        return False
+    try:
+        file = sock.makefile('r+b')
+        _send(file, action='stop')
+        file.read()
+    finally:
+        sock.close()
+    return True
+
+
+class _ClientStream(object):
+    """Forwards everything written to it to the client of the daemon."""
+
+    encoding = 'utf-8'
+
+    def __init__(self, file, name):
+        self._file = file
+        self._name = name
+
+    def write(self, data):
+        if isinstance(data, str):
+            data = data.decode('utf-8', 'replace')
+        _send(self._file, stream=self._name, output=data)
+
+    def writelines(self, lines):
+        for line in lines:
+            self.write(line)
+
+    def flush(self):
+        pass
+
+    def isatty(self):
+        return False
+
+
+def _get_code_state():
+    import buildtools
+    from buildcache import _get_path_key
+
+    # The webpack worker (see bundling.py) keeps running along with the
+    # daemon, so it has to be restarted once webpack_runner.js changes.
+    paths = glob.glob(os.path.join(buildtools.__path__[0], '*.py'))
+    paths += glob.glob(os.path.join(buildtools.__path__[0], '*.js'))
+    return {path: _get_path_key(path) for path in paths}
+
+
+class BuildDaemon(object):
+    """Serves build commands for a repository over a Unix domain socket.
+
+    Since the daemon keeps running between builds, Python and all modules
+    only need to be loaded once. The same goes for webpack, which keeps
+    running in a worker process, as long as requests come with the same
+    environment variables and working directory. The parsed metadata, the
+    compiled templates and the stat index are kept in memory as well, as
+    long as the files they have been derived from don't change. Once
+    buildtools itself changes, the daemon exits, and commands are run by the
+    client until it is started again.
+    """
+
+    def __init__(self, base_dir):
+        self.base_dir = os.path.abspath(base_dir)
+        self.path = get_socket_path(self.base_dir)
+        self._code_state = _get_code_state()
+        self._running = False
+
+    def serve_forever(self):
+        global _serving
+        import packager
+        from buildcache import ResidentCache
+
+        if _connect(self.path):
+            raise Exception('A build daemon is already running for ' +
+                            self.base_dir)
+        try:
+            os.remove(self.path)
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+        directory = os.path.dirname(self.path)
+        try:
+            os.makedirs(directory)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+        # Clients refuse to connect if other users could replace the socket.
+        os.chmod(directory, stat.S_IMODE(os.stat(directory).st_mode) & ~0o022)
+
+        packager.resident_cache = ResidentCache()
+        _serving = True
+        server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            server.bind(self.path)
+            os.chmod(self.path, 0o600)
+            server.listen(5)
+            logging.info('Build daemon listening on %s', self.path)
+
+            self._running = True
+            while self._running:
+                connection, _ = server.accept()
+                file = connection.makefile('r+b')
+                try:
+                    self._handle(file)
+                except socket.error:
+                    # The client went away
+                    pass
+                finally:
+                    file.close()
+                    connection.close()
+        finally:
+            server.close()
+            os.remove(self.path)
+            packager.resident_cache = None
+            _serving = False
+
+    def _handle(self, file):
+        request = json.loads(file.readline())
+        if request['action'] == 'stop':
+            self._running = False
+            return
+
+        if _get_code_state() != self._code_state:
+            # Modules which have been loaded already would be outdated, so
+            # let the client run the command, and exit.
+            self._running = False
+            return
+
+        _send(file, exit=self._run(file, request))
+
+    def _run(self, file, request):
+        from build import process_args
+
+        cwd = os.getcwd()
+        environ = dict(os.environ)
+        streams = sys.stdout, sys.stderr
+        root = logging.getLogger()
+        handlers, level = root.handlers, root.level
+
+        stderr = _ClientStream(file, 'stderr')
+        sys.stdout = _ClientStream(file, 'stdout')
+        sys.stderr = stderr
+        root.handlers = [logging.StreamHandler(stderr)]
+        root.handlers[0].setFormatter(logging.Formatter(logging.BASIC_FORMAT))
+        args = request['args']
+        verbose = any(arg in {'-v', '--verbose'}
+                      for arg in args[:args.index(get_command(args))])
+        root.setLevel(logging.INFO if verbose else logging.WARNING)
+        try:
+            os.chdir(request['cwd'])
+            os.environ.clear()
+            os.environ.update(request['env'])
+
+            process_args(self.base_dir, *args)
+            return 0
+        except SystemExit as e:
+            if e.code is None or isinstance(e.code, int):
+                return e.code or 0
+            print >>sys.stderr, e.code
+            return 1
+        except Exception:
+            traceback.print_exc()
+            return 1
+        finally:
+            os.chdir(cwd)
+            os.environ.clear()
+            os.environ.update(environ)
+            sys.stdout, sys.stderr = streams
+            root.handlers, root.level = handlers, level
@@ -8,6 +8,10 @@ let infoModule = "";
 
 function infoLoader(source)
 {
+  // Each bundle can be given its own info module through the loader's options,
+  // so that bundles for several platforms can be created at the same time.
+  if (this.query && typeof this.query.infoModule == "string")
+    return this.query.infoModule;
   return infoModule;
 }
 infoLoader.setInfoModule = contents => { infoModule = contents; };
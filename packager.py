@@ -8,14 +8,51 @@
 import sys
 import os
 import re
+import atexit
+import fnmatch
+import glob
+import shutil
+import struct
 import subprocess
 import json
+import tempfile
+import threading
+import time
+import hashlib
 import zipfile
+import zlib
+from contextlib import contextmanager
+from itertools import izip
+from multiprocessing import Pool
+from multiprocessing.pool import ThreadPool
 from StringIO import StringIO
+
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+
 from chainedconfigparser import ChainedConfigParser
+from buildcache import (ContentCache, StatIndex, get_cache_path,
+                        get_code_files, get_path_hash, hash_file,
+                        iter_file_chunks)
 
 import buildtools
 
+ZIP_CACHE_SIZE = 256 * 1024 * 1024
+BUILD_CACHE_SIZE = 256 * 1024 * 1024
+PREPROCESS_CACHE_SIZE = 64 * 1024 * 1024
+
+# The earliest date which can be represented in zip files.
+ZIP_EPOCH = (1980, 1, 1, 0, 0, 0)
+
+# Entries smaller than this are kept in memory, even if Files is over its
+# memory budget, as writing them to disk would hardly save anything.
+SPILL_MIN_SIZE = 64 * 1024
+
 EXTENSIONS = {
     'edge': 'appx',
     'gecko': 'xpi',
@@ -51,6 +88,11 @@ def get_app_id(release_build, metadata):
     return get_build_specific_option(release_build, metadata, 'app_id')
 
 
+# Long-running processes (see daemon.py) set this to a buildcache.ResidentCache,
+# in order to keep the parsed metadata and the stat index between builds.
+resident_cache = None
+
+
 def getMetadataPath(baseDir, type):
     return os.path.join(baseDir, 'metadata.%s' % type)
 
@@ -60,12 +102,174 @@ def getDevEnvPath(baseDir, type):
 
 
 def readMetadata(baseDir, type):
+    path = getMetadataPath(baseDir, type)
+    if resident_cache:
+        key = ('metadata', os.path.abspath(path))
+        parser = resident_cache.get(key)
+        if parser is not None:
+            return parser
+
     parser = ChainedConfigParser()
     parser.optionxform = lambda option: option
-    parser.read(getMetadataPath(baseDir, type))
+    parser.read(path)
+
+    if resident_cache:
+        resident_cache.set(key, parser, [path] + parser.filenames)
     return parser
 
 
+def get_zip_cache(baseDir):
+    return ContentCache(get_cache_path(baseDir, 'zip'), ZIP_CACHE_SIZE)
+
+
+def get_preprocess_cache(baseDir):
+    return ContentCache(get_cache_path(baseDir, 'preprocess'),
+                        PREPROCESS_CACHE_SIZE)
+
+
+def get_stat_index(baseDir):
+    path = get_cache_path(baseDir, 'index.json')
+    if resident_cache:
+        # The index checks by itself whether the hashes it knows are still
+        # valid, so it can be kept as long as the process lives.
+        index = resident_cache.get(('stat_index', path))
+        if index is None:
+            index = StatIndex(path)
+            resident_cache.set(('stat_index', path), index)
+        return index
+    return StatIndex(path)
+
+
+def get_build_cache(baseDir):
+    return ContentCache(get_cache_path(baseDir, 'builds'), BUILD_CACHE_SIZE)
+
+
+def _iter_fingerprint_files(params, files):
+    # The metadata files, including those the metadata inherits from.
+    baseDir = params['baseDir']
+    for path in params['metadata'].filenames:
+        yield 'metadata:' + os.path.relpath(path, baseDir), path
+
+    # The source files which go into the package, as they were read.
+    for relpath in sorted(dict.iterkeys(files)):
+        entry = files.get_entry(relpath)
+        if entry:
+            yield relpath, entry.path
+
+    # Templates and scripts which are part of the build come from buildtools.
+    buildtoolsDir = os.path.dirname(os.path.abspath(__file__))
+    for path in get_code_files():
+        yield 'buildtools:' + os.path.relpath(path, buildtoolsDir), path
+
+
+def get_build_fingerprint(params, files, index=None, keyFile=None):
+    """Get a digest of everything that goes into a build.
+
+    This covers the (resolved) metadata, the content of the source files
+    read into files (before running the build), buildtools itself, as well
+    as the build parameters and the signing key, but not the current time.
+    So the package might differ in its timestamps, unless the build is
+    reproducible. Files which the build depends on otherwise, e.g. through
+    webpack, are only known after building, so restore_build() checks these.
+    """
+    baseDir = params['baseDir']
+    metadata = params['metadata']
+    digest = hashlib.sha1()
+
+    def update(*values):
+        digest.update(json.dumps(values) + '\n')
+
+    update(params['type'], params['version'], params['releaseBuild'],
+           params['devenv'], params.get('reproducible', False))
+    if params.get('bundler'):
+        update('bundler', params['bundler'])
+    if params.get('reproducible'):
+        update(os.environ.get('SOURCE_DATE_EPOCH'))
+    if (not params['releaseBuild'] and not params['devenv'] and
+            os.path.exists(os.path.join(baseDir, '.git'))):
+        # The revision goes into the build as .revision
+        update(subprocess.check_output(['git', 'rev-parse', 'HEAD'],
+                                       cwd=baseDir))
+
+    for section in sorted(metadata.sections()):
+        update(section, sorted((item, item.source) for item in
+                               metadata.items(section, raw=True)))
+
+    if keyFile:
+        update(hash_file(keyFile))
+
+    for relpath, path in _iter_fingerprint_files(params, files):
+        update(relpath, get_path_hash(path, index))
+
+    return digest.hexdigest()
+
+
+def use_build_cache(params, outFile, keyFile=None):
+    # Development environments are built into memory, and are rebuilt
+    # whenever the poller notices any changes anyway. Builds signed with a
+    # key which doesn't exist yet can't be fingerprinted.
+    return (params['cache'] and not params['devenv'] and
+            isinstance(outFile, basestring) and
+            (keyFile is None or os.path.exists(keyFile)))
+
+
+def restore_build(baseDir, fingerprint, outFile, index=None):
+    """Copy the cached result of a build to outFile, if there is any.
+
+    The build is only used if none of the files it depended on, which are
+    not covered by the fingerprint, changed since, and if the same files
+    are found for the patterns it listed files with.
+    """
+    cache = get_build_cache(baseDir)
+    record = cache.get(fingerprint)
+    if record is None:
+        return False
+    record = json.loads(record)
+    if any(get_path_hash(path, index) != digest
+           for path, digest in record['dependencies'].iteritems()):
+        return False
+    if any(sorted(glob.glob(pattern)) != paths
+           for pattern, paths in record['globs'].iteritems()):
+        return False
+
+    data = cache.get(record['package'])
+    if data is None:
+        return False
+    with open(outFile, 'wb') as file:
+        file.write(data)
+    return True
+
+
+def store_build(baseDir, fingerprint, outFile, dependencies=None,
+                globs=None):
+    """Cache the package in outFile, for builds with the same fingerprint.
+
+    dependencies maps further files the build depended on to their hashes,
+    and globs the patterns it listed files with to the paths found, like
+    StageRunner.dependencies and StageRunner.globs.
+    """
+    with open(outFile, 'rb') as file:
+        data = file.read()
+    cache = get_build_cache(baseDir)
+    package_key = hashlib.sha1(data).hexdigest()
+    cache.set(package_key, data)
+    record = {'dependencies': dependencies or {}, 'globs': globs or {},
+              'package': package_key}
+    cache.set(fingerprint, json.dumps(record), replace=True)
+
+
+def get_source_date_time():
+    """Get the timestamp to give all entries of reproducible builds.
+
+    As suggested by https://reproducible-builds.org/specs/source-date-epoch/,
+    this is taken from the SOURCE_DATE_EPOCH environment variable, if set.
+    """
+    epoch = os.environ.get('SOURCE_DATE_EPOCH')
+    if epoch is None:
+        return ZIP_EPOCH
+    return max(time.gmtime(int(epoch))[:6], ZIP_EPOCH)
+
+
 def getBuildNum(baseDir):
     try:
         from buildtools.ensure_dependencies import Mercurial, Git
@@ -99,51 +303,901 @@ def getBuildVersion(baseDir, metadata, releaseBuild, buildNum=None):
     return version
 
 
+def get_template_environment(autoescape=False):
+    """Return the jinja2 environment used for all templates of the build.
+
+    There is one environment per process (and an autoescaping overlay of it),
+    which keeps the templates it has loaded. Compiled templates are also kept
+    on disk in jinja2's bytecode cache, so that no template is compiled again
+    unless its source changed.
+    """
+    env = _template_environments.get(autoescape)
+    if env is not None:
+        return env
+
+    import jinja2
+
+    base = _template_environments.get(False)
+    if base is None:
+        template_path = os.path.join(buildtools.__path__[0], 'templates')
+        base = jinja2.Environment(
+            loader=jinja2.FileSystemLoader(template_path),
+            bytecode_cache=_get_bytecode_cache(jinja2, 'plain'),
+        )
+        base.filters.update({'json': json.dumps})
+        _template_environments[False] = base
+    if autoescape:
+        # The code generated for autoescaping templates differs, so it has
+        # to be cached separately.
+        env = base.overlay(autoescape=True,
+                           bytecode_cache=_get_bytecode_cache(jinja2,
+                                                              'escaped'))
+        _template_environments[True] = env
+    return _template_environments[autoescape]
+
+
+def _get_preprocess_environment(autoescape=False):
+    # Files of the extension are rendered in an environment of their own,
+    # which can neither load buildtools' templates nor use its filters, but
+    # which shares the bytecode cache.
+    key = ('preprocess', autoescape)
+    env = _template_environments.get(key)
+    if env is None:
+        import jinja2
+
+        bytecode_cache = get_template_environment(autoescape).bytecode_cache
+        env = jinja2.Environment(autoescape=autoescape,
+                                 bytecode_cache=bytecode_cache)
+        _template_environments[key] = env
+    return env
+
+
+def _get_bytecode_cache(jinja2, kind):
+    try:
+        return jinja2.FileSystemBytecodeCache(
+            pattern='__buildtools_{}_%s.cache'.format(kind),
+        )
+    except (OSError, RuntimeError):
+        # There is no usable temporary directory.
+        return None
+
+
+_template_environments = {}
+
+
 def getTemplate(template, autoEscape=False):
+    return get_template_environment(autoEscape).get_template(template)
+
+
+def compile_template(source, name, autoescape=False):
+    """Return a template for source, e.g. a file of the extension.
+
+    Templates are looked up in the bytecode cache by their name and source,
+    just like the templates of buildtools. Unlike these, they can't include
+    other templates, or use the filters buildtools adds.
+    """
+    env = _get_preprocess_environment(autoescape)
+    cache = env.bytecode_cache
+    if cache is None:
+        return env.from_string(source)
+
+    # The cache is shared with buildtools' templates, which are compiled
+    # with another environment.
+    bucket = cache.get_bucket(env, 'preprocess:' + name, None, source)
+    if bucket.code is None:
+        bucket.code = env.compile(source, name, name)
+        cache.set_bucket(bucket)
+    return env.template_class.from_code(env, bucket.code, env.make_globals(None))
+
+
+# Delimiters of jinja2's default syntax. Files without any of them render as
+# they are, except for line breaks.
+TEMPLATE_DELIMITERS = ('{{', '{%', '{#')
+
+# Line breaks (UTF-8 encoded) other than \n, which jinja2 replaces with \n,
+# as it splits templates with unicode.splitlines().
+_LINE_BREAKS = re.compile(r'\r|[\x0b\x0c\x1c-\x1e]|\xc2\x85|\xe2\x80[\xa8\xa9]')
+
+
+def _has_template_syntax(source):
+    return any(delimiter in source for delimiter in TEMPLATE_DELIMITERS)
+
+
+def _pass_through_template(source):
+    # Gives the same result as rendering a template without any syntax.
+    if _LINE_BREAKS.search(source) is None:
+        # Only the trailing newline is removed by jinja2 then.
+        return source[:-1] if source.endswith('\n') else source
+    return '\n'.join(source.decode('utf-8').splitlines()).encode('utf-8')
+
+
+def _render_template(args):
+    """Render the content of a file as a jinja2 template.
+
+    Takes the content and name of the file, whether to autoescape and the
+    parameters to render the template with, so that files can be rendered
+    by worker processes.
+    """
+    source, name, autoescape, params = args
+    template = compile_template(source.decode('utf-8'), name, autoescape)
+    return template.render(params).encode('utf-8')
+
+
+def _get_render_key(source, name, autoescape, params):
+    # The name only appears in error messages, so files with the same
+    # content share their results.
     import jinja2
 
-    template_path = os.path.join(buildtools.__path__[0], 'templates')
-    loader = jinja2.FileSystemLoader(template_path)
-    if autoEscape:
-        env = jinja2.Environment(loader=loader, autoescape=True)
+    return hashlib.sha1(json.dumps(
+        [jinja2.__version__, autoescape, params,
+         hashlib.sha1(source).hexdigest()],
+        sort_keys=True, default=repr,
+    )).hexdigest()
+
+
+class FileEntry(object):
+    """A file on disk which is part of the build but hasn't been read yet.
+
+    Files only keeps these records for files it reads, and only loads their
+    content when it is actually accessed, so that files which go into the
+    package unchanged are never held in memory as a whole. If a StatIndex is
+    given, the hash is looked up there rather than computed from the content.
+    """
+
+    __slots__ = ('path', 'stat', 'index', '_hash')
+
+    def __init__(self, path, stat=None, index=None):
+        if stat is None:
+            stat = os.stat(path)
+        self.path = path
+        self.stat = stat
+        self.index = index
+        self._hash = None
+
+    def __getstate__(self):
+        # Entries are sent to worker processes, which have no use for the
+        # index. The stat results of the scandir module can't be pickled.
+        return self.path, os.stat_result(tuple(self.stat)[:10]), self._hash
+
+    def __setstate__(self, state):
+        self.path, self.stat, self._hash = state
+        self.index = None
+
+    @property
+    def size(self):
+        return self.stat.st_size
+
+    @property
+    def mtime(self):
+        return self.stat.st_mtime
+
+    def read(self):
+        with open(self.path, 'rb') as file:
+            return file.read()
+
+    def iter_chunks(self):
+        return iter_file_chunks(self.path)
+
+    @property
+    def hash(self):
+        """Hex SHA-1 digest of the file's content, computed on first use."""
+        if self._hash is None:
+            if self.index:
+                self._hash = self.index.get_hash(self.path, self.stat)
+            else:
+                self._hash = hash_file(self.path)
+        return self._hash
+
+
+class SpilledEntry(FileEntry):
+    """Content which was generated during the build but written to disk.
+
+    Unlike for a FileEntry, the content has already been passed through the
+    process hook. If the content was unicode, it is stored UTF-8 encoded, and
+    encoding is set.
+    """
+
+    __slots__ = ('encoding',)
+
+    def __init__(self, path, content_hash, encoding=None):
+        super(SpilledEntry, self).__init__(path)
+        self._hash = content_hash
+        self.encoding = encoding
+
+    def __getstate__(self):
+        return super(SpilledEntry, self).__getstate__() + (self.encoding,)
+
+    def __setstate__(self, state):
+        super(SpilledEntry, self).__setstate__(state[:-1])
+        self.encoding = state[-1]
+
+
+class _SpillFiles(object):
+    """The files which entries of Files and their forks were spilled to.
+
+    Files and their forks share the SpilledEntry objects, so each file keeps
+    a count of the entries referring to it, and is only removed once
+    there are none left.
+    """
+
+    def __init__(self):
+        self.path = tempfile.mkdtemp(prefix='buildtools-spill-')
+        atexit.register(shutil.rmtree, self.path, True)
+        self._refs = {}
+        self._lock = threading.Lock()
+
+    def create(self, data, encoding=None):
+        """Write data to a new file, and get a SpilledEntry for it."""
+        fd, path = tempfile.mkstemp(dir=self.path)
+        with os.fdopen(fd, 'wb') as file:
+            file.write(data)
+        with self._lock:
+            self._refs[path] = 1
+        return SpilledEntry(path, hashlib.sha1(data).hexdigest(), encoding)
+
+    def acquire(self, entry):
+        with self._lock:
+            if entry.path in self._refs:
+                self._refs[entry.path] += 1
+
+    def release(self, entry):
+        with self._lock:
+            if entry.path not in self._refs:
+                return
+            self._refs[entry.path] -= 1
+            if self._refs[entry.path] > 0:
+                return
+            del self._refs[entry.path]
+        os.remove(entry.path)
+
+    def remove(self):
+        """Remove all files, regardless of entries still referring to them."""
+        with self._lock:
+            self._refs.clear()
+        shutil.rmtree(self.path, ignore_errors=True)
+
+
+class _Patterns(object):
+    """A set of names, some of which may be glob patterns."""
+
+    def __init__(self, patterns):
+        self._names = set()
+        self._globs = []
+        for pattern in patterns:
+            if any(char in pattern for char in '*?['):
+                self._globs.append(re.compile(fnmatch.translate(pattern)))
+            else:
+                self._names.add(pattern)
+
+    def __contains__(self, name):
+        if name in self._names:
+            return True
+        return any(glob.match(name) for glob in self._globs)
+
+
+class FileMatcher(object):
+    """Decides which files go into the build when reading a directory tree.
+
+    Only files whose top-level directory (or which themselves) are listed in
+    included go into the build. Files are left out if any directory on their
+    path, or the file itself, is listed in ignored, or if their path is listed
+    in skip. All of these may contain glob patterns.
+    """
+
+    def __init__(self, included, ignored, skip=()):
+        self._included = _Patterns(included)
+        self._ignored = _Patterns(ignored)
+        self._skip = _Patterns(skip)
+
+    def is_included(self, relpath):
+        return relpath.split('/', 1)[0] in self._included
+
+    def is_ignored(self, relpath):
+        return any(part in self._ignored for part in relpath.split('/'))
+
+    def is_skipped(self, relpath):
+        return relpath in self._skip
+
+    def matches(self, relpath):
+        return (self.is_included(relpath) and not self.is_ignored(relpath) and
+                not self.is_skipped(relpath))
+
+    def match_child(self, dir_relpath, name):
+        """Get the relative path of name in dir_relpath, if it matches.
+
+        The directory is assumed to match already, so that only the name has
+        to be checked, rather than splitting up the whole path again. Returns
+        None if the child doesn't match.
+        """
+        if name in self._ignored:
+            return None
+        if dir_relpath:
+            relpath = dir_relpath + '/' + name
+        elif name in self._included:
+            relpath = name
+        else:
+            return None
+        if relpath in self._skip:
+            return None
+        return relpath
+
+
+class _DirEntry(object):
+    """Fallback for the entries scandir() returns, if it isn't available."""
+
+    def __init__(self, dirpath, name):
+        self.name = name
+        self.path = os.path.join(dirpath, name)
+
+    def is_dir(self):
+        return os.path.isdir(self.path)
+
+    def stat(self):
+        return os.stat(self.path)
+
+
+def _scandir(path):
+    if scandir:
+        return scandir(path)
+    return (_DirEntry(path, name) for name in os.listdir(path))
+
+
+def iter_files(path, relpath, matcher):
+    """Yield (relpath, entry) for each file below path which matches.
+
+    The directory tree is walked iteratively, and directories which don't
+    match aren't descended into. Where available, the file type information
+    returned by scandir() is used rather than calling stat() on every entry.
+    If path is a file, it is yielded as is.
+    """
+    if not os.path.isdir(path):
+        yield relpath, _DirEntry(*os.path.split(path))
+        return
+
+    if relpath and (not matcher.is_included(relpath) or
+                    matcher.is_ignored(relpath)):
+        return
+
+    stack = [(path, relpath)]
+    while stack:
+        dirpath, dir_relpath = stack.pop()
+        for entry in sorted(_scandir(dirpath), key=lambda e: e.name,
+                            reverse=True):
+            entry_relpath = matcher.match_child(dir_relpath, entry.name)
+            if entry_relpath is None:
+                continue
+            if entry.is_dir():
+                stack.append((entry.path, entry_relpath))
+            else:
+                yield entry_relpath, entry
+
+
+class JobBudget(object):
+    """Limits the number of processes working on a build at the same time.
+
+    Stages of the build may run at the same time, each in a thread holding
+    one job (see stages.StageRunner). Work spread over several processes,
+    like compressing files or running webpack, takes the jobs left over in
+    addition, so that no more than jobs processes are busy overall.
+    """
+
+    def __init__(self, jobs):
+        self.jobs = max(jobs, 1)
+        self._available = self.jobs
+        self._condition = threading.Condition()
+
+    def acquire(self):
+        """Take one job, waiting until one is available."""
+        with self._condition:
+            while self._available < 1:
+                self._condition.wait()
+            self._available -= 1
+
+    def release(self, count=1):
+        with self._condition:
+            self._available += count
+            self._condition.notify_all()
+
+    @contextmanager
+    def take(self):
+        """Take the jobs left over, for work spread over several processes.
+
+        Yields the number of processes to use. The calling thread counts as
+        one of them, as it waits for the others.
+        """
+        with self._condition:
+            extra = min(self._available, self.jobs - 1)
+            self._available -= extra
+        try:
+            yield extra + 1
+        finally:
+            if extra:
+                self.release(extra)
+
+
+def get_job_budget(params):
+    """Get the JobBudget shared by everything working on a build."""
+    budget = params.get('job_budget')
+    if budget is None:
+        budget = JobBudget(params.get('jobs', 1))
+    return budget
+
+
+def _map_threaded(func, items, threads):
+    """Like map(), but calls func on a pool of threads if threads > 1.
+
+    This is meant for I/O bound functions, e.g. on network filesystems.
+    """
+    if threads <= 1 or len(items) < 2:
+        return map(func, items)
+    pool = ThreadPool(min(threads, len(items)))
+    try:
+        return pool.map(func, items)
+    finally:
+        pool.terminate()
+
+
+def _get_content_hash(source):
+    if isinstance(source, FileEntry):
+        return source.hash
+    return hashlib.sha1(source).hexdigest()
+
+
+class CompressionPolicy(object):
+    """Decides how each entry of a zip file is compressed.
+
+    Entries with one of stored_extensions, typically formats which are
+    compressed already, are stored as they are. Other entries are deflated at
+    the given zlib level, unless that doesn't get them below max_ratio times
+    their original size, in which case they are stored as well.
+    """
+
+    PRECOMPRESSED_EXTENSIONS = frozenset([
+        '.png', '.jpg', '.jpeg', '.gif', '.webp', '.ico', '.woff', '.woff2',
+        '.zip', '.gz', '.xpi', '.crx', '.mp3', '.mp4', '.ogg', '.webm',
+    ])
+
+    def __init__(self, compression=zipfile.ZIP_DEFLATED,
+                 level=zlib.Z_DEFAULT_COMPRESSION, stored_extensions=(),
+                 max_ratio=None):
+        self.compression = compression
+        self.level = level
+        self.stored_extensions = frozenset(stored_extensions)
+        self.max_ratio = max_ratio
+
+    def get_compression(self, name):
+        """Get the compression type, level and max ratio for an entry."""
+        extension = os.path.splitext(name)[1].lower()
+        if (self.compression == zipfile.ZIP_STORED or
+                extension in self.stored_extensions):
+            return zipfile.ZIP_STORED, None, None
+        return self.compression, self.level, self.max_ratio
+
+
+def get_compression_policy(params):
+    """Get the compression policy to use for the given build.
+
+    Development environments are compressed quickly, as they are unpacked
+    straight away, while release builds get the best compression.
+    """
+    if params['devenv']:
+        level = zlib.Z_BEST_SPEED
+    elif params['releaseBuild']:
+        level = zlib.Z_BEST_COMPRESSION
     else:
-        env = jinja2.Environment(loader=loader)
-    env.filters.update({'json': json.dumps})
-    return env.get_template(template)
+        level = zlib.Z_DEFAULT_COMPRESSION
+
+    return CompressionPolicy(
+        level=level,
+        stored_extensions=CompressionPolicy.PRECOMPRESSED_EXTENSIONS,
+        max_ratio=0.95,
+    )
+
+
+class CompressionSummary(dict):
+    """Number of entries and bytes before and after compression by category.
+
+    Entries are categorized by their file extension.
+    """
+
+    def add(self, name, size, compressed_size):
+        category = os.path.splitext(name)[1].lower() or '(none)'
+        totals = self.setdefault(category, [0, 0, 0])
+        totals[0] += 1
+        totals[1] += size
+        totals[2] += compressed_size
+
+    def format(self):
+        lines = []
+        for category, (count, size, compressed_size) in sorted(
+                self.iteritems(), key=lambda item: -item[1][1]):
+            lines.append('{}: {} files, {} bytes, {} compressed '
+                         '({} saved)'.format(category, count, size,
+                                             compressed_size,
+                                             size - compressed_size))
+        return '\n'.join(lines)
+
+
+def _compress(args):
+    """Compress the data of a single zip entry.
+
+    The data is either given as a string or as a FileEntry, which is read in
+    chunks. Returns the compression type actually used, the CRC, the
+    uncompressed size and the compressed data, so that entries can be
+    compressed by worker processes and be written into the archive
+    afterwards. Deflating works the same as ZipFile.writestr() does, if the
+    default level is used.
+    """
+    source, compress_type, level, max_ratio = args
+    if isinstance(source, FileEntry):
+        chunks = source.iter_chunks()
+    else:
+        chunks = [source]
+
+    compressor = None
+    if compress_type == zipfile.ZIP_DEFLATED:
+        compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+
+    crc = 0
+    size = 0
+    output = []
+    for chunk in chunks:
+        crc = zlib.crc32(chunk, crc)
+        size += len(chunk)
+        output.append(compressor.compress(chunk) if compressor else chunk)
+    if compressor:
+        output.append(compressor.flush())
+    data = ''.join(output)
+
+    if compressor and max_ratio is not None and len(data) > size * max_ratio:
+        # Not worth it, store the data instead, and pay with reading
+        # streamed files twice.
+        compress_type = zipfile.ZIP_STORED
+        data = source.read() if isinstance(source, FileEntry) else source
+
+    return compress_type, crc & 0xffffffff, size, data
+
+
+def _get_compression_key(source, compress_type, level, max_ratio):
+    # The zlib version is part of the key as different versions might
+    # compress differently, and a cache hit must give the same result as
+    # compressing the data again.
+    return hashlib.sha1('{}:{}:{}:{}:{}'.format(
+        zlib.ZLIB_VERSION, compress_type, level, max_ratio,
+        _get_content_hash(source),
+    )).hexdigest()
+
+
+def _iter_compressed(tasks, jobs=1, cache=None, threads=1):
+    """Compress entries, yielding the results in order.
+
+    Tasks are tuples of a source (string or FileEntry) along with the
+    compression type, level and max ratio to use. Results found in the cache
+    (a buildcache.ContentCache) are used as they are, the other tasks are
+    compressed, on a pool of worker processes if jobs > 1, and their results
+    are added to the cache. Otherwise, if threads > 1, files are hashed and
+    compressed on a pool of threads, as zlib releases the GIL.
+    """
+    keys = [None] * len(tasks)
+    pending = range(len(tasks))
+    if cache:
+        keys = _map_threaded(lambda task: _get_compression_key(*task), tasks,
+                             threads)
+        pending = [i for i, key in enumerate(keys) if key not in cache]
+
+    pool = None
+    if len(pending) > 1:
+        if jobs > 1:
+            pool = Pool(jobs)
+        elif threads > 1:
+            pool = ThreadPool(threads)
+    try:
+        if pool:
+            results = pool.imap(_compress, (tasks[i] for i in pending))
+        else:
+            results = (_compress(tasks[i]) for i in pending)
+
+        pending = set(pending)
+        for i, task in enumerate(tasks):
+            if i in pending:
+                result = next(results)
+                if cache:
+                    compress_type, crc, size, data = result
+                    cache.set(keys[i], struct.pack('<HII', compress_type,
+                                                   crc, size) + data)
+            else:
+                blob = cache.get(keys[i])
+                if blob is None:
+                    # Evicted by a concurrent build since we looked it up.
+                    result = _compress(task)
+                else:
+                    result = struct.unpack_from('<HII', blob) + (blob[10:],)
+            yield result
+    finally:
+        if pool:
+            pool.terminate()
+
+
+def _write_compressed(zf, zinfo, crc, size, data):
+    """Write an entry whose data was compressed already to a ZipFile.
+
+    ZipFile.writestr() insists on compressing the data itself, so this
+    mirrors what it does, minus the compression.
+    """
+    zinfo.CRC = crc
+    zinfo.file_size = size
+    zinfo.compress_size = len(data)
+    zinfo.header_offset = zf.fp.tell()
+    zf._writecheck(zinfo)
+    zf._didModify = True
+    zip64 = (zinfo.file_size > zipfile.ZIP64_LIMIT or
+             zinfo.compress_size > zipfile.ZIP64_LIMIT)
+    if zip64 and not zf._allowZip64:
+        raise zipfile.LargeZipFile('Filesize would require ZIP64 extensions')
+    zf.fp.write(zinfo.FileHeader(zip64))
+    zf.fp.write(data)
+    zf.filelist.append(zinfo)
+    zf.NameToInfo[zinfo.filename] = zinfo
 
 
 class Files(dict):
-    def __init__(self, includedFiles, ignoredFiles, process=None):
+    def __init__(self, includedFiles, ignoredFiles, process=None, index=None,
+                 io_threads=1, memory_budget=None):
         self.includedFiles = includedFiles
         self.ignoredFiles = ignoredFiles
         self.process = process
+        self.index = index
+        self.io_threads = io_threads
+        self.memory_budget = memory_budget
+        self.matcher = FileMatcher(includedFiles, ignoredFiles)
+        # While a build stage runs, this is the stages.StageRecorder which
+        # keeps track of the files it accesses.
+        self.recorder = None
+        self._resident = {}
+        self._resident_size = 0
+        # The _SpillFiles shared with forks, and whether these files created
+        # it (rather than being a fork).
+        self._spill_files = None
+        self._owns_spill_files = False
 
     def __setitem__(self, key, value):
         if self.process:
             value = self.process(key, value)
+        self._store(key, value)
+
+    def _store(self, key, value):
+        if self.recorder:
+            self.recorder.add_output(key)
+        self._discard(key)
         dict.__setitem__(self, key, value)
+        if isinstance(value, SpilledEntry) and self._spill_files:
+            self._spill_files.acquire(value)
+        elif self.memory_budget is not None and not isinstance(value,
+                                                               FileEntry):
+            if isinstance(value, unicode):
+                size = len(value.encode('utf-8'))
+            else:
+                size = len(value)
+            self._resident[key] = size
+            self._resident_size += size
+            if self._resident_size > self.memory_budget:
+                self._spill()
+
+    def __getitem__(self, key):
+        if self.recorder:
+            self.recorder.add_entry(self, key)
+        value = dict.__getitem__(self, key)
+        if isinstance(value, SpilledEntry):
+            data = value.read()
+            if value.encoding:
+                data = data.decode(value.encoding)
+            return data
+        if isinstance(value, FileEntry):
+            # Content read from disk is passed through the process hook
+            # when it is loaded, rather than when the file is read.
+            value = value.read()
+            if self.process:
+                value = self.process(key, value)
+        return value
+
+    def __delitem__(self, key):
+        if self.recorder:
+            self.recorder.add_output(key)
+        self._discard(key)
+        dict.__delitem__(self, key)
+
+    def __contains__(self, key):
+        if self.recorder:
+            self.recorder.add_entry(self, key)
+        return dict.__contains__(self, key)
+
+    def __iter__(self):
+        if self.recorder:
+            self.recorder.add_listing()
+        return dict.__iter__(self)
+
+    def keys(self):
+        return list(self)
+
+    def _discard(self, key):
+        # Forget about the current value for key, which is being replaced
+        # or removed.
+        value = dict.get(self, key)
+        if key in self._resident:
+            self._resident_size -= self._resident.pop(key)
+        elif isinstance(value, SpilledEntry) and self._spill_files:
+            self._spill_files.release(value)
+
+    def _spill(self):
+        # Write the largest entries to disk, until the ones left in memory
+        # fit into the budget again.
+        if self._spill_files is None:
+            self._spill_files = _SpillFiles()
+            self._owns_spill_files = True
+
+        candidates = sorted(self._resident.iteritems(),
+                            key=lambda (key, size): size, reverse=True)
+        for key, size in candidates:
+            if (self._resident_size <= self.memory_budget or
+                    size < SPILL_MIN_SIZE):
+                break
+            data = dict.__getitem__(self, key)
+            encoding = None
+            if isinstance(data, unicode):
+                data = data.encode('utf-8')
+                encoding = 'utf-8'
+
+            entry = self._spill_files.create(data, encoding)
+            self._discard(key)
+            dict.__setitem__(self, key, entry)
+
+    def close(self):
+        """Remove the files which entries were spilled to, if any.
+
+        Spilled entries can no longer be accessed afterwards. For a fork,
+        only the files which neither the original nor other forks refer to
+        anymore are removed.
+        """
+        if self._spill_files is None:
+            return
+        if self._owns_spill_files:
+            self._spill_files.remove()
+        else:
+            for value in dict.itervalues(self):
+                if isinstance(value, SpilledEntry):
+                    self._spill_files.release(value)
+        self._spill_files = None
+
+    def get(self, key, default=None):
+        if key in self:
+            return self[key]
+        return default
+
+    def pop(self, key, *args):
+        if key not in self:
+            return dict.pop(self, key, *args)
+        value = self[key]
+        del self[key]
+        return value
+
+    def itervalues(self):
+        for key in self:
+            yield self[key]
+
+    def iteritems(self):
+        for key in self:
+            yield key, self[key]
+
+    def values(self):
+        return list(self.itervalues())
+
+    def items(self):
+        return list(self.iteritems())
+
+    def fork(self):
+        """Get a copy, which can be changed independently of these files.
+
+        The copy has no memory budget, but entries which have been spilled
+        to disk can still be accessed through it until close() is called on
+        either of them, even if they are replaced in the original meanwhile.
+        """
+        files = Files(self.includedFiles, self.ignoredFiles, self.process,
+                      self.index, self.io_threads)
+        dict.update(files, self)
+        files._spill_files = self._spill_files
+        if self._spill_files:
+            for value in dict.itervalues(files):
+                if isinstance(value, SpilledEntry):
+                    self._spill_files.acquire(value)
+        return files
+
+    def get_changes(self, before):
+        """Get the changes made since before (a copy of the files' entries).
+
+        The result can be passed to apply_changes().
+        """
+        changes = {key: value for key, value in dict.iteritems(self)
+                   if before.get(key) is not value}
+        for key in before:
+            if not dict.__contains__(self, key):
+                changes[key] = None
+        return changes
+
+    def get_file_hash(self, key):
+        """Get the hex SHA-1 digest of a file's content, or None if missing.
+
+        This doesn't pass files through the process hook.
+        """
+        value = dict.get(self, key)
+        if value is None:
+            return None
+        if isinstance(value, unicode):
+            value = value.encode('utf-8')
+        return _get_content_hash(value)
+
+    def get_file_size(self, key):
+        """Get the size of a file in bytes, or None if missing.
+
+        This doesn't pass files through the process hook.
+        """
+        value = dict.get(self, key)
+        if value is None:
+            return None
+        if isinstance(value, FileEntry):
+            return value.size
+        if isinstance(value, unicode):
+            value = value.encode('utf-8')
+        return len(value)
+
+    def apply_changes(self, changes):
+        """Update files with the recorded result of a build stage.
+
+        changes maps names to their new content (a string or FileEntry), or
+        to None for files which were removed. The content is expected to
+        have been passed through the process hook already.
+        """
+        for key, value in changes.iteritems():
+            if value is None:
+                if dict.__contains__(self, key):
+                    del self[key]
+            else:
+                self._store(key, value)
+
+    def get_entry(self, key):
+        """Get the FileEntry for key, or None if its content is in memory."""
+        value = dict.__getitem__(self, key)
+        if isinstance(value, FileEntry):
+            return value
+        return None
 
     def isIncluded(self, relpath):
-        return relpath.split('/')[0] in self.includedFiles
+        return self.matcher.is_included(relpath)
 
     def is_ignored(self, relpath):
-        parts = relpath.split('/')
-        return any(part in self.ignoredFiles for part in parts)
+        return self.matcher.is_ignored(relpath)
+
+    def _find_files(self, path, relpath='', skip=()):
+        matcher = self.matcher
+        if skip:
+            matcher = FileMatcher(self.includedFiles, self.ignoredFiles, skip)
+        return list(iter_files(path, relpath, matcher))
+
+    def _add_files(self, found):
+        # On slow (e.g. network) filesystems, waiting for each stat() call
+        # in turn adds up, so these are done on a pool of threads if
+        # configured. The files are still added in the order they were found.
+        stats = _map_threaded(lambda (name, entry): entry.stat(), found,
+                              self.io_threads)
+        for (name, entry), stat in izip(found, stats):
+            if dict.__contains__(self, name):
+                print >>sys.stderr, 'Warning: File %s defined multiple times' % name
+            self._store(name, FileEntry(entry.path, stat, self.index))
 
     def read(self, path, relpath='', skip=()):
-        if os.path.isdir(path):
-            for file in os.listdir(path):
-                name = relpath + ('/' if relpath != '' else '') + file
-                included = self.isIncluded(name) and not self.is_ignored(name)
-                if name not in skip and included:
-                    self.read(os.path.join(path, file), name, skip)
-        else:
-            with open(path, 'rb') as file:
-                if relpath in self:
-                    print >>sys.stderr, 'Warning: File %s defined multiple times' % relpath
-                self[relpath] = file.read()
+        self._add_files(self._find_files(path, relpath, skip))
 
     def readMappedFiles(self, mappings):
+        found = []
         for item in mappings:
             target, source = item
 
@@ -153,23 +1207,132 @@ class Files(dict):
             parts = source.split('/')
             path = os.path.join(os.path.dirname(item.source), *parts)
             if os.path.exists(path):
-                self.read(path, target)
+                found.extend(self._find_files(path, target))
             else:
                 print >>sys.stderr, "Warning: Mapped file %s doesn't exist" % source
 
-    def preprocess(self, filenames, params={}):
-        import jinja2
-        env = jinja2.Environment()
+        self._add_files(found)
+
+    def preprocess(self, filenames, params={}, jobs=1, cache=None):
+        """Render the given files as jinja2 templates with params.
 
+        Files without any template syntax are passed through, rather than
+        compiling them, and remain untouched unless jinja2 would change their
+        line breaks. Rendered files are taken from cache (a
+        buildcache.ContentCache) if possible. The other files are rendered,
+        on a pool of worker processes if jobs > 1, and added to the cache.
+        """
+        results = {}
+        tasks = []
         for filename in filenames:
-            env.autoescape = os.path.splitext(filename)[1].lower() in ('.html', '.xml')
-            template = env.from_string(self[filename].decode('utf-8'))
-            self[filename] = template.render(params).encode('utf-8')
+            source = self[filename]
+            if isinstance(source, unicode):
+                source = source.encode('utf-8')
+            if not _has_template_syntax(source):
+                result = _pass_through_template(source)
+                if result != source:
+                    self[filename] = result
+                continue
 
-    def zip(self, outFile, sortKey=None, compression=zipfile.ZIP_DEFLATED):
+            autoescape = os.path.splitext(filename)[1].lower() in ('.html', '.xml')
+            task = (source, filename, autoescape, params)
+            key = None
+            if cache:
+                key = _get_render_key(*task)
+                results[filename] = cache.get(key)
+                if results[filename] is not None:
+                    continue
+            tasks.append((filename, key, task))
+
+        args = [task_args for _, _, task_args in tasks]
+        if jobs > 1 and len(tasks) > 1:
+            pool = Pool(min(jobs, len(tasks)))
+            try:
+                rendered = pool.map(_render_template, args)
+            finally:
+                pool.terminate()
+        else:
+            rendered = map(_render_template, args)
+
+        for (filename, key, _), result in izip(tasks, rendered):
+            if cache:
+                cache.set(key, result)
+            results[filename] = result
+        for filename, result in results.iteritems():
+            self[filename] = result
+
+    def zip(self, outFile, sortKey=None, compression=zipfile.ZIP_DEFLATED,
+            jobs=1, cache=None, policy=None, date_time=None):
+        """Write all files into a zip archive.
+
+        Returns a CompressionSummary. Unless a CompressionPolicy is given, all
+        entries are compressed the same, according to compression. Unless
+        date_time is given, entries are timestamped with the current time.
+        """
+        if policy is None:
+            policy = CompressionPolicy(compression)
+
+        names = sorted(self, key=sortKey)
+        tasks = [(self._get_zip_source(name),) + policy.get_compression(name)
+                 for name in names]
+        if date_time is None:
+            date_time = time.localtime(time.time())[:6]
+        summary = CompressionSummary()
+
+        # Deflating is the expensive part, so entries are compressed up
+        # front, in parallel if requested, or taken from the cache. The
+        # results are still written in order, so the archive is the same
+        # either way.
         with zipfile.ZipFile(outFile, 'w', compression) as zf:
-            for name in sorted(self, key=sortKey):
-                zf.writestr(name, self[name])
+            results = _iter_compressed(tasks, jobs, cache, self.io_threads)
+            for name, (compress_type, crc, size, data) in izip(names,
+                                                               results):
+                zinfo = zipfile.ZipInfo(name, date_time)
+                zinfo.compress_type = compress_type
+                zinfo.create_system = 3  # Unix, as for the attributes below.
+                zinfo.external_attr = 0o600 << 16
+                _write_compressed(zf, zinfo, crc, size, data)
+                summary.add(name, size, len(data))
+
+        return summary
+
+    def _get_zip_source(self, name):
+        # Files which don't have to go through the process hook are streamed
+        # into the archive straight from disk.
+        entry = self.get_entry(name)
+        if entry and (not self.process or isinstance(entry, SpilledEntry)):
+            return entry
+        data = self[name]
+        if isinstance(data, unicode):
+            data = data.encode('utf-8')
+        return data
+
+    def get_content_hash(self):
+        """Get the hex SHA-1 digest of the names and content of all files."""
+        digest = hashlib.sha1()
+        for name in sorted(self):
+            source = self._get_zip_source(name)
+            digest.update('{}\0{}\0'.format(name, _get_content_hash(source)))
+        return digest.hexdigest()
+
+    def write_to_directory(self, path):
+        """Write all files into a directory, e.g. for a development environment.
+
+        Files which don't have to go through the process hook are copied
+        straight from disk.
+        """
+        for name in self:
+            target = os.path.join(path, *name.split('/'))
+            dirname = os.path.dirname(target)
+            if not os.path.isdir(dirname):
+                os.makedirs(dirname)
+
+            source = self._get_zip_source(name)
+            if isinstance(source, FileEntry):
+                shutil.copyfile(source.path, target)
+            else:
+                with open(target, 'wb') as file:
+                    file.write(source)
 
     def zipToString(self, sortKey=None):
         buffer = StringIO()
@@ -2,11 +2,12 @@
 # License, v. 2.0. If a copy of the MPL was not distributed with this
 # file, You can obtain one at http://mozilla.org/MPL/2.0/.
 
+import collections
 import ConfigParser
 import errno
-import glob
 import io
 import json
+import logging
 import os
 import re
 import struct
@@ -14,9 +15,20 @@ import subprocess
 import sys
 import random
 import posixpath
+import tempfile
+import time
+from multiprocessing.pool import ThreadPool
 
 from packager import (readMetadata, getDefaultFileName, getBuildVersion,
-                      getTemplate, get_extension, Files, get_app_id)
+                      getTemplate, get_extension, Files, get_app_id,
+                      get_zip_cache, get_preprocess_cache, get_stat_index,
+                      get_compression_policy, get_source_date_time,
+                      use_build_cache, JobBudget, get_job_budget,
+                      get_build_fingerprint, restore_build, store_build)
+import commonjs
+from bundling import (balance, get_bundle_cache, get_webpack_workers,
+                      iter_concurrently)
+from stages import StageRunner, get_stage_cache, glob_files, record_file
 
 defaultLocale = 'en_US'
 
@@ -45,6 +57,17 @@ def processFile(path, data, params):
     return data
 
 
+_defaultProcessFile = processFile
+
+
+def get_file_processor(params):
+    # Unless processFile() has been overridden, there is no need to load files
+    # just in order to pass them through it.
+    if processFile is _defaultProcessFile:
+        return None
+    return lambda path, data: processFile(path, data, params)
+
+
 def makeIcons(files, filenames):
     icons = {}
     for filename in filenames:
@@ -142,6 +165,19 @@ def createManifest(params, files):
     return manifest.encode('utf-8')
 
 
+def add_manifest(params, files):
+    files['manifest.json'] = createManifest(params, files)
+
+
+def preprocess_files(params, files, filenames):
+    cache = None
+    if params['cache']:
+        cache = get_preprocess_cache(params['baseDir'])
+    with get_job_budget(params).take() as jobs:
+        files.preprocess(filenames, {'needsExt': True}, jobs=jobs,
+                         cache=cache)
+
+
 def toJson(data):
     return json.dumps(
         data, ensure_ascii=False, sort_keys=True,
@@ -149,7 +185,7 @@ def toJson(data):
     ).encode('utf-8') + '\n'
 
 
-def create_bundles(params, files, bundle_tests):
+def get_bundle_configuration(params, bundle_tests):
     base_extension_path = params['baseDir']
     info_templates = {
         'chrome': 'chromeInfo.js.tmpl',
@@ -189,11 +225,17 @@ def create_bundles(params, files, bundle_tests):
     configuration = {
         'bundles': [],
         'extension_path': base_extension_path,
-        'info_module': info_module,
-        'resolve_paths': resolve_paths,
-        'aliases': aliases,
     }
 
+    def add_bundle(bundle_name, entry_points):
+        configuration['bundles'].append({
+            'bundle_name': bundle_name,
+            'entry_points': entry_points,
+            'info_module': info_module,
+            'resolve_paths': resolve_paths,
+            'aliases': aliases,
+        })
+
     for item in params['metadata'].items('bundles'):
         name, value = item
         base_item_path = os.path.dirname(item.source)
@@ -202,40 +244,190 @@ def create_bundles(params, files, bundle_tests):
                                       base_extension_path)
         entry_files = [os.path.join(base_item_path, module_path)
                        for module_path in value.split()]
-        configuration['bundles'].append({
-            'bundle_name': bundle_file,
-            'entry_points': entry_files,
-        })
+        add_bundle(bundle_file, entry_files)
 
     if bundle_tests:
         test_paths = os.path.join(base_extension_path, 'qunit', 'tests', '*.js')
-        configuration['bundles'].append({
-            'bundle_name': 'qunit/tests.js',
-            'entry_points': glob.glob(test_paths),
-        })
+        add_bundle('qunit/tests.js', glob_files(test_paths))
+
+    return configuration
+
+
+def iter_webpack(configuration, cache=None, jobs=1):
+    """Create the bundles described by configuration.
+
+    Yields the name of each bundle along with its content, the files
+    included in it, and the files webpack depends on for it, as soon as the
+    bundle is ready. If cache (a bundling.BundleCache) is given, bundles
+    which are up to date there are taken from it, and only the others are
+    created. These are spread over up to jobs webpack workers, balanced by
+    how long each bundle took to compile the last time.
+    """
+    extension_path = configuration['extension_path']
+    # This is how webpack_runner.js names the bundles it created.
+    bundles = collections.OrderedDict(
+        (os.path.normpath(bundle['bundle_name']), bundle)
+        for bundle in configuration['bundles']
+    )
+
+    pending = []
+    for name, bundle in bundles.iteritems():
+        result = cache.get(extension_path, bundle) if cache else None
+        if result is None:
+            pending.append(bundle)
+        else:
+            yield name, result
+    if not pending:
+        return
+
+    times = [None] * len(pending)
+    if cache:
+        times = [cache.get_time(extension_path, bundle) for bundle in pending]
+    groups = balance(times, jobs)
+    workers = get_webpack_workers(len(groups))
+    responses = [
+        worker.iter_bundles(dict(configuration,
+                                 bundles=[pending[i] for i in group]))
+        for worker, group in zip(workers, groups)
+    ]
+    for name, result in iter_concurrently(responses):
+        seconds = result.pop('time', None)
+        if cache:
+            cache.set(extension_path, bundles[name], result)
+            if seconds is not None:
+                cache.set_time(extension_path, bundles[name], seconds)
+        yield name, result
+
+
+def run_webpack(configuration, cache=None, jobs=1):
+    """Create the bundles described by configuration.
+
+    Returns a dictionary mapping the name of each bundle to what
+    iter_webpack() yields along with it, in the order of configuration.
+    """
+    output = dict(iter_webpack(configuration, cache, jobs))
+    names = [os.path.normpath(bundle['bundle_name'])
+             for bundle in configuration['bundles']]
+    return collections.OrderedDict((name, output[name]) for name in names)
+
+
+class SharedBundler(object):
+    """Creates the bundles for several builds in a single webpack run.
+
+    The configurations of all builds (e.g. for different platforms or
+    versions) are added up front. Once the bundles for any of them are
+    needed, the bundles for all of them are created.
+    """
+
+    def __init__(self):
+        self._configurations = []
+        self._output = None
+
+    def add(self, configuration):
+        if configuration not in self._configurations:
+            self._configurations.append(configuration)
+            self._output = None
+
+    def _create_all(self, cache, jobs):
+        # The bundles of each configuration are put into a separate
+        # directory, as they usually have the same names. Configurations
+        # for the same extension path are bundled in one go.
+        requests = collections.OrderedDict()
+        for i, configuration in enumerate(self._configurations):
+            bundles = requests.setdefault(configuration['extension_path'], [])
+            for bundle in configuration['bundles']:
+                bundles.append(dict(
+                    bundle, bundle_name=posixpath.join(
+                        '__{}__'.format(i), bundle['bundle_name'],
+                    ),
+                ))
+
+        self._output = [{} for configuration in self._configurations]
+        for extension_path, bundles in requests.iteritems():
+            output = run_webpack({
+                'bundles': bundles,
+                'extension_path': extension_path,
+            }, cache, jobs)
+            # The names of the bundles have been normalized by now, so they
+            # are split up the way os.path.normpath() joined them.
+            for name, bundle in output.iteritems():
+                directory, name = name.split(os.sep, 1)
+                self._output[int(directory.strip('_'))][name] = bundle
+
+    def bundle(self, configuration, cache=None, jobs=1):
+        if configuration not in self._configurations:
+            # The configuration wasn't added up front, e.g. because it was
+            # created with a different build number.
+            return run_webpack(configuration, cache, jobs)
+        if self._output is None:
+            self._create_all(cache, jobs)
+        return self._output[self._configurations.index(configuration)]
+
+
+# The functions creating the bundles described by a configuration, by the
+# name they are selected with. They take a bundling.BundleCache (or None) and
+# the number of parallel jobs, and yield the name of each bundle along with
+# its content, the files included in it, and the files it depends on.
+BUNDLERS = {
+    'webpack': iter_webpack,
+    'python': commonjs.iter_bundles,
+}
+
+
+def get_bundler(params):
+    """Get the name of the bundler to create the bundles of a build with.
+
+    It can be given on the command line, or in the general section of the
+    metadata, otherwise webpack is used.
+    """
+    bundler = params.get('bundler')
+    metadata = params['metadata']
+    if not bundler and metadata.has_option('general', 'bundler'):
+        bundler = metadata.get('general', 'bundler')
+    bundler = bundler or 'webpack'
+    if bundler not in BUNDLERS:
+        raise Exception('Unknown bundler: ' + bundler)
+    return bundler
+
+
+def create_bundles(params, files, bundle_tests):
+    configuration = get_bundle_configuration(params, bundle_tests)
+    bundler = get_bundler(params)
+    cache = None
+    if params['cache']:
+        cache = get_bundle_cache(params['baseDir'], files.index)
+    shared = params.get('shared_bundler')
+    names = {os.path.normpath(bundle['bundle_name'])
+             for bundle in configuration['bundles']}
+
+    with get_job_budget(params).take() as jobs:
+        if bundler == 'webpack' and shared:
+            output = shared.bundle(configuration, cache, jobs).iteritems()
+        else:
+            # Each bundle is added once it has been created, while the
+            # others are still being worked on.
+            output = BUNDLERS[bundler](configuration, cache, jobs)
 
-    cmd = ['node', os.path.join(os.path.dirname(__file__), 'webpack_runner.js')]
-    process = subprocess.Popen(cmd, stdout=subprocess.PIPE,
-                               stdin=subprocess.PIPE)
-    output = process.communicate(input=toJson(configuration))[0]
-    if process.returncode != 0:
-        raise subprocess.CalledProcessError(process.returncode, cmd=cmd)
-    output = json.loads(output)
+        for name, bundle in output:
+            for dependency in bundle['dependencies']:
+                record_file(dependency)
 
-    # Clear the mapping for any files included in a bundle, to avoid them being
-    # duplicated in the build.
-    for to_ignore in output['included']:
-        files.pop(to_ignore, None)
+            # Clear the mapping for any files included in a bundle, to avoid
+            # them being duplicated in the build. Bundles created already
+            # are kept, whichever other bundle they might be included in.
+            for to_ignore in bundle['included']:
+                if to_ignore not in names:
+                    files.pop(to_ignore, None)
 
-    for bundle in output['files']:
-        files[bundle] = output['files'][bundle].encode('utf-8')
+            files[name] = bundle['content']
 
 
 def import_locales(params, files):
     for item in params['metadata'].items('import_locales'):
         filename = item[0]
-        for sourceFile in glob.glob(os.path.join(os.path.dirname(item.source),
-                                                 *filename.split('/'))):
+        for sourceFile in glob_files(os.path.join(os.path.dirname(item.source),
+                                                  *filename.split('/'))):
+            record_file(sourceFile)
             keys = item[1]
             locale = sourceFile.split(os.path.sep)[-2]
             targetFile = posixpath.join('_locales', locale, 'messages.json')
@@ -306,22 +498,26 @@ def fix_translations_for_chrome(files):
                 files['_locales/es_419/' + filename] = data
 
 
-def signBinary(zipdata, keyFile):
-    from Crypto.Hash import SHA
+def _load_private_key(keyFile):
     from Crypto.PublicKey import RSA
-    from Crypto.Signature import PKCS1_v1_5
 
     try:
         with open(keyFile, 'rb') as file:
-            key = RSA.importKey(file.read())
+            return RSA.importKey(file.read())
     except IOError as e:
         if e.errno != errno.ENOENT:
             raise
         key = RSA.generate(2048)
         with open(keyFile, 'wb') as file:
             file.write(key.exportKey('PEM'))
+        return key
+
+
+def signBinary(zipdata, keyFile):
+    from Crypto.Hash import SHA
+    from Crypto.Signature import PKCS1_v1_5
 
-    return PKCS1_v1_5.new(key).sign(SHA.new(zipdata))
+    return PKCS1_v1_5.new(_load_private_key(keyFile)).sign(SHA.new(zipdata))
 
 
 def getPublicKey(keyFile):
@@ -330,16 +526,89 @@ def getPublicKey(keyFile):
         return RSA.importKey(file.read()).publickey().exportKey('DER')
 
 
+class _HashingWriter(object):
+    """Write-only file object feeding everything it writes into a hash.
+
+    Positions reported by tell() are relative to where writing started, so
+    that a zip archive written through it has the same offsets as one
+    written to a file of its own.
+    """
+
+    def __init__(self, file, digest):
+        self._file = file
+        self._digest = digest
+        self._position = 0
+
+    def write(self, data):
+        self._file.write(data)
+        self._digest.update(data)
+        self._position += len(data)
+
+    def tell(self):
+        return self._position
+
+    def flush(self):
+        self._file.flush()
+
+
+def write_package(outputFile, files, keyFile=None, **kwargs):
+    """Write files as a zip archive, or as a signed CRX if keyFile is given.
+
+    The archive is streamed to outputFile and into the signature hash as it
+    is being written, so no copy of the whole archive is held in memory. The
+    CRX header is written with a placeholder signature of the right size up
+    front and filled in once the archive is complete, hence outputFile has to
+    be seekable. Any further keyword arguments are passed on to Files.zip(),
+    and its CompressionSummary is returned.
+    """
+    if isinstance(outputFile, basestring):
+        with open(outputFile, 'wb') as file:
+            return write_package(file, files, keyFile, **kwargs)
+
+    if keyFile is None:
+        return files.zip(outputFile, **kwargs)
+
+    from Crypto.Hash import SHA
+    from Crypto.Signature import PKCS1_v1_5
+    from Crypto.Util.number import ceil_div, size
+
+    key = _load_private_key(keyFile)
+    pubkey = key.publickey().exportKey('DER')
+    signature_length = ceil_div(size(key.n), 8)
+
+    header_start = outputFile.tell()
+    outputFile.write(struct.pack('<4sIII', 'Cr24', 2, len(pubkey),
+                                 signature_length))
+    outputFile.write(pubkey)
+    outputFile.write('\0' * signature_length)
+
+    digest = SHA.new()
+    summary = files.zip(_HashingWriter(outputFile, digest), **kwargs)
+    signature = PKCS1_v1_5.new(key).sign(digest)
+
+    end = outputFile.tell()
+    outputFile.seek(header_start + 16 + len(pubkey))
+    outputFile.write(signature)
+    outputFile.seek(end)
+    return summary
+
+
 def writePackage(outputFile, pubkey, signature, zipdata):
+    """Write an archive created up front, as a CRX if signed.
+
+    Kept for external callers, write_package() avoids holding the whole
+    archive in memory.
+    """
     if isinstance(outputFile, basestring):
-        file = open(outputFile, 'wb')
-    else:
-        file = outputFile
-    if pubkey != None and signature != None:
-        file.write(struct.pack('<4sIII', 'Cr24', 2, len(pubkey), len(signature)))
-        file.write(pubkey)
-        file.write(signature)
-    file.write(zipdata)
+        with open(outputFile, 'wb') as file:
+            return writePackage(file, pubkey, signature, zipdata)
+
+    if pubkey is not None and signature is not None:
+        outputFile.write(struct.pack('<4sIII', 'Cr24', 2, len(pubkey),
+                                     len(signature)))
+        outputFile.write(pubkey)
+        outputFile.write(signature)
+    outputFile.write(zipdata)
 
 
 def add_devenv_requirements(files, metadata, params):
@@ -347,67 +616,392 @@ def add_devenv_requirements(files, metadata, params):
         os.path.join(os.path.dirname(__file__), 'chromeDevenvPoller__.js'),
         relpath='devenvPoller__.js',
     )
-    files['devenvVersion__'] = str(random.random())
 
     if metadata.has_option('general', 'testScripts'):
         files['qunit/index.html'] = createScriptPage(
             params, 'testIndex.html.tmpl', ('general', 'testScripts'),
         )
 
+    # The poller reloads the extension whenever this changes, so for
+    # reproducible builds it is derived from the content of all other files.
+    if params.get('reproducible'):
+        files['devenvVersion__'] = files.get_content_hash()
+    else:
+        files['devenvVersion__'] = str(random.random())
 
-def createBuild(baseDir, type='chrome', outFile=None, buildNum=None, releaseBuild=False, keyFile=None, devenv=False):
-    metadata = readMetadata(baseDir, type)
-    version = getBuildVersion(baseDir, metadata, releaseBuild, buildNum)
 
-    if outFile == None:
-        file_extension = get_extension(type, keyFile is not None)
-        outFile = getDefaultFileName(metadata, version, file_extension)
+def read_files(files, baseDir, metadata):
+    if metadata.has_section('mapping'):
+        mapped = metadata.items('mapping')
+        files.readMappedFiles(mapped)
+        files.read(baseDir, skip=[filename for filename, _ in mapped])
+    else:
+        files.read(baseDir)
+
+
+class SharedBuildState(object):
+    """Work shared between several builds of a repository.
+
+    The builds, e.g. for different platforms, use the same stat index, so
+    that each source file is hashed only once. Files read for one build are
+    reused for any other build reading the same files, and the bundles for
+    all builds are created in a single webpack run.
+    """
+
+    def __init__(self, baseDir, cache=True):
+        self.baseDir = baseDir
+        self.index = get_stat_index(baseDir) if cache else None
+        self.bundler = SharedBundler()
+        self._read = {}
+
+    def add_build(self, type, releaseBuild=False, buildNum=None,
+                  devenv=False):
+        """Register a build, so its bundles are created with all others."""
+        metadata = readMetadata(self.baseDir, type)
+        if not metadata.has_section('bundles'):
+            return
+        params = {
+            'type': type,
+            'baseDir': self.baseDir,
+            'version': getBuildVersion(self.baseDir, metadata, releaseBuild,
+                                       buildNum),
+            'metadata': metadata,
+        }
+        bundle_tests = devenv and metadata.has_option('general', 'testScripts')
+        self.bundler.add(get_bundle_configuration(params, bundle_tests))
+
+    def read_files(self, files, metadata):
+        mapped = []
+        if metadata.has_section('mapping'):
+            mapped = metadata.items('mapping')
+        key = (tuple(sorted(files.includedFiles)),
+               tuple(sorted(files.ignoredFiles)),
+               tuple(tuple(item) for item in mapped))
+        if key not in self._read:
+            read_files(files, self.baseDir, metadata)
+            self._read[key] = dict.copy(files)
+        else:
+            dict.update(files, self._read[key])
+
 
-    params = {
+def createBuild(baseDir, type='chrome', outFile=None, buildNum=None, releaseBuild=False, keyFile=None, devenv=False, jobs=1, io_threads=1, cache=True, memory_budget=None, reproducible=False, rebuild=False, shared=None, bundler=None):
+    variant = {
+        'outFile': outFile,
+        'buildNum': buildNum,
+        'releaseBuild': releaseBuild,
+        'keyFile': keyFile,
+    }
+    createBuildMatrix(baseDir, type, [variant], devenv=devenv, jobs=jobs,
+                      io_threads=io_threads, cache=cache,
+                      memory_budget=memory_budget, reproducible=reproducible,
+                      rebuild=rebuild, shared=shared, bundler=bundler)
+
+
+class BuildResult(object):
+    """The outcome of a build, before it has been written to a package.
+
+    files is the Files of the build, and stats an OrderedDict mapping the
+    steps of the build (reading the files, each stage, and writing the
+    package) to the seconds they took and the number of bytes they produced.
+    dependencies maps the files outside of files which the build depended
+    on to their hashes, and globs the patterns it listed files with to the
+    paths found.
+    For Edge, the package is the zip file which createBuild() passes on to
+    manifoldjs.
+    """
+
+    # Packages up to this size are kept in memory by get_package()
+    SPOOL_SIZE = 64 * 1024 * 1024
+
+    def __init__(self, params, files, stats=None, keyFile=None,
+                 dependencies=None, globs=None):
+        self.params = params
+        self.files = files
+        self.stats = collections.OrderedDict(stats or ())
+        self.keyFile = keyFile
+        self.dependencies = dependencies or {}
+        self.globs = globs or {}
+
+    def write(self, outFile):
+        """Write the package to outFile, a path or a seekable file object.
+
+        Returns the CompressionSummary of the package.
+        """
+        params = self.params
+        baseDir = params['baseDir']
+        start = time.time()
+        offset = 0 if isinstance(outFile, basestring) else outFile.tell()
+
+        with get_job_budget(params).take() as jobs:
+            summary = write_package(
+                outFile, self.files, self.keyFile, jobs=jobs,
+                cache=get_zip_cache(baseDir) if params['cache'] else None,
+                policy=get_compression_policy(params),
+                date_time=(get_source_date_time() if params['reproducible']
+                           else None),
+            )
+
+        if isinstance(outFile, basestring):
+            size = os.path.getsize(outFile)
+        else:
+            size = outFile.tell() - offset
+        self.stats['package'] = (time.time() - start, size)
+        return summary
+
+    def get_package(self):
+        """Get the package as a stream, positioned at its start."""
+        stream = tempfile.SpooledTemporaryFile(self.SPOOL_SIZE)
+        self.write(stream)
+        stream.seek(0)
+        return stream
+
+    def close(self):
+        self.files.close()
+
+
+def get_build_params(baseDir, type, metadata, releaseBuild=False,
+                     buildNum=None, devenv=False, jobs=1, io_threads=1,
+                     cache=True, reproducible=False, shared=None,
+                     bundler=None):
+    return {
         'type': type,
         'baseDir': baseDir,
         'releaseBuild': releaseBuild,
-        'version': version,
+        'version': getBuildVersion(baseDir, metadata, releaseBuild, buildNum),
         'devenv': devenv,
         'metadata': metadata,
+        'jobs': jobs,
+        'job_budget': JobBudget(jobs),
+        'io_threads': io_threads,
+        'cache': cache,
+        'reproducible': reproducible,
+        'bundler': bundler,
+        'shared_bundler': shared.bundler if shared else None,
     }
 
-    mapped = metadata.items('mapping') if metadata.has_section('mapping') else []
+
+def get_build_index(baseDir, cache=True, shared=None):
+    if shared:
+        return shared.index
+    return get_stat_index(baseDir) if cache else None
+
+
+def read_build_files(params, index=None, shared=None, memory_budget=None,
+                     process=None):
+    """Create the Files of a build, and read the source files into it.
+
+    Returns the files and the stats of reading them.
+    """
+    start = time.time()
     files = Files(getPackageFiles(params), getIgnoredFiles(params),
-                  process=lambda path, data: processFile(path, data, params))
+                  process=process, index=index,
+                  io_threads=params['io_threads'],
+                  memory_budget=memory_budget)
+    if shared:
+        shared.read_files(files, params['metadata'])
+    else:
+        read_files(files, params['baseDir'], params['metadata'])
+
+    size = sum(files.get_file_size(name) for name in dict.iterkeys(files))
+    return files, collections.OrderedDict(read=(time.time() - start, size))
 
-    files.readMappedFiles(mapped)
-    files.read(baseDir, skip=[opt for opt, _ in mapped])
+
+def _create_result(params, index, shared, memory_budget):
+    baseDir = params['baseDir']
+    metadata = params['metadata']
+    files, stats = read_build_files(params, index, shared, memory_budget,
+                                    get_file_processor(params))
+
+    building_from_git = os.path.exists(os.path.join(baseDir, '.git'))
+    if (not params['releaseBuild'] and not params['devenv'] and
+            building_from_git):
+        cmd = ['git', 'rev-parse', 'HEAD']
+        files['.revision'] = subprocess.check_output(cmd, cwd=baseDir)
+
+    # Unless their inputs changed, the results of these stages are taken
+    # from the previous build. With jobs > 1, stages which don't depend on
+    # each other, e.g. webpack and the manifest, run at the same time.
+    stages = StageRunner(params, files, get_stage_cache(baseDir)
+                         if params['cache'] else None, index)
 
     if metadata.has_section('bundles'):
-        bundle_tests = devenv and metadata.has_option('general', 'testScripts')
-        create_bundles(params, files, bundle_tests)
+        bundle_tests = (params['devenv'] and
+                        metadata.has_option('general', 'testScripts'))
+        stages.add('bundles', create_bundles, (bundle_tests,))
 
     if metadata.has_section('preprocess'):
-        files.preprocess(
-            [f for f, _ in metadata.items('preprocess')],
-            {'needsExt': True},
-        )
+        stages.add('preprocess', preprocess_files,
+                   ([f for f, _ in metadata.items('preprocess')],))
 
     if metadata.has_section('import_locales'):
-        import_locales(params, files)
+        stages.add('import_locales', import_locales)
 
-    files['manifest.json'] = createManifest(params, files)
-    building_from_git = os.path.exists(os.path.join(baseDir, '.git'))
-    if not releaseBuild and not devenv and building_from_git:
-        cmd = ['git', 'rev-parse', 'HEAD']
-        files['.revision'] = subprocess.check_output(cmd, cwd=baseDir)
+    stages.add('manifest', add_manifest)
+
+    if params['type'] == 'chrome':
+        stages.add('fix_translations',
+                   lambda params, files: fix_translations_for_chrome(files),
+                   after=('bundles', 'preprocess', 'import_locales',
+                          'manifest'))
 
-    if type == 'chrome':
-        fix_translations_for_chrome(files)
+    stages.run_all(params['jobs'])
+    stats.update(stages.stats)
 
-    if devenv:
+    if params['devenv']:
+        start = time.time()
         add_devenv_requirements(files, metadata, params)
+        stats['devenv'] = (time.time() - start, 0)
+    return BuildResult(params, files, stats,
+                       dependencies=stages.dependencies,
+                       globs=stages.globs)
+
+
+def create_build_result(baseDir, type='chrome', buildNum=None,
+                        releaseBuild=False, keyFile=None, devenv=False,
+                        jobs=1, io_threads=1, cache=True, memory_budget=None,
+                        reproducible=False, shared=None, bundler=None):
+    """Run a build, without writing the package.
+
+    Takes the same arguments as createBuild(), and returns a BuildResult.
+    Its close() method should be called once it is no longer needed.
+    """
+    metadata = readMetadata(baseDir, type)
+    params = get_build_params(baseDir, type, metadata, releaseBuild,
+                              buildNum, devenv, jobs, io_threads, cache,
+                              reproducible, shared, bundler)
+    index = get_build_index(baseDir, cache, shared)
+    result = _create_result(params, index, shared, memory_budget)
+    result.keyFile = keyFile
+    if index:
+        index.save()
+    return result
+
+
+def createBuildMatrix(baseDir, type='chrome', variants=({},), devenv=False,
+                      jobs=1, io_threads=1, cache=True, memory_budget=None,
+                      reproducible=False, rebuild=False, shared=None,
+                      bundler=None):
+    """Create several variants of the build for a platform in one go.
+
+    Each variant is a dictionary, which can give outFile, buildNum,
+    releaseBuild and keyFile as for createBuild(). The source files are only
+    read once, variants with the same version (e.g. a signed and an unsigned
+    release build) share all files, and the packages are written in
+    parallel.
+    """
+    metadata = readMetadata(baseDir, type)
+    if shared is None and len(variants) > 1:
+        shared = SharedBuildState(baseDir, cache)
+        for variant in variants:
+            shared.add_build(type, variant.get('releaseBuild', False),
+                             variant.get('buildNum'), devenv)
+    index = get_build_index(baseDir, cache, shared)
+    # All variants are written at the same time, so they share their jobs.
+    budget = JobBudget(jobs)
+
+    builds = collections.OrderedDict()
+    for variant in variants:
+        keyFile = variant.get('keyFile')
+        params = get_build_params(baseDir, type, metadata,
+                                  variant.get('releaseBuild', False),
+                                  variant.get('buildNum'), devenv, jobs,
+                                  io_threads, cache, reproducible, shared,
+                                  bundler)
+        params['job_budget'] = budget
+
+        outFile = variant.get('outFile')
+        if outFile == None:
+            file_extension = get_extension(type, keyFile is not None)
+            outFile = getDefaultFileName(metadata, params['version'],
+                                         file_extension)
+
+        fingerprint = None
+        if use_build_cache(params, outFile, keyFile):
+            # Only the names and stats of the source files are read here,
+            # their content is hashed through the index.
+            files = read_build_files(params, index, shared)[0]
+            fingerprint = get_build_fingerprint(params, files, index, keyFile)
+            if not rebuild and restore_build(baseDir, fingerprint, outFile,
+                                             index):
+                logging.info('Nothing changed, used cached build %s',
+                             fingerprint)
+                continue
+
+        # Variants only differing in their output file and signing key
+        # end up with the same files.
+        key = (params['releaseBuild'], params['version'])
+        build = builds.setdefault(key, (params, []))
+        build[1].append((outFile, keyFile, fingerprint))
 
-    zipdata = files.zipToString()
-    signature = None
-    pubkey = None
-    if keyFile != None:
-        signature = signBinary(zipdata, keyFile)
-        pubkey = getPublicKey(keyFile)
-    writePackage(outFile, pubkey, signature, zipdata)
+    packages = []
+    try:
+        for params, outputs in builds.itervalues():
+            result = _create_result(params, index, shared, memory_budget)
+            for outFile, keyFile, fingerprint in outputs:
+                packages.append((BuildResult(params, result.files,
+                                             result.stats, keyFile,
+                                             result.dependencies,
+                                             result.globs),
+                                 outFile, fingerprint))
+
+        def write(package):
+            result, outFile, fingerprint = package
+            # Each package being written holds a job, and compresses its
+            # files using the jobs left over.
+            budget.acquire()
+            try:
+                summary = result.write(outFile)
+            finally:
+                budget.release()
+            logging.info('Compression summary:\n%s', summary.format())
+            if fingerprint:
+                store_build(baseDir, fingerprint, outFile,
+                            result.dependencies, result.globs)
+
+        if len(packages) > 1 and jobs > 1:
+            pool = ThreadPool(min(len(packages), jobs))
+            try:
+                pool.map(write, packages)
+            finally:
+                pool.terminate()
+        else:
+            map(write, packages)
+    finally:
+        for result, _, _ in packages:
+            result.close()
+
+    if index:
+        index.save()
+
+
+def createBuilds(baseDir, types, outFile=None, buildNum=None,
+                 releaseBuild=False, devenv=False, cache=True, **kwargs):
+    """Build the extension for several platforms in one go.
+
+    Work which doesn't depend on the platform, like reading the source files
+    and running webpack, is only done once. Any further keyword arguments are
+    passed on to the createBuild() function of each platform.
+    """
+    import packagerEdge
+
+    types = sorted(set(types), key=types.index)
+    if outFile and len(types) > 1:
+        raise ValueError('A single output file was given for several '
+                         'platforms')
+    if kwargs.get('reproducible') and 'edge' in types and not devenv:
+        raise ValueError(packagerEdge.REPRODUCIBLE_ERROR)
+
+    shared = None
+    if len(types) > 1:
+        shared = SharedBuildState(baseDir, cache)
+        for type in types:
+            shared.add_build(type, releaseBuild, buildNum, devenv)
+
+    for type in types:
+        module = packagerEdge if type == 'edge' else sys.modules[__name__]
+        module.createBuild(baseDir, type=type, outFile=outFile,
+                           buildNum=buildNum, releaseBuild=releaseBuild,
+                           devenv=devenv, cache=cache, shared=shared,
+                           **kwargs)
+    if shared and shared.index:
+        shared.index.save()
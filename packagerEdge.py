@@ -6,20 +6,25 @@ import os
 import shutil
 import json
 import re
-from StringIO import StringIO
 from glob import glob
 import subprocess
 import tempfile
+import time
 from xml.etree import ElementTree
-from zipfile import ZipFile
 import ConfigParser
+import logging
 
 import packager
 import packagerChrome
+from stages import StageRunner, get_stage_cache
 
 MANIFEST = 'appxmanifest.xml'
 ASSETS_DIR = 'Assets'
 
+# manifoldjs timestamps the files it packages with their modification time,
+# and adds further metadata which differs for each build.
+REPRODUCIBLE_ERROR = 'Reproducible builds are not supported for Edge'
+
 defaultLocale = packagerChrome.defaultLocale
 
 
@@ -131,45 +136,7 @@ def update_appx_manifest(manifest_path, base_dir, files, metadata,
     tree.write(manifest_path, encoding='utf-8', xml_declaration=True)
 
 
-def createBuild(baseDir, type='edge', outFile=None,  # noqa: preserve API.
-                buildNum=None, releaseBuild=False, keyFile=None,
-                devenv=False):
-
-    metadata = packager.readMetadata(baseDir, type)
-    version = packager.getBuildVersion(baseDir, metadata, releaseBuild,
-                                       buildNum)
-
-    outfile = outFile or packager.getDefaultFileName(metadata, version, 'appx')
-
-    params = {
-        'type': type,
-        'baseDir': baseDir,
-        'releaseBuild': releaseBuild,
-        'version': version,
-        'devenv': devenv,
-        'metadata': metadata,
-    }
-
-    files = packager.Files(packagerChrome.getPackageFiles(params),
-                           packagerChrome.getIgnoredFiles(params))
-
-    if metadata.has_section('mapping'):
-        mapped = metadata.items('mapping')
-        files.readMappedFiles(mapped)
-        files.read(baseDir, skip=[filename for filename, _ in mapped])
-    else:
-        files.read(baseDir)
-
-    if metadata.has_section('bundles'):
-        bundle_tests = devenv and metadata.has_option('general', 'testScripts')
-        packagerChrome.create_bundles(params, files, bundle_tests)
-
-    if metadata.has_section('preprocess'):
-        files.preprocess(metadata.options('preprocess'), {'needsExt': True})
-
-    if metadata.has_section('import_locales'):
-        packagerChrome.import_locales(params, files)
-
+def add_manifest(params, files):
     # The Windows Store will reject the build unless every translation of the
     # product name has been reserved. This is hard till impossible to manage
     # with community translations, so we don't translate the product name for
@@ -182,16 +149,104 @@ def createBuild(baseDir, type='edge', outFile=None,  # noqa: preserve API.
         packagerChrome.createManifest(params, files),
     )
 
-    if devenv:
+
+def _create_result(params, index, shared, memory_budget):
+    base_dir = params['baseDir']
+    metadata = params['metadata']
+    files, stats = packagerChrome.read_build_files(params, index, shared,
+                                                   memory_budget)
+
+    stages = StageRunner(params, files, get_stage_cache(base_dir)
+                         if params['cache'] else None, index)
+
+    if metadata.has_section('bundles'):
+        bundle_tests = (params['devenv'] and
+                        metadata.has_option('general', 'testScripts'))
+        stages.add('bundles', packagerChrome.create_bundles, (bundle_tests,))
+
+    if metadata.has_section('preprocess'):
+        stages.add('preprocess', packagerChrome.preprocess_files,
+                   (metadata.options('preprocess'),))
+
+    if metadata.has_section('import_locales'):
+        stages.add('import_locales', packagerChrome.import_locales)
+
+    stages.add('manifest', add_manifest, after=('import_locales',))
+    stages.run_all(params['jobs'])
+    stats.update(stages.stats)
+
+    if params['devenv']:
+        start = time.time()
         packagerChrome.add_devenv_requirements(files, metadata, params)
+        stats['devenv'] = (time.time() - start, 0)
+    return packagerChrome.BuildResult(params, files, stats,
+                                      dependencies=stages.dependencies,
+                                      globs=stages.globs)
+
+
+def create_build_result(baseDir, type='edge',  # noqa: API of createBuild.
+                        buildNum=None, releaseBuild=False, keyFile=None,
+                        devenv=False, jobs=1, io_threads=1, cache=True,
+                        memory_budget=None, reproducible=False, shared=None,
+                        bundler=None):
+    """Run a build, without packaging it.
+
+    Takes the same arguments as createBuild(), and returns a
+    packagerChrome.BuildResult.
+    """
+    metadata = packager.readMetadata(baseDir, type)
+    params = packagerChrome.get_build_params(
+        baseDir, type, metadata, releaseBuild, buildNum, devenv, jobs,
+        io_threads, cache, reproducible, shared, bundler,
+    )
+    index = packagerChrome.get_build_index(baseDir, cache, shared)
+    result = _create_result(params, index, shared, memory_budget)
+    if index:
+        index.save()
+    return result
 
-    zipped = StringIO()
-    files.zip(zipped)
 
-    zipped.seek(0)
+def createBuild(baseDir, type='edge', outFile=None,  # noqa: preserve API.
+                buildNum=None, releaseBuild=False, keyFile=None,
+                devenv=False, jobs=1, io_threads=1, cache=True,
+                memory_budget=None, reproducible=False, rebuild=False,
+                shared=None, bundler=None):
+    if reproducible and not devenv:
+        raise ValueError(REPRODUCIBLE_ERROR)
 
+    metadata = packager.readMetadata(baseDir, type)
+    params = packagerChrome.get_build_params(
+        baseDir, type, metadata, releaseBuild, buildNum, devenv, jobs,
+        io_threads, cache, reproducible, shared, bundler,
+    )
+    outfile = outFile or packager.getDefaultFileName(metadata,
+                                                     params['version'], 'appx')
+
+    index = packagerChrome.get_build_index(baseDir, cache, shared)
+    fingerprint = None
+    if packager.use_build_cache(params, outfile):
+        files = packagerChrome.read_build_files(params, index, shared)[0]
+        fingerprint = packager.get_build_fingerprint(params, files, index)
+        if not rebuild and packager.restore_build(baseDir, fingerprint,
+                                                  outfile, index):
+            logging.info('Nothing changed, used cached build %s', fingerprint)
+            index.save()
+            return
+
+    result = _create_result(params, index, shared, memory_budget)
+    files = result.files
+    if index:
+        index.save()
+
+    # Development environments are zipped directly into the output file,
+    # otherwise the files are written into a directory for manifoldjs to
+    # package them.
     if devenv:
-        shutil.copyfileobj(zipped, outfile)
+        try:
+            summary = result.write(outfile)
+            logging.info('Compression summary:\n%s', summary.format())
+        finally:
+            result.close()
         return
 
     tmp_dir = tempfile.mkdtemp('adblockplus_package')
@@ -199,8 +254,7 @@ def createBuild(baseDir, type='edge', outFile=None,  # noqa: preserve API.
         src_dir = os.path.join(tmp_dir, 'src')
         ext_dir = os.path.join(tmp_dir, 'ext')
 
-        with ZipFile(zipped, 'r') as zip_file:
-            zip_file.extractall(src_dir)
+        files.write_to_directory(src_dir)
 
         cmd_env = os.environ.copy()
         cmd_env['SRC_FOLDER'] = src_dir
@@ -237,5 +291,9 @@ def createBuild(baseDir, type='edge', outFile=None,  # noqa: preserve API.
                                'edgeExtension.appx')
 
         shutil.copyfile(package, outfile)
+        if fingerprint:
+            packager.store_build(baseDir, fingerprint, outfile,
+                                 result.dependencies, result.globs)
     finally:
         shutil.rmtree(tmp_dir, ignore_errors=True)
+        files.close()
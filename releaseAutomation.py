@@ -193,26 +193,46 @@ def update_metadata(metadata, version):
         fp.truncate()
 
 
-def create_build(platform, base_dir, target_path, version, key_file=None):
-    """Create a build for the target platform and version."""
-    if platform == 'edge':
-        import buildtools.packagerEdge as packager
-    else:
-        import buildtools.packagerChrome as packager
+def create_build(platform, base_dir, target_path, version, key_file=None,
+                 shared=None):
+    """Create a build for the target platform and version.
+
+    If given, shared is the packagerChrome.SharedBuildState of the release.
+    """
+    return create_builds(platform, base_dir, [(target_path, key_file)],
+                         version, shared)[0]
+
+
+def create_builds(platform, base_dir, targets, version, shared=None):
+    """Create builds for the target platform and version in one go.
 
+    targets is a list of (target_path, key_file) tuples, with key_file
+    being None for unsigned builds. Returns the paths of the builds.
+    """
     metadata = readMetadata(base_dir, platform)
     update_metadata(metadata, version)
 
-    build_path = os.path.join(
-        target_path,
-        getDefaultFileName(metadata, version,
-                           get_extension(platform, key_file is not None)),
-    )
+    variants = []
+    for target_path, key_file in targets:
+        build_path = os.path.join(
+            target_path,
+            getDefaultFileName(metadata, version,
+                               get_extension(platform, key_file is not None)),
+        )
+        variants.append({'outFile': build_path, 'releaseBuild': True,
+                         'keyFile': key_file})
 
-    packager.createBuild(base_dir, type=platform, outFile=build_path,
-                         releaseBuild=True, keyFile=key_file)
+    if platform == 'edge':
+        import buildtools.packagerEdge as packager
+        for variant in variants:
+            packager.createBuild(base_dir, type=platform, shared=shared,
+                                 cache=False, **variant)
+    else:
+        import buildtools.packagerChrome as packager
+        packager.createBuildMatrix(base_dir, platform, variants,
+                                   shared=shared, cache=False)
 
-    return build_path
+    return [variant['outFile'] for variant in variants]
 
 
 def release_commit(base_dir, extension_name, version, platforms):
@@ -259,19 +279,32 @@ def run(baseDir, platforms, version, keyFile, downloads_repo):
     with open(default_locale_path, 'r') as fp:
         extension_name = json.load(fp)['name']['message']
 
+    # The builds for all platforms share their source files and bundles, so
+    # the metadata must have the new version number before any of them starts.
+    import buildtools.packagerChrome as packagerChrome
+    # Release builds never use the build cache, so that nothing left over
+    # from previous builds can end up in them.
+    shared = packagerChrome.SharedBuildState(baseDir, cache=False)
+    for platform in target_platforms:
+        update_metadata(readMetadata(baseDir, platform), version)
+        shared.add_build(platform, releaseBuild=True)
+
     for platform in target_platforms:
-        used_key_file = None
         if platform == 'chrome':
             # Currently, only chrome builds are provided by us as signed
             # packages. Create an unsigned package in base_dir which should be
-            # uploaded to the Chrome Web Store
-            create_build(platform, baseDir, baseDir, version)
-            used_key_file = keyFile
-
-        downloads.append(
-            create_build(platform, baseDir, downloads_repo, version,
-                         used_key_file),
-        )
+            # uploaded to the Chrome Web Store. Both are created in one go.
+            downloads.append(create_builds(
+                platform, baseDir, [(downloads_repo, keyFile), (baseDir, None)],
+                version, shared,
+            )[0])
+        else:
+            downloads.append(
+                create_build(platform, baseDir, downloads_repo, version,
+                             shared=shared),
+            )
+    if shared.index:
+        shared.index.save()
 
     # Only create one commit, one tag and one source archive for all
     # platforms
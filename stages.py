@@ -0,0 +1,435 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+# Note: Build stages are functions taking the build parameters and the Files
+# of the build, which they update. While a stage runs, everything it reads is
+# recorded, so that as long as none of that changes, its result can be
+# replayed rather than running it again.
+
+import glob
+import hashlib
+import json
+import logging
+import os
+import Queue
+import sys
+import threading
+import time
+from collections import Mapping, OrderedDict
+
+from buildcache import (ContentCache, get_cache_path, get_code_files,
+                        get_path_hash)
+from packager import FileEntry, JobBudget, SpilledEntry
+
+import buildtools
+
+STAGE_CACHE_SIZE = 256 * 1024 * 1024
+
+_local = threading.local()
+
+
+def get_stage_cache(base_dir):
+    return ContentCache(get_cache_path(base_dir, 'stages'), STAGE_CACHE_SIZE)
+
+
+def get_recorder():
+    """Get the StageRecorder of the stage running on this thread, if any."""
+    return getattr(_local, 'recorder', None)
+
+
+def record_file(path):
+    """Record that the running stage depends on a file outside of Files.
+
+    The file doesn't need to exist, in which case the stage runs again once
+    it has been created.
+    """
+    recorder = get_recorder()
+    if recorder:
+        recorder.add_path(path)
+
+
+def glob_files(pattern):
+    """Like glob.glob(), but the running stage depends on the result."""
+    paths = glob.glob(pattern)
+    recorder = get_recorder()
+    if recorder:
+        recorder.add_glob(pattern, paths)
+    return paths
+
+
+def _digest(value):
+    return hashlib.sha1(json.dumps(value, sort_keys=True,
+                                   default=repr)).hexdigest()
+
+
+def _get_section_digest(metadata, section):
+    if section is None:
+        return _digest([_get_section_digest(metadata, name)
+                        for name in sorted(metadata.sections())])
+    if not metadata.has_section(section):
+        return None
+    return _digest(sorted((item[0], item[1], item.source)
+                          for item in metadata.items(section, raw=True)))
+
+
+def _get_code_digest():
+    # The stages as well as the templates they use are part of buildtools,
+    # so whenever anything in buildtools changes, all stages run again.
+    if _get_code_digest._result is None:
+        base_dir = buildtools.__path__[0]
+        _get_code_digest._result = _digest([
+            (os.path.relpath(path, base_dir), get_path_hash(path))
+            for path in get_code_files()
+        ])
+    return _get_code_digest._result
+
+
+_get_code_digest._result = None
+
+
+class _RecordingMetadata(object):
+    """Wraps the metadata, recording which sections are used."""
+
+    # These methods of ChainedConfigParser take the section as first argument,
+    # all others are assumed to depend on the metadata as a whole.
+    SECTION_METHODS = {'get', 'getint', 'getfloat', 'getboolean', 'items',
+                       'options', 'has_option', 'has_section',
+                       'option_source', 'serialize_section_if_present'}
+
+    def __init__(self, metadata, recorder):
+        self._metadata = metadata
+        self._recorder = recorder
+
+    def __getattr__(self, name):
+        attr = getattr(self._metadata, name)
+        if not callable(attr):
+            return attr
+
+        recorder = self._recorder
+        if name in self.SECTION_METHODS:
+            def method(section, *args, **kwargs):
+                recorder.add_section(section)
+                return attr(section, *args, **kwargs)
+        else:
+            def method(*args, **kwargs):
+                recorder.add_section(None)
+                return attr(*args, **kwargs)
+        return method
+
+
+class _RecordingParams(Mapping):
+    """Wraps the build parameters, recording which of them are used."""
+
+    # Parameters which are helpers for the stages rather than settings
+    # affecting their results.
+    UNTRACKED = {'shared_bundler', 'cache', 'jobs', 'job_budget',
+                 'io_threads'}
+
+    def __init__(self, params, recorder):
+        self._params = params
+        self._recorder = recorder
+        self._metadata = _RecordingMetadata(params['metadata'], recorder)
+
+    def __getitem__(self, key):
+        if key == 'metadata':
+            return self._metadata
+        if key not in self.UNTRACKED:
+            self._recorder.add_param(key, self._params.get(key))
+        return self._params[key]
+
+    def __iter__(self):
+        return iter(self._params)
+
+    def __len__(self):
+        return len(self._params)
+
+
+class StageRecorder(object):
+    """Keeps track of everything a build stage reads."""
+
+    def __init__(self, metadata, index=None):
+        self.metadata = metadata
+        self.index = index
+        self.entries = {}
+        self.listing = False
+        self.paths = {}
+        self.globs = {}
+        self.sections = {}
+        self.params = {}
+        self._outputs = set()
+
+    def add_entry(self, files, key):
+        # Only the content files had before the stage ran is relevant, not
+        # whatever the stage did with them.
+        if key not in self.entries and key not in self._outputs:
+            self.entries[key] = files.get_file_hash(key)
+
+    def add_output(self, key):
+        self._outputs.add(key)
+
+    def add_listing(self):
+        self.listing = True
+
+    def add_path(self, path):
+        if path not in self.paths:
+            self.paths[path] = get_path_hash(path, self.index)
+
+    def add_glob(self, pattern, paths):
+        self.globs[pattern] = sorted(paths)
+
+    def add_section(self, section):
+        if section not in self.sections:
+            self.sections[section] = _get_section_digest(self.metadata,
+                                                         section)
+
+    def add_param(self, key, value):
+        self.params[key] = _digest(value)
+
+
+class _Stage(object):
+    def __init__(self, name, func, args, after):
+        self.name = name
+        self.func = func
+        self.args = args
+        self.after = after
+        self.result = None
+        self.error = None
+        self.time = None
+
+
+class StageRunner(object):
+    """Runs the stages of a build, replaying their results if possible.
+
+    For each stage, the inputs recorded the last time it ran are stored in
+    cache (a buildcache.ContentCache), along with its results. If all of these
+    inputs are still the same, the results are applied to files rather than
+    running the stage again. If files has a process hook, stages always run,
+    as there is no telling whether the hook would give the same results.
+
+    Stages which don't depend on each other might run at the same time, each
+    on its own copy of files. Their results are applied to files in the order
+    the stages were added, so that the outcome is the same as if they ran one
+    after another. A stage which accessed files that an earlier stage changed
+    in the meantime runs again.
+
+    After running the stages, stats maps the name of each stage to the
+    seconds it took and the number of bytes it wrote. dependencies maps the
+    files outside of files which they depend on (e.g. those webpack bundled)
+    to their hashes, and globs maps the patterns they listed files with to
+    the paths found.
+    """
+
+    VERSION = 1
+
+    def __init__(self, params, files, cache=None, index=None):
+        self.params = params
+        self.files = files
+        self.cache = cache
+        self.index = index
+        self.stats = OrderedDict()
+        self.dependencies = {}
+        self.globs = {}
+        self._stages = []
+
+    def add(self, name, func, args=(), after=()):
+        """Add a stage called name, which runs func(params, files, *args).
+
+        The stage doesn't run before the stages listed in after have run and
+        their results have been applied. Stages which haven't been added
+        before are ignored there.
+        """
+        added = {stage.name for stage in self._stages}
+        after = [dependency for dependency in after if dependency in added]
+        self._stages.append(_Stage(name, func, args, after))
+
+    def run_all(self, jobs=1):
+        """Run all stages added, up to jobs of them at the same time.
+
+        Returns the names of the stages which ran, rather than being replayed.
+        """
+        stages, self._stages = self._stages, []
+        if jobs <= 1:
+            ran = []
+            for stage in stages:
+                start = time.time()
+                inputs, changes, has_run = self._run(self.files, stage)
+                self._add_stats(stage, start, inputs, changes)
+                if has_run:
+                    ran.append(stage.name)
+            return ran
+
+        # Each running stage holds a job of the budget, leaving the others
+        # to the processes which stages start.
+        budget = self.params.get('job_budget') or JobBudget(jobs)
+        applied = set()
+        ran = []
+        pending = list(stages)
+        running = 0
+        finished = Queue.Queue()
+
+        def run_stage(stage, files):
+            budget.acquire()
+            start = time.time()
+            try:
+                stage.result = self._run(files, stage)
+            except BaseException:
+                stage.error = sys.exc_info()
+            finally:
+                files.close()
+                budget.release()
+            stage.time = time.time() - start
+            finished.put(stage)
+
+        while stages:
+            for stage in list(pending):
+                if running >= jobs:
+                    break
+                if all(name in applied for name in stage.after):
+                    pending.remove(stage)
+                    running += 1
+                    thread = threading.Thread(
+                        target=run_stage, args=(stage, self.files.fork()),
+                    )
+                    thread.daemon = True
+                    thread.start()
+
+            stage = finished.get()
+            running -= 1
+            if stage.error:
+                raise stage.error[0], stage.error[1], stage.error[2]
+
+            while stages and stages[0].result:
+                stage = stages.pop(0)
+
+                inputs, changes, has_run = stage.result
+                start = time.time() - stage.time
+                if self._files_unchanged(inputs, self.files):
+                    self.files.apply_changes(changes)
+                else:
+                    budget.acquire()
+                    try:
+                        inputs, changes, has_run = self._run(self.files,
+                                                             stage)
+                    finally:
+                        budget.release()
+                self._add_stats(stage, start, inputs, changes)
+                if has_run:
+                    ran.append(stage.name)
+                applied.add(stage.name)
+
+        return ran
+
+    def _add_stats(self, stage, start, inputs, changes):
+        size = sum(self.files.get_file_size(key) or 0 for key in changes)
+        self.stats[stage.name] = (time.time() - start, size)
+        self.dependencies.update(inputs['paths'])
+        self.globs.update(inputs['globs'])
+
+    def _run(self, files, stage):
+        # Runs the stage on files, returning the inputs it recorded, the
+        # changes it made, and whether it actually ran.
+        use_cache = self.cache is not None and not files.process
+        key = _digest([self.VERSION, _get_code_digest(), self.params['type'],
+                       stage.name, stage.args])
+        if use_cache:
+            record = self.cache.get(key)
+            if record is not None:
+                record = json.loads(record)
+                changes = None
+                if self._is_current(record['inputs'], files):
+                    changes = self._load_outputs(record['outputs'])
+                if changes is not None:
+                    logging.info('Using result of %s from previous build',
+                                 stage.name)
+                    files.apply_changes(changes)
+                    return record['inputs'], changes, False
+
+        recorder = StageRecorder(self.params['metadata'], self.index)
+        before = dict.copy(files)
+        names = _digest(sorted(before))
+
+        _local.recorder = files.recorder = recorder
+        try:
+            stage.func(_RecordingParams(self.params, recorder), files,
+                       *stage.args)
+        finally:
+            _local.recorder = files.recorder = None
+
+        inputs = {
+            'entries': recorder.entries,
+            'names': names if recorder.listing else None,
+            'paths': recorder.paths,
+            'globs': recorder.globs,
+            'sections': [[section, digest] for section, digest
+                         in recorder.sections.iteritems()],
+            'params': recorder.params,
+        }
+        changes = files.get_changes(before)
+        if use_cache:
+            record = {'inputs': inputs,
+                      'outputs': self._store_outputs(changes)}
+            self.cache.set(key, json.dumps(record), replace=True)
+        return inputs, changes, True
+
+    def _files_unchanged(self, inputs, files):
+        return (
+            (inputs['names'] is None or
+             _digest(sorted(dict.iterkeys(files))) == inputs['names']) and
+            all(files.get_file_hash(key) == digest
+                for key, digest in inputs['entries'].iteritems())
+        )
+
+    def _is_current(self, inputs, files):
+        metadata = self.params['metadata']
+        return (
+            all(_digest(self.params.get(key)) == digest
+                for key, digest in inputs['params'].iteritems()) and
+            all(_get_section_digest(metadata, section) == digest
+                for section, digest in inputs['sections']) and
+            self._files_unchanged(inputs, files) and
+            all(get_path_hash(path, self.index) == digest
+                for path, digest in inputs['paths'].iteritems()) and
+            all(sorted(glob.glob(pattern)) == paths
+                for pattern, paths in inputs['globs'].iteritems())
+        )
+
+    def _store_outputs(self, changes):
+        outputs = {}
+        for key, value in changes.iteritems():
+            if value is None:
+                outputs[key] = None
+                continue
+
+            if isinstance(value, SpilledEntry):
+                data, encoding = value.read(), value.encoding
+            elif isinstance(value, FileEntry):
+                outputs[key] = ['file', value.path]
+                continue
+            elif isinstance(value, unicode):
+                data, encoding = value.encode('utf-8'), 'utf-8'
+            else:
+                data, encoding = value, None
+
+            data_key = hashlib.sha1(data).hexdigest()
+            self.cache.set(data_key, data)
+            outputs[key] = ['data', data_key, encoding]
+        return outputs
+
+    def _load_outputs(self, outputs):
+        changes = {}
+        for key, output in outputs.iteritems():
+            if output is None:
+                changes[key] = None
+            elif output[0] == 'file':
+                if not os.path.isfile(output[1]):
+                    return None
+                changes[key] = FileEntry(output[1], index=self.index)
+            else:
+                _, data_key, encoding = output
+                data = self.cache.get(data_key)
+                if data is None:
+                    # Evicted from the cache
+                    return None
+                changes[key] = data.decode(encoding) if encoding else data
+        return changes
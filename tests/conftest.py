@@ -0,0 +1,13 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import pytest
+
+
+@pytest.fixture(autouse=True)
+def cache_dir(tmpdir_factory, monkeypatch):
+    """Keep the build cache of each test apart from the user's."""
+    path = tmpdir_factory.mktemp('cache')
+    monkeypatch.setenv('BUILDTOOLS_CACHE_DIR', str(path))
+    return path
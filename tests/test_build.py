@@ -0,0 +1,78 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import json
+import subprocess
+import sys
+
+# Time in seconds, importing build.py and parsing the command line may take at
+# most. It takes about 20ms on a developer machine, the budget leaves room for
+# slow CI runners.
+STARTUP_BUDGET = 0.2
+
+# Modules which only some commands need, and which must therefore not be
+# imported before the command runs.
+LAZY_MODULES = [
+    'buildtools.buildcache',
+    'buildtools.daemon',
+    'buildtools.localeTools',
+    'buildtools.packager',
+    'buildtools.packagerChrome',
+    'json',
+    'mimetypes',
+    'shutil',
+    'urllib2',
+    'zipfile',
+]
+
+
+def run_python(code, *args):
+    # Every run needs a fresh interpreter, as modules and the command line
+    # parser are only set up once per process.
+    output = subprocess.check_output([sys.executable, '-c', code] +
+                                     list(args))
+    return json.loads(output)
+
+
+def test_startup(tmpdir):
+    tmpdir.join('metadata.chrome').write('[general]\nbasename = test\n')
+    # Commands which aren't forwarded to the build daemon (see daemon.py)
+    # should start as quickly as possible. The command itself is replaced,
+    # so that everything up to running it is measured.
+    code = ('import sys, time\n'
+            'start = time.time()\n'
+            'from buildtools import build\n'
+            'parse_args = build.MAIN_PARSER.parse_args\n'
+            'def dispatch(args):\n'
+            '    arguments = parse_args(args)\n'
+            '    arguments.function = lambda **kwargs: None\n'
+            '    return arguments\n'
+            'build.MAIN_PARSER.parse_args = dispatch\n'
+            'build.process_args(sys.argv[1], "lint-gitlab-ci")\n'
+            'elapsed = time.time() - start\n'
+            'modules = sorted(sys.modules)\n'
+            'import json\n'
+            'print(json.dumps([elapsed, modules]))\n')
+    elapsed, modules = min(run_python(code, str(tmpdir)) for i in range(3))
+
+    assert set(LAZY_MODULES).isdisjoint(modules)
+    assert elapsed < STARTUP_BUDGET
+
+
+def test_lazy_subcommands(tmpdir):
+    tmpdir.join('metadata.chrome').write('[general]\nbasename = test\n')
+    tmpdir.join('metadata.gecko').write('[general]\nbasename = test\n')
+    code = ('import json, sys\n'
+            'from buildtools import build\n'
+            'result = []\n'
+            'for command in sys.argv[2:]:\n'
+            '    build.build_available_subcommands(sys.argv[1], command)\n'
+            '    result.append(sorted(build.SUB_PARSERS.choices))\n'
+            'print(json.dumps(result))\n')
+    result = run_python(code, str(tmpdir), 'devenv', 'build', 'bogus')
+
+    assert result[0] == ['devenv']
+    assert result[1] == ['build', 'devenv']
+    assert 'build-matrix' in result[2]
+    assert 'lint-gitlab-ci' in result[2]
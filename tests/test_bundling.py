@@ -0,0 +1,163 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import subprocess
+import sys
+
+import pytest
+
+from buildtools import bundling
+from buildtools.buildcache import ContentCache
+
+# Speaks the protocol of webpack_runner.js, sending a bundle for each name
+# requested, with its process ID as content.
+FAKE_WORKER = '''
+import os, sys
+from buildtools import bundling
+
+while True:
+    request = bundling.read_message(sys.stdin)
+    if request is None:
+        break
+    for name in request.get('bundles', []):
+        bundling.write_message(sys.stdout, {'bundle': name, 'included': [],
+                                            'dependencies': [], 'time': 0})
+        bundling.write_frame(sys.stdout, str(os.getpid()))
+    if request.get('abort'):
+        os._exit(1)
+    if request.get('crash') and os.path.exists(request['crash']):
+        # Crash only once
+        os.remove(request['crash'])
+        os._exit(1)
+    if request.get('fail'):
+        bundling.write_message(sys.stdout, {'error': 'Module not found'})
+    else:
+        bundling.write_message(sys.stdout, {'done': True})
+'''
+
+
+@pytest.fixture
+def worker():
+    worker = bundling.WebpackWorker([sys.executable, '-c', FAKE_WORKER])
+    yield worker
+    worker.close()
+
+
+def get_pid(worker, **request):
+    return worker.run(dict(request, bundles=['main.js']))['main.js']['content']
+
+
+def test_worker_is_reused(worker):
+    pid = get_pid(worker)
+    assert get_pid(worker) == pid
+
+    worker.close()
+    assert get_pid(worker) != pid
+
+
+def test_worker_restarts_for_environment(worker, tmpdir, monkeypatch):
+    pid = get_pid(worker)
+    monkeypatch.setenv('NODE_PATH', str(tmpdir))
+    assert get_pid(worker) != pid
+
+    pid = get_pid(worker)
+    monkeypatch.chdir(tmpdir)
+    assert get_pid(worker) != pid
+
+    pid = get_pid(worker)
+    assert get_pid(worker) == pid
+
+
+def test_worker_recovers(worker, tmpdir):
+    pid = get_pid(worker)
+    marker = tmpdir.join('crash')
+    marker.write('')
+
+    # Bundles received before the crash aren't passed on again.
+    bundles = list(worker.iter_bundles({'bundles': ['a.js', 'b.js'],
+                                        'crash': str(marker)}))
+    assert [name for name, bundle in bundles] == ['a.js', 'b.js']
+    assert bundles[0][1]['content'] == pid
+    assert bundles[1][1]['content'] == pid
+    assert get_pid(worker) != pid
+    assert not marker.check()
+
+    with pytest.raises(subprocess.CalledProcessError):
+        get_pid(worker, abort=True)
+
+
+def test_worker_interrupted(worker):
+    pid = get_pid(worker)
+    bundles = worker.iter_bundles({'bundles': ['a.js', 'b.js']})
+    assert next(bundles)[0] == 'a.js'
+    bundles.close()
+
+    # The rest of the response mustn't be mistaken for the next one.
+    assert worker.run({'bundles': ['c.js']}).keys() == ['c.js']
+    assert get_pid(worker) != pid
+
+
+def test_worker_error(worker):
+    pid = get_pid(worker)
+    with pytest.raises(Exception) as excinfo:
+        get_pid(worker, fail=True)
+    assert 'Module not found' in str(excinfo.value)
+
+    # Errors creating bundles don't affect the worker
+    assert get_pid(worker) == pid
+
+
+def test_iter_concurrently():
+    def fail():
+        yield 3
+        raise ValueError()
+
+    items = bundling.iter_concurrently([iter([1, 2]), iter([])])
+    assert sorted(items) == [1, 2]
+    items = bundling.iter_concurrently([iter([1, 2]), fail()])
+    with pytest.raises(ValueError):
+        list(items)
+
+
+@pytest.mark.parametrize('change,valid', [
+    (lambda src: None, True),
+    (lambda src: src.join('lib', 'a.js').write('var c;'), False),
+    (lambda src: src.join('lib', 'new.js').write(''), False),
+    (lambda src: src.join('other', 'missing.js').write(''), False),
+    (lambda src: src.join('unrelated.js').write(''), True),
+])
+def test_bundle_cache(tmpdir, change, valid):
+    src = tmpdir.join('src')
+    src.join('lib', 'a.js').write('var a;', ensure=True)
+    src.join('lib', 'b.js').write('var b;')
+    src.join('other').ensure(dir=True)
+    cache = bundling.BundleCache(ContentCache(str(tmpdir.join('cache')),
+                                              1024 * 1024))
+    bundle = {
+        'bundle_name': 'lib/main.js', 'entry_points': ['./lib/a.js'],
+        'info_module': 'info', 'resolve_paths': [str(src.join('lib'))],
+        'aliases': {},
+    }
+    output = {
+        'content': 'var a; var b;', 'included': ['lib/a.js', 'lib/b.js'],
+        'dependencies': [str(src.join('lib', 'a.js')),
+                         str(src.join('lib', 'b.js')),
+                         str(src.join('other', 'missing.js'))],
+    }
+    cache.set(str(src), bundle, output)
+    change(src)
+
+    assert (cache.get(str(src), bundle) == output) == valid
+    assert cache.get(str(src), dict(bundle, info_module='other')) is None
+
+
+@pytest.mark.parametrize('times,count,groups', [
+    ([], 4, []),
+    ([1, 1, 1], 1, [[0, 1, 2]]),
+    ([None, None, None, None], 2, [[0, 2], [1, 3]]),
+    ([5, 1, 1, 3, 2], 2, [[0, 1], [2, 3, 4]]),
+    ([3, None, 1], 2, [[0], [1, 2]]),
+])
+def test_balance(times, count, groups):
+    assert bundling.balance(times, count) == groups
@@ -0,0 +1,106 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import json
+import subprocess
+from distutils.spawn import find_executable
+
+import pytest
+
+from buildtools import commonjs
+
+
+@pytest.fixture
+def srcdir(tmpdir):
+    tmpdir.join('lib', 'main.js').write(
+        '// require("commented")\n'
+        'var a = require("./a");\n'
+        'var info = require("info");\n'
+        'var thing = require("core_thing");\n'
+        'var data = require("data.json");\n'
+        'console.log(a.name, a.b, info.version, thing, data.answer,\n'
+        '            "require(\'nothing\')");\n',
+        ensure=True,
+    )
+    tmpdir.join('lib', 'a.js').write('exports.name = "a";\n'
+                                     'exports.b = require("./b");')
+    tmpdir.join('lib', 'b.js').write('module.exports = require("./a").name;')
+    tmpdir.join('lib', 'data.json').write('{"answer": 42}')
+    tmpdir.join('core', 'lib', 'core', 'thing.js').write(
+        'module.exports = "thing";', ensure=True,
+    )
+    tmpdir.join('node_modules', 'pkg', 'package.json').write(
+        json.dumps({'main': 'src/main.js'}), ensure=True,
+    )
+    tmpdir.join('node_modules', 'pkg', 'src', 'main.js').write(
+        'module.exports = "pkg";', ensure=True,
+    )
+    tmpdir.join('node_modules', 'other', 'index.js').write('', ensure=True)
+    return tmpdir
+
+
+def get_bundle(srcdir, entry_points=('lib/main.js',)):
+    return {
+        'bundle_name': 'lib/bundle.js',
+        'entry_points': [str(srcdir.join(path)) for path in entry_points],
+        'info_module': 'exports.version = "1.0";',
+        'resolve_paths': [str(srcdir.join('lib')),
+                          str(srcdir.join('core', 'lib')),
+                          'node_modules'],
+        'aliases': {'info$': commonjs.INFO_MODULE, 'alias': 'pkg'},
+    }
+
+
+@pytest.mark.parametrize('request_,directory,expected', [
+    ('./a', 'lib', 'lib/a.js'),
+    ('../lib/data', 'core', 'lib/data.json'),
+    ('a.js', 'core', 'lib/a.js'),
+    ('core_thing', 'lib', 'core/lib/core/thing.js'),
+    ('lib_main', 'lib', None),
+    ('pkg', 'lib', 'node_modules/pkg/src/main.js'),
+    ('other', 'core/lib/core', 'node_modules/other/index.js'),
+    ('alias', 'lib', 'node_modules/pkg/src/main.js'),
+    ('alias/src/main', 'lib', 'node_modules/pkg/src/main.js'),
+    ('missing', 'lib', None),
+])
+def test_resolve(srcdir, request_, directory, expected):
+    bundle = get_bundle(srcdir)
+    resolver = commonjs._Resolver(bundle['resolve_paths'], bundle['aliases'])
+    resolved = resolver.resolve(request_, str(srcdir.join(directory)))
+
+    if expected is None:
+        assert resolved is None
+    else:
+        assert resolved == str(srcdir.join(expected))
+
+
+def test_create_bundle(srcdir):
+    output = commonjs.create_bundle(str(srcdir), get_bundle(srcdir))
+
+    assert output['included'] == ['lib/main.js', 'lib/a.js', 'lib/b.js',
+                                  'core/lib/core/thing.js', 'lib/data.json']
+    assert str(srcdir.join('lib', 'a.js')) in output['dependencies']
+    # Files looked for are dependencies as well.
+    assert str(srcdir.join('lib', 'a')) in output['dependencies']
+    # Requests in comments and strings are ignored.
+    assert not any('commented' in path or 'nothing' in path
+                   for path in output['dependencies'])
+    assert 'exports.version = "1.0";' in output['content']
+
+
+def test_module_not_found(srcdir):
+    srcdir.join('lib', 'broken.js').write('require("./missing");')
+    with pytest.raises(Exception) as excinfo:
+        commonjs.create_bundle(str(srcdir),
+                               get_bundle(srcdir, ['lib/broken.js']))
+    assert "Can't resolve './missing'" in str(excinfo.value)
+
+
+@pytest.mark.skipif(not find_executable('node'), reason='requires Node.js')
+def test_bundle_runs(srcdir):
+    output = commonjs.create_bundle(str(srcdir), get_bundle(srcdir))
+    srcdir.join('bundle.js').write(output['content'])
+
+    result = subprocess.check_output(['node', str(srcdir.join('bundle.js'))])
+    assert result == "a a 1.0 thing 42 require('nothing')\n"
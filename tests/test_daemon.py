@@ -0,0 +1,157 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import json
+import os
+import socket
+import subprocess
+import sys
+import threading
+import time
+import zipfile
+
+import pytest
+
+from buildtools import daemon
+
+pytestmark = pytest.mark.skipif(not hasattr(socket, 'AF_UNIX'),
+                                reason='Requires Unix domain sockets')
+
+
+@pytest.fixture
+def repository(tmpdir):
+    tmpdir.join('metadata.chrome').write('[general]\nbasename = test\n')
+    base_dir = str(tmpdir)
+
+    process = subprocess.Popen([
+        sys.executable, '-c',
+        'import sys; from buildtools.build import process_args; '
+        'process_args(sys.argv[1], "daemon")',
+        base_dir,
+    ])
+    path = daemon.get_socket_path(base_dir)
+    for i in range(100):
+        if os.path.exists(path) or process.poll() is not None:
+            break
+        time.sleep(0.1)
+
+    yield base_dir
+
+    daemon.stop(base_dir)
+    process.wait()
+
+
+def test_forward(repository, capsys):
+    assert daemon.forward(repository, ['build', '--bogus']) == 2
+    assert 'unrecognized arguments: --bogus' in capsys.readouterr()[1]
+
+    # Commands which aren't forwarded run in the client
+    assert daemon.forward(repository, ['translate', 'key']) is None
+
+
+def test_build(repository, tmpdir):
+    # The Python bundler doesn't need Node.js, nor webpack in node_modules.
+    metadata = tmpdir.join('metadata.chrome')
+    metadata.write('[general]\n'
+                   'basename = test\n'
+                   'version = 1.0\n'
+                   'author = Someone\n'
+                   'bundler = python\n'
+                   '[bundles]\n'
+                   'lib/main.js = ./lib/index.js\n')
+    tmpdir.join('_locales', 'en_US', 'messages.json').write(json.dumps({
+        name: {'message': 'Test'}
+        for name in ['name', 'name_releasebuild', 'description']
+    }), ensure=True)
+    tmpdir.join('lib', 'index.js').write('require("dep");', ensure=True)
+    dependency = tmpdir.join('node_modules', 'dep', 'index.js')
+    dependency.write('var first;', ensure=True)
+    package = tmpdir.join('test.zip')
+
+    def build():
+        assert daemon.forward(repository, ['build', '-r', str(package)]) == 0
+        with zipfile.ZipFile(str(package)) as zf:
+            manifest = json.loads(zf.read('manifest.json'))
+            return manifest['version'], zf.read('lib/main.js')
+
+    version, bundle = build()
+    assert version == '1.0'
+    assert 'var first;' in bundle
+
+    dependency.write('var second;')
+    version, bundle = build()
+    assert 'var first;' not in bundle
+    assert 'var second;' in bundle
+
+    metadata.write(metadata.read().replace('1.0', '1.1'))
+    version, bundle = build()
+    assert version == '1.1'
+    assert 'var second;' in bundle
+
+
+def test_stop(repository):
+    assert daemon.stop(repository)
+    for i in range(100):
+        if not os.path.exists(daemon.get_socket_path(repository)):
+            break
+        time.sleep(0.1)
+
+    assert daemon.forward(repository, ['build', '--bogus']) is None
+    assert not daemon.stop(repository)
+
+
+def test_threaded_output():
+    class SlowFile(object):
+        def __init__(self):
+            self.chunks = []
+
+        def write(self, data):
+            # Give other threads a chance to write in the middle of a message.
+            for char in data:
+                self.chunks.append(char)
+                time.sleep(0.0001)
+
+        def flush(self):
+            pass
+
+    file = SlowFile()
+    stream = daemon._ClientStream(file, 'stdout')
+    threads = [threading.Thread(target=stream.write, args=(str(i) * 20,))
+               for i in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    messages = [json.loads(line)
+                for line in ''.join(file.chunks).splitlines()]
+    assert sorted(message['output'] for message in messages) == [
+        str(i) * 20 for i in range(8)
+    ]
+
+
+def test_socket_permissions(repository):
+    directory = os.path.dirname(daemon.get_socket_path(repository))
+    assert daemon.forward(repository, ['build', '--bogus']) == 2
+
+    # Other users could have replaced the socket
+    os.chmod(directory, 0o777)
+    try:
+        assert daemon.forward(repository, ['build', '--bogus']) is None
+    finally:
+        os.chmod(directory, 0o755)
+
+
+def test_long_socket_path(tmpdir, monkeypatch):
+    monkeypatch.setattr(daemon, 'MAX_SOCKET_PATH', 0)
+    monkeypatch.setattr('tempfile.tempdir', str(tmpdir))
+    path = daemon.get_socket_path('repository')
+    directory = tmpdir.join('buildtools-{}'.format(os.getuid()))
+
+    assert os.path.dirname(path) == str(directory)
+    assert directory.stat().mode & 0o777 == 0o700
+
+    directory.chmod(0o755)
+    with pytest.raises(Exception):
+        daemon.get_socket_path('repository')
@@ -0,0 +1,814 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import json
+import os
+import threading
+import time
+import zipfile
+from multiprocessing.pool import ThreadPool
+from StringIO import StringIO
+from struct import unpack
+
+import pytest
+from Crypto.Signature import PKCS1_v1_5
+from Crypto.PublicKey import RSA
+from Crypto.Hash import SHA
+
+from buildtools import packager, packagerChrome
+from buildtools.chainedconfigparser import Item
+from buildtools.buildcache import (ContentCache, StatIndex, get_cache_path,
+                                   hash_file)
+
+KEYFILE = os.path.join(os.path.dirname(__file__), 'chrome_rsa.pem')
+
+
+@pytest.fixture
+def files():
+    files = packager.Files({'lib', 'icons'}, set())
+    files['lib/a.js'] = 'var a;\n' * 100
+    files['lib/b.js'] = 'var b;'
+    files['icons/abp-16.png'] = open(
+        os.path.join(os.path.dirname(__file__), 'abp-16.png'), 'rb',
+    ).read()
+    return files
+
+
+def split_crx(data):
+    magic, version, l_pubkey, l_signature = unpack('<4sIII', data[:16])
+    assert (magic, version) == ('Cr24', 2)
+    pubkey = data[16:16 + l_pubkey]
+    signature = data[16 + l_pubkey:16 + l_pubkey + l_signature]
+    return pubkey, signature, data[16 + l_pubkey + l_signature:]
+
+
+def assert_zip_content(zipdata, files):
+    with zipfile.ZipFile(StringIO(zipdata)) as zf:
+        assert zf.namelist() == sorted(files)
+        for name in files:
+            assert zf.read(name) == files[name]
+
+
+def test_write_package_unsigned(files):
+    output = StringIO()
+    packagerChrome.write_package(output, files)
+
+    assert_zip_content(output.getvalue(), files)
+
+
+def test_write_package_signed(files, tmpdir):
+    path = str(tmpdir.join('test.crx'))
+    packagerChrome.write_package(path, files, KEYFILE)
+
+    with open(path, 'rb') as fp:
+        pubkey, signature, zipdata = split_crx(fp.read())
+    with open(KEYFILE, 'rb') as fp:
+        key = RSA.importKey(fp.read())
+
+    assert pubkey == key.publickey().exportKey('DER')
+    assert PKCS1_v1_5.new(key).verify(SHA.new(zipdata), signature)
+    assert_zip_content(zipdata, files)
+
+
+def test_legacy_package_api(files):
+    date_time = (2000, 1, 1, 0, 0, 0)
+    archive = StringIO()
+    files.zip(archive, date_time=date_time)
+    zipdata = archive.getvalue()
+    legacy = StringIO()
+    packagerChrome.writePackage(legacy, packagerChrome.getPublicKey(KEYFILE),
+                                packagerChrome.signBinary(zipdata, KEYFILE),
+                                zipdata)
+    streamed = StringIO()
+    packagerChrome.write_package(streamed, files, KEYFILE, date_time=date_time)
+
+    assert legacy.getvalue() == streamed.getvalue()
+
+
+def test_zip_parallel_matches_serial(files, monkeypatch):
+    monkeypatch.setattr(packager.time, 'time', lambda: 1e9)
+    for i in range(20):
+        files['lib/module{}.js'.format(i)] = 'var x = {};\n'.format(i) * i
+
+    # Written like before entries were compressed up front, with the
+    # attributes ZipFile.writestr() gives them on Unix.
+    reference = StringIO()
+    with zipfile.ZipFile(reference, 'w', zipfile.ZIP_DEFLATED) as zf:
+        for name in sorted(files):
+            zinfo = zipfile.ZipInfo(name, time.localtime(1e9)[:6])
+            zinfo.compress_type = zipfile.ZIP_DEFLATED
+            zinfo.create_system = 3
+            zinfo.external_attr = 0o600 << 16
+            zf.writestr(zinfo, files[name])
+
+    serial = files.zipToString()
+    parallel = StringIO()
+    files.zip(parallel, jobs=4)
+
+    assert serial == reference.getvalue()
+    assert parallel.getvalue() == serial
+    assert_zip_content(serial, files)
+
+
+def test_zip_cache(files, tmpdir, monkeypatch):
+    monkeypatch.setattr(packager.time, 'time', lambda: 1e9)
+    cache = ContentCache(str(tmpdir.join('cache')), 1024 * 1024)
+    uncached = files.zipToString()
+
+    first = StringIO()
+    files.zip(first, cache=cache)
+
+    def compress(args):
+        raise AssertionError('Cached entry compressed again')
+
+    monkeypatch.setattr(packager, '_compress', compress)
+    second = StringIO()
+    files.zip(second, jobs=4, cache=cache)
+
+    assert first.getvalue() == second.getvalue() == uncached
+
+
+def test_content_cache_threads(tmpdir):
+    cache = ContentCache(str(tmpdir), 1024 * 1024)
+    cache.set('0000', '')
+    values = [str(i) * 10000 for i in range(8)]
+
+    def store(value):
+        for i in range(20):
+            cache.set('aa01', value, replace=True)
+            cache.set('{:02x}{}'.format(i, value[:2]), value)
+
+    pool = ThreadPool(len(values))
+    try:
+        pool.map(store, values)
+    finally:
+        pool.terminate()
+
+    assert cache.get('aa01') in values
+    assert not list(tmpdir.visit(lambda path: path.ext == '.tmp'))
+    assert cache._size == sum(size for _, size, _ in cache._list_blobs())
+
+
+def test_cache_path(tmpdir, cache_dir):
+    repository = tmpdir.join('repository')
+    path = get_cache_path(str(repository), 'zip')
+
+    # Caches must never show up as untracked files in the repository.
+    assert path.startswith(str(cache_dir) + os.sep)
+    assert get_cache_path(str(repository.join('.')), 'zip') == path
+    assert get_cache_path(str(tmpdir.join('other')), 'zip') != path
+
+
+def test_content_cache_eviction(tmpdir):
+    cache = ContentCache(str(tmpdir), 3000)
+    for i, key in enumerate(['aa01', 'bb02', 'cc03']):
+        cache.set(key, 'x' * 1000)
+        os.utime(cache._get_path(key), (i, i))
+
+    assert cache.get('aa01') == 'x' * 1000
+    cache.set('dd04', 'y' * 1000)
+
+    assert 'bb02' not in cache
+    assert 'cc03' not in cache
+    assert 'aa01' in cache
+    assert 'dd04' in cache
+
+
+@pytest.fixture
+def srcdir(tmpdir):
+    tmpdir.join('lib', 'a.js').write('var a;\n' * 100, ensure=True)
+    tmpdir.join('lib', 'b.js').write('var b;', ensure=True)
+    tmpdir.join('lib', 'ignored', 'c.js').write('var c;', ensure=True)
+    tmpdir.join('skin', 'big.bin').write(os.urandom(300 * 1024), mode='wb',
+                                         ensure=True)
+    tmpdir.join('other', 'd.js').write('var d;', ensure=True)
+    return tmpdir
+
+
+def test_read_is_lazy(srcdir):
+    files = packager.Files({'lib', 'skin'}, {'ignored'})
+    files.read(str(srcdir))
+
+    assert sorted(files) == ['lib/a.js', 'lib/b.js', 'skin/big.bin']
+    entry = files.get_entry('skin/big.bin')
+    assert entry.size == 300 * 1024
+    assert entry.path == str(srcdir.join('skin', 'big.bin'))
+
+    assert files['lib/b.js'] == 'var b;'
+    assert files.get('lib/b.js') == 'var b;'
+    assert files.get_entry('lib/b.js') is not None
+
+    files['lib/b.js'] = 'var e;'
+    assert files.get_entry('lib/b.js') is None
+    assert files.pop('lib/b.js') == 'var e;'
+
+
+def test_read_processes_on_load(srcdir):
+    files = packager.Files({'lib'}, set(),
+                           process=lambda path, data: data.upper())
+    files.read(str(srcdir))
+
+    assert files['lib/b.js'] == 'VAR B;'
+    assert dict(files.items())['lib/b.js'] == 'VAR B;'
+
+
+def test_zip_streams_from_disk(srcdir, monkeypatch):
+    monkeypatch.setattr(packager.time, 'time', lambda: 1e9)
+    files = packager.Files({'lib', 'skin'}, set())
+    files.read(str(srcdir))
+    in_memory = packager.Files({'lib', 'skin'}, set())
+    for name in files:
+        in_memory[name] = files[name]
+
+    parallel = StringIO()
+    files.zip(parallel, jobs=2)
+
+    assert files.zipToString() == in_memory.zipToString()
+    assert parallel.getvalue() == in_memory.zipToString()
+    assert_zip_content(files.zipToString(), files)
+
+
+def test_write_to_directory(srcdir, tmpdir):
+    files = packager.Files({'lib', 'skin'}, set())
+    files.read(str(srcdir))
+    files['lib/b.js'] = 'var e;'
+    files['lib/new/unicode.js'] = u'\u2026'
+    target = tmpdir.join('target')
+    files.write_to_directory(str(target))
+
+    assert target.join('lib', 'a.js').read() == 'var a;\n' * 100
+    assert target.join('lib', 'b.js').read() == 'var e;'
+    assert (target.join('lib', 'new', 'unicode.js').read('rb') ==
+            u'\u2026'.encode('utf-8'))
+    assert (target.join('skin', 'big.bin').read('rb') ==
+            srcdir.join('skin', 'big.bin').read('rb'))
+    assert files.get_file_size('skin/big.bin') == 300 * 1024
+    assert files.get_file_size('lib/new/unicode.js') == 3
+
+
+def test_file_matcher():
+    matcher = packager.FileMatcher({'lib', '*.json'}, {'.git', '*.orig'},
+                                   skip={'lib/skipped.js', 'lib/tmp/*'})
+
+    assert matcher.matches('lib/a/b.js')
+    assert matcher.matches('bar.json')
+    assert not matcher.matches('ext/a.js')
+    assert not matcher.matches('lib/.git/config')
+    assert not matcher.matches('lib/a.js.orig')
+    assert not matcher.matches('lib/skipped.js')
+    assert not matcher.matches('lib/tmp/a.js')
+
+
+def test_read_prunes_directories(srcdir, monkeypatch):
+    scanned = []
+    scandir = packager._scandir
+
+    def record_scandir(path):
+        scanned.append(os.path.relpath(path, str(srcdir)))
+        return scandir(path)
+
+    monkeypatch.setattr(packager, '_scandir', record_scandir)
+    files = packager.Files({'lib'}, {'ignored'})
+    files.read(str(srcdir), skip=['lib/a.js'])
+
+    assert sorted(files) == ['lib/b.js']
+    assert sorted(scanned) == ['.', 'lib']
+
+
+def test_stat_index(tmpdir):
+    path = tmpdir.join('a.js')
+    path.write('var a;')
+    path.setmtime(1e9)
+    index = StatIndex(str(tmpdir.join('cache', 'index.json')))
+    original_hash = hash_file(str(path))
+
+    assert index.get_hash(str(path)) == original_hash
+    index.save()
+
+    # As long as the stat info matches, the file isn't read again.
+    path.write('var b;')
+    path.setmtime(1e9)
+    index = StatIndex(index.path)
+    assert index.get_hash(str(path)) == original_hash
+
+    path.setmtime(1e9 + 1)
+    assert index.get_hash(str(path)) == hash_file(str(path))
+
+
+def test_stat_index_skips_racy_files(tmpdir):
+    path = tmpdir.join('a.js')
+    path.write('var a;')
+    index = StatIndex(str(tmpdir.join('cache', 'index.json')))
+    index.get_hash(str(path))
+    index.save()
+
+    assert not os.path.exists(index.path)
+
+
+def test_read_uses_stat_index(srcdir):
+    srcdir.join('lib', 'b.js').setmtime(1e9)
+    index = StatIndex(str(srcdir.join('index.json')))
+    files = packager.Files({'lib'}, set(), index=index)
+    files.read(str(srcdir))
+
+    index.get_hash(str(srcdir.join('lib', 'b.js')))
+    index._entries[str(srcdir.join('lib', 'b.js'))][3] = 'from index'
+
+    assert files.get_entry('lib/b.js').hash == 'from index'
+
+
+def test_compression_policy(files, tmpdir):
+    files['lib/random.js'] = os.urandom(1024)
+    policy = packager.CompressionPolicy(
+        level=9, max_ratio=0.95,
+        stored_extensions=packager.CompressionPolicy.PRECOMPRESSED_EXTENSIONS,
+    )
+    cache = ContentCache(str(tmpdir), 1024 * 1024)
+
+    for i in range(2):
+        output = StringIO()
+        summary = files.zip(output, cache=cache, policy=policy)
+
+        with zipfile.ZipFile(output) as zf:
+            compression = {info.filename: info.compress_type
+                           for info in zf.infolist()}
+        assert compression == {
+            'icons/abp-16.png': zipfile.ZIP_STORED,
+            'lib/a.js': zipfile.ZIP_DEFLATED,
+            'lib/b.js': zipfile.ZIP_STORED,
+            'lib/random.js': zipfile.ZIP_STORED,
+        }
+        assert_zip_content(output.getvalue(), files)
+
+        png_size = len(files['icons/abp-16.png'])
+        assert summary['.png'] == [1, png_size, png_size]
+        count, size, compressed_size = summary['.js']
+        assert (count, size) == (3, sum(len(files[name]) for name in files
+                                        if name.endswith('.js')))
+        assert compressed_size < size
+
+
+def test_threaded_read_matches_serial(srcdir, monkeypatch):
+    monkeypatch.setattr(packager.time, 'time', lambda: 1e9)
+    for i in range(8):
+        srcdir.join('lib', 'extra{}.js'.format(i)).write('var e{};'.format(i))
+    index = StatIndex(str(srcdir.join('index.json')))
+    cache = ContentCache(str(srcdir.join('cache')), 1024 * 1024)
+
+    pools = []
+    thread_pool = packager.ThreadPool
+
+    def create_pool(threads):
+        pools.append(threads)
+        return thread_pool(threads)
+
+    monkeypatch.setattr(packager, 'ThreadPool', create_pool)
+
+    results = []
+    for io_threads in [1, 4]:
+        files = packager.Files({'lib', 'skin', 'other'}, {'ignored'},
+                               index=index, io_threads=io_threads)
+        files.read(str(srcdir))
+        files.readMappedFiles([Item(
+            'mapped/d.js', 'other/d.js', str(srcdir.join('metadata')),
+        )])
+        # More files than threads were read, on a pool of threads.
+        assert len(files) > 2 * io_threads
+        assert pools == ([io_threads] if io_threads > 1 else [])
+
+        output = StringIO()
+        files.zip(output, cache=cache)
+        results.append((sorted(files), output.getvalue()))
+
+    assert results[0] == results[1]
+    assert 'mapped/d.js' in results[0][0]
+
+
+def test_memory_budget(monkeypatch):
+    monkeypatch.setattr(packager.time, 'time', lambda: 1e9)
+    big = 'var big;\n' * 20000
+    files = packager.Files({'lib'}, set(), memory_budget=250 * 1024,
+                           process=lambda path, data: data)
+    in_memory = packager.Files({'lib'}, set())
+    for name, data in [('lib/a.js', big), ('lib/b.js', u'var b = "\xe4";'),
+                       ('lib/c.js', big.upper() * 2), ('lib/d.js', 'var d;')]:
+        files[name] = in_memory[name] = data
+
+    spilled = [name for name in files
+               if isinstance(files.get_entry(name), packager.SpilledEntry)]
+    assert spilled == ['lib/c.js']
+    assert files['lib/c.js'] == big.upper() * 2
+    assert files['lib/b.js'] == u'var b = "\xe4";'
+    assert files.zipToString() == in_memory.zipToString()
+
+    path = files.get_entry('lib/c.js').path
+    files['lib/c.js'] = 'var c;'
+    assert not os.path.exists(path)
+
+    files['lib/e.js'] = big * 2
+    files.close()
+    assert not os.path.exists(files.get_entry('lib/e.js').path)
+
+
+def test_memory_budget_unicode():
+    files = packager.Files({'lib'}, set(), memory_budget=1000)
+    files['lib/a.js'] = u'\xe4' * 400
+    assert files._resident_size == 800
+
+
+def test_memory_budget_fork(monkeypatch):
+    monkeypatch.setattr(packager, 'SPILL_MIN_SIZE', 0)
+    files = packager.Files({'lib'}, set(), memory_budget=0)
+    files['lib/a.js'] = 'var a;'
+    files['lib/b.js'] = 'var b;'
+    path = files.get_entry('lib/a.js').path
+
+    fork = files.fork()
+    files['lib/a.js'] = 'var a = 1;'
+    del files['lib/b.js']
+    assert fork['lib/a.js'] == 'var a;'
+    assert fork['lib/b.js'] == 'var b;'
+
+    other_fork = files.fork()
+    fork.close()
+    assert not os.path.exists(path)
+    assert other_fork['lib/a.js'] == 'var a = 1;'
+    files.close()
+
+
+def test_reproducible_package(files, tmpdir, monkeypatch):
+    monkeypatch.setenv('SOURCE_DATE_EPOCH', '1500000000')
+    date_time = packager.get_source_date_time()
+    assert date_time == (2017, 7, 14, 2, 40, 0)
+
+    packages = []
+    for i in range(2):
+        path = str(tmpdir.join('{}.crx'.format(i)))
+        packagerChrome.write_package(path, files, KEYFILE, date_time=date_time)
+        with open(path, 'rb') as fp:
+            packages.append(fp.read())
+
+    assert packages[0] == packages[1]
+    with zipfile.ZipFile(StringIO(split_crx(packages[0])[2])) as zf:
+        assert {info.date_time for info in zf.infolist()} == {date_time}
+
+    content_hash = files.get_content_hash()
+    files['lib/b.js'] = 'var c;'
+    assert files.get_content_hash() != content_hash
+
+
+def test_reproducible_edge(tmpdir):
+    with pytest.raises(ValueError):
+        packagerChrome.createBuilds(str(tmpdir), ['chrome', 'edge'],
+                                    reproducible=True)
+
+
+def test_build_fingerprint(srcdir):
+    srcdir.join('metadata.chrome').write('[general]\nbasename = test\n')
+    params = {
+        'type': 'chrome',
+        'baseDir': str(srcdir),
+        'version': '1.0',
+        'releaseBuild': True,
+        'devenv': False,
+        'io_threads': 1,
+        'metadata': packager.readMetadata(str(srcdir), 'chrome'),
+    }
+
+    def get_fingerprint(**kwargs):
+        files = packagerChrome.read_build_files(params)[0]
+        return packager.get_build_fingerprint(params, files, **kwargs)
+
+    fingerprint = get_fingerprint()
+
+    srcdir.join('test-1.0.zip').write('previous build')
+    srcdir.join('other', 'd.js').write('var e;')
+    srcdir.join('node_modules', 'pkg', 'index.js').write('', ensure=True)
+    assert get_fingerprint() == fingerprint
+
+    srcdir.join('lib', 'ignored', 'c.js').write('var e;')
+    assert get_fingerprint() != fingerprint
+    fingerprint = get_fingerprint()
+
+    srcdir.join('lib', 'e.js').write('var e;')
+    assert get_fingerprint() != fingerprint
+    fingerprint = get_fingerprint()
+
+    assert get_fingerprint(keyFile=KEYFILE) != fingerprint
+
+    srcdir.join('metadata.chrome').write('[general]\nbasename = other\n')
+    params['metadata'] = packager.readMetadata(str(srcdir), 'chrome')
+    assert get_fingerprint() != fingerprint
+
+
+def test_build_dependencies(tmpdir):
+    base_dir = str(tmpdir.join('repo'))
+    dependency = tmpdir.join('node_modules', 'pkg', 'index.js')
+    dependency.write('module.exports = 1;', ensure=True)
+    package = tmpdir.join('package.zip')
+    package.write('package')
+
+    dependencies = {str(dependency): packager.hash_file(str(dependency))}
+    packager.store_build(base_dir, 'fingerprint', str(package), dependencies)
+    package.remove()
+    assert packager.restore_build(base_dir, 'fingerprint', str(package))
+    assert package.read() == 'package'
+
+    dependency.write('module.exports = 2;')
+    assert not packager.restore_build(base_dir, 'fingerprint', str(package))
+    assert not packager.restore_build(base_dir, 'other', str(package))
+
+
+def test_build_cache_globs(tmpdir):
+    tmpdir.join('metadata.chrome').write('[general]\n'
+                                         'basename = test\n'
+                                         'version = 1.0\n'
+                                         'author = Someone\n'
+                                         '[import_locales]\n'
+                                         'locale/*/ui.json = *\n')
+    tmpdir.join('_locales', 'en_US', 'messages.json').write(json.dumps({
+        name: {'message': 'Test'}
+        for name in ['name', 'name_releasebuild', 'description']
+    }), ensure=True)
+    tmpdir.join('locale', 'en_US', 'ui.json').write(
+        '{"ui": {"message": "UI"}}', ensure=True,
+    )
+    package = tmpdir.join('test.zip')
+
+    def build():
+        packagerChrome.createBuild(str(tmpdir), releaseBuild=True,
+                                   outFile=str(package))
+        with zipfile.ZipFile(str(package)) as zf:
+            return sorted(zf.namelist())
+
+    assert '_locales/de/messages.json' not in build()
+
+    # Locales are listed with a glob, rather than read as source files.
+    tmpdir.join('locale', 'de', 'ui.json').write(
+        '{"ui": {"message": "Oberflaeche"}}', ensure=True,
+    )
+    assert '_locales/de/messages.json' in build()
+
+
+def test_build_matrix_jobs(tmpdir, monkeypatch):
+    tmpdir.join('metadata.chrome').write('[general]\n'
+                                         'basename = test\n'
+                                         'version = 1.0\n'
+                                         'author = Someone\n')
+    tmpdir.join('_locales', 'en_US', 'messages.json').write(json.dumps({
+        name: {'message': 'Test'}
+        for name in ['name', 'name_devbuild', 'description']
+    }), ensure=True)
+    zip_files = packager.Files.zip
+    lock = threading.Lock()
+    running = []
+    busy = []
+
+    def zip(self, output, jobs=1, **kwargs):
+        with lock:
+            running.append(jobs)
+            busy.append(sum(running))
+        time.sleep(0.1)
+        try:
+            return zip_files(self, output, jobs=jobs, **kwargs)
+        finally:
+            with lock:
+                running.remove(jobs)
+
+    monkeypatch.setattr(packager.Files, 'zip', zip)
+    variants = [{'outFile': str(tmpdir.join('{}.zip'.format(i))),
+                 'buildNum': '1'} for i in range(4)]
+    packagerChrome.createBuildMatrix(str(tmpdir), variants=variants, jobs=3)
+
+    assert len(busy) == 4
+    assert max(busy) <= 3
+
+
+def test_shared_bundler(monkeypatch):
+    calls = []
+
+    def run_webpack(configuration, cache=None, jobs=1):
+        calls.append(configuration)
+        return {os.path.normpath(bundle['bundle_name']): {
+            'content': bundle['info_module'], 'included': [],
+            'dependencies': [],
+        } for bundle in configuration['bundles']}
+
+    monkeypatch.setattr(packagerChrome, 'run_webpack', run_webpack)
+
+    def configuration(info_module, extension_path='/ext'):
+        return {'extension_path': extension_path, 'bundles': [{
+            'bundle_name': 'lib/main.js', 'entry_points': ['main.js'],
+            'info_module': info_module, 'resolve_paths': [], 'aliases': {},
+        }]}
+
+    bundler = packagerChrome.SharedBundler()
+    bundler.add(configuration('chrome'))
+    bundler.add(configuration('gecko'))
+
+    assert bundler.bundle(configuration('gecko')) == {
+        'lib/main.js': {'content': 'gecko', 'included': [],
+                        'dependencies': []},
+    }
+    assert bundler.bundle(configuration('chrome')) == {
+        'lib/main.js': {'content': 'chrome', 'included': [],
+                        'dependencies': []},
+    }
+    assert len(calls) == 1
+    assert len(calls[0]['bundles']) == 2
+
+    # Bundles for a different configuration are created separately
+    bundler.bundle(configuration('other'))
+    assert len(calls) == 2
+
+    # Configurations are bundled with their own extension path.
+    del calls[:]
+    bundler = packagerChrome.SharedBundler()
+    bundler.add(configuration('chrome'))
+    bundler.add(configuration('gecko', '/other'))
+    assert bundler.bundle(configuration('gecko', '/other')) == {
+        'lib/main.js': {'content': 'gecko', 'included': [],
+                        'dependencies': []},
+    }
+    assert [call['extension_path'] for call in calls] == ['/ext', '/other']
+
+
+@pytest.mark.parametrize('option,flag,expected', [
+    (None, None, 'webpack'),
+    ('python', None, 'python'),
+    ('python', 'webpack', 'webpack'),
+    (None, 'python', 'python'),
+    ('rollup', None, None),
+])
+def test_get_bundler(tmpdir, option, flag, expected):
+    metadata = '[general]\nbasename = test\n'
+    if option:
+        metadata += 'bundler = {}\n'.format(option)
+    tmpdir.join('metadata.chrome').write(metadata)
+    params = {'metadata': packager.readMetadata(str(tmpdir), 'chrome'),
+              'bundler': flag}
+
+    if expected is None:
+        with pytest.raises(Exception):
+            packagerChrome.get_bundler(params)
+    else:
+        assert packagerChrome.get_bundler(params) == expected
+
+
+def test_template_bytecode_cache(tmpdir, monkeypatch):
+    jinja2 = pytest.importorskip('jinja2')
+    cache = jinja2.FileSystemBytecodeCache(str(tmpdir))
+    monkeypatch.setattr(packager, '_get_bytecode_cache',
+                        lambda jinja2, kind: cache)
+    compiled = []
+    original_compile = jinja2.Environment.compile
+
+    def compile_template(self, source, *args):
+        compiled.append(source)
+        return original_compile(self, source, *args)
+
+    monkeypatch.setattr(jinja2.Environment, 'compile', compile_template)
+
+    def preprocess(source):
+        # Each build starts with a new environment, as a new process would.
+        monkeypatch.setattr(packager, '_template_environments', {})
+        files = packager.Files({'lib'}, set())
+        files['lib/page.html'] = source
+        files.preprocess(['lib/page.html'], {'name': '<b>'})
+        packager.getTemplate('manifest.json.tmpl')
+        return files['lib/page.html']
+
+    assert preprocess('{{ name }}') == '&lt;b&gt;'
+    assert len(compiled) == 2
+    assert preprocess('{{ name }}') == '&lt;b&gt;'
+    assert len(compiled) == 2
+    assert preprocess('{{ name }}!') == '&lt;b&gt;!'
+    assert compiled[2:] == [u'{{ name }}!']
+
+
+def test_preprocess_environment():
+    jinja2 = pytest.importorskip('jinja2')
+    files = packager.Files({'lib'}, set())
+
+    # There is no loader to include buildtools' templates with.
+    files['lib/include.html'] = "{% include 'manifest.json.tmpl' %}"
+    with pytest.raises(TypeError):
+        files.preprocess(['lib/include.html'])
+
+    files['lib/filter.html'] = '{{ name|json }}'
+    with pytest.raises(jinja2.TemplateAssertionError):
+        files.preprocess(['lib/filter.html'], {'name': 'test'})
+
+
+@pytest.mark.parametrize('source', [
+    '', '\n', 'plain\n', 'plain\n\n', 'no newline', 'windows\r\nlines\r\n',
+    u'unicode\u2028line\u2029breaks\x85\n'.encode('utf-8'),
+])
+def test_preprocess_passes_plain_files(source, monkeypatch):
+    jinja2 = pytest.importorskip('jinja2')
+    expected = jinja2.Environment().from_string(
+        source.decode('utf-8'),
+    ).render().encode('utf-8')
+
+    def render(args):
+        raise AssertionError('File without template syntax rendered')
+
+    monkeypatch.setattr(packager, '_render_template', render)
+    files = packager.Files({'lib'}, set())
+    files['lib/page.html'] = source
+    files.preprocess(['lib/page.html'])
+
+    assert files['lib/page.html'] == expected
+
+
+def test_preprocess_cache(tmpdir, monkeypatch):
+    pytest.importorskip('jinja2')
+    cache = ContentCache(str(tmpdir.join('cache')), 1024 * 1024)
+
+    def preprocess(params, jobs=1):
+        files = packager.Files({'lib'}, set())
+        for i in range(4):
+            files['lib/page{}.html'.format(i)] = '<p>{{ name }}</p>\n'
+        files['lib/other.js'] = 'var i = {{ i }};'
+        files.preprocess(list(files), params, jobs=jobs, cache=cache)
+        return dict(files.items())
+
+    expected = {'lib/page{}.html'.format(i): '<p>&lt;b&gt;</p>'
+                for i in range(4)}
+    expected['lib/other.js'] = 'var i = 1;'
+    assert preprocess({'name': '<b>', 'i': 1}, jobs=4) == expected
+
+    def render(args):
+        raise AssertionError('Cached file rendered again')
+
+    monkeypatch.setattr(packager, '_render_template', render)
+    assert preprocess({'name': '<b>', 'i': 1}) == expected
+    with pytest.raises(AssertionError):
+        preprocess({'name': '<b>', 'i': 2})
+
+
+def test_run_webpack_uses_bundle_cache(tmpdir, monkeypatch):
+    from buildtools import bundling
+
+    class Worker(object):
+        def iter_bundles(self, configuration):
+            calls.append([bundle['bundle_name']
+                          for bundle in configuration['bundles']])
+            for bundle in configuration['bundles']:
+                yield bundle['bundle_name'], {
+                    'content': bundle['info_module'], 'included': [],
+                    'dependencies': [str(src.join(bundle['bundle_name']))],
+                    'time': 1.0,
+                }
+
+    calls = []
+    monkeypatch.setattr(packagerChrome, 'get_webpack_workers',
+                        lambda count: [Worker() for i in range(count)])
+    src = tmpdir.join('src')
+    src.join('a.js').write('', ensure=True)
+    src.join('b.js').write('')
+    cache = bundling.BundleCache(ContentCache(str(tmpdir.join('cache')),
+                                              1024 * 1024))
+    configuration = {'extension_path': str(src), 'bundles': [
+        {'bundle_name': name, 'entry_points': [], 'info_module': name,
+         'resolve_paths': [], 'aliases': {}}
+        for name in ['a.js', 'b.js']
+    ]}
+
+    output = packagerChrome.run_webpack(configuration, cache)
+    src.join('b.js').write('changed')
+    assert packagerChrome.run_webpack(configuration, cache) == output
+    assert calls == [['a.js', 'b.js'], ['b.js']]
+
+
+def test_run_webpack_parallel(tmpdir, monkeypatch):
+    from buildtools import bundling
+
+    class Worker(object):
+        def __init__(self, number):
+            self.number = number
+
+        def iter_bundles(self, configuration):
+            # Bundles arrive in reverse order.
+            for bundle in reversed(configuration['bundles']):
+                yield bundle['bundle_name'], {
+                    'content': bundle['info_module'], 'included': [],
+                    'dependencies': [], 'time': self.number,
+                }
+
+    monkeypatch.setattr(packagerChrome, 'get_webpack_workers',
+                        lambda count: [Worker(i) for i in range(count)])
+    cache = bundling.BundleCache(ContentCache(str(tmpdir), 1024 * 1024))
+    configuration = {'extension_path': '/ext', 'bundles': [
+        {'bundle_name': 'lib/{}.js'.format(i), 'entry_points': [],
+         'info_module': str(i), 'resolve_paths': [], 'aliases': {}}
+        for i in range(5)
+    ]}
+
+    serial = packagerChrome.run_webpack(configuration)
+    parallel = packagerChrome.run_webpack(configuration, cache, jobs=3)
+    assert parallel == serial
+    assert list(parallel) == ['lib/{}.js'.format(i) for i in range(5)]
+    assert ([cache.get_time('/ext', bundle)
+             for bundle in configuration['bundles']] == [0, 1, 2, 0, 1])
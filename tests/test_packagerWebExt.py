@@ -17,6 +17,7 @@ from Crypto.PublicKey import RSA
 from Crypto.Hash import SHA
 
 from buildtools import packager
+from buildtools import packagerChrome
 from buildtools.packagerChrome import defaultLocale
 from buildtools.build import process_args
 
@@ -493,3 +494,86 @@ def test_build_webext(platform, command, keyfile, tmpdir, srcdir, capsys):
                 package.read(os.path.join(folder, '{}.{}'.format(name, ext))),
                 expected,
             )
+
+
+@pytest.mark.usefixtures(
+    'all_lang_locales',
+    'locale_modules',
+    'icons',
+    'lib_files',
+    'chrome_metadata',
+    'gecko_webext_metadata',
+    'edge_metadata',
+)
+def test_build_matrix(keyfile, srcdir):
+    process_args(str(srcdir), 'build-matrix', '-t', 'chrome', '-b', '1337',
+                 '-k', keyfile, 'devbuild', 'release', 'signed-release')
+
+    out_dir = os.path.join(os.path.dirname(__file__), os.pardir)
+    devbuild = os.path.join(out_dir, 'adblockpluschrome-1.2.3.1337.zip')
+    release = os.path.join(out_dir, 'adblockpluschrome-1.2.3.zip')
+    signed = os.path.join(out_dir, 'adblockpluschrome-1.2.3.crx')
+
+    assert_chrome_signature(signed, keyfile)
+
+    with ZipContent(devbuild) as package:
+        assert_webpack_bundle(package, '', True, 'chrome')
+
+    with ZipContent(release) as package, ZipContent(signed) as signed_package:
+        assert_webpack_bundle(package, '', False, 'chrome')
+        assert package.namelist() == signed_package.namelist()
+        for name in package.namelist():
+            assert package.read(name) == signed_package.read(name)
+
+
+@pytest.mark.usefixtures(
+    'all_lang_locales',
+    'locale_modules',
+    'icons',
+    'lib_files',
+    'chrome_metadata',
+)
+def test_build_result(srcdir):
+    result = packagerChrome.create_build_result(str(srcdir), 'chrome',
+                                                buildNum='1337')
+    try:
+        assert 'addonVersion = "1.2.3.1337";' in result.files['lib/foo.js']
+        package = result.get_package()
+        package.seek(0, os.SEEK_END)
+        size = package.tell()
+        package.seek(0)
+        with zipfile.ZipFile(package) as zip_file:
+            assert sorted(zip_file.namelist()) == sorted(result.files)
+    finally:
+        result.close()
+
+    assert list(result.stats)[0] == 'read'
+    assert 'bundles' in result.stats
+    assert list(result.stats)[-1] == 'package'
+    assert result.stats['package'][1] == size
+
+
+@pytest.mark.usefixtures(
+    'all_lang_locales',
+    'locale_modules',
+    'icons',
+    'lib_files',
+    'chrome_metadata',
+    'gecko_webext_metadata',
+)
+@pytest.mark.parametrize('platform', ['chrome', 'gecko'])
+def test_python_bundler(platform, srcdir):
+    result = packagerChrome.create_build_result(str(srcdir), platform,
+                                                buildNum='1337',
+                                                bundler='python')
+    try:
+        libfoo = result.files['lib/foo.js']
+    finally:
+        result.close()
+
+    assert 'var bar;' in libfoo
+    assert 'addonVersion = "1.2.3.1337";' in libfoo
+    assert 'var this_is_c;' in libfoo
+    assert 'var this_is_mogo;' in libfoo
+    assert ('var foo;' in libfoo) != (platform == 'gecko')
+    assert 'lib/aliased.js' not in result.files
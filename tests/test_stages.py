@@ -0,0 +1,163 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import os
+import threading
+
+import pytest
+
+from buildtools import packager
+from buildtools.buildcache import ContentCache
+from buildtools.stages import StageRunner, record_file
+
+
+@pytest.fixture
+def build(tmpdir):
+    tmpdir.join('metadata.chrome').write(
+        '[general]\nbasename = test\n[other]\nfoo = bar\n',
+    )
+    tmpdir.join('lib', 'a.js').write('var a;', ensure=True)
+    tmpdir.join('lib', 'b.js').write('var b;', ensure=True)
+    tmpdir.join('lib', 'old.js').write('var old;', ensure=True)
+    tmpdir.join('external.txt').write('foo')
+    return tmpdir
+
+
+def run_build(build, stage):
+    files = packager.Files({'lib'}, set())
+    files.read(str(build))
+    params = {
+        'type': 'chrome',
+        'baseDir': str(build),
+        'version': '1.0',
+        'metadata': packager.readMetadata(str(build), 'chrome'),
+    }
+    cache = ContentCache(str(build.join('cache')), 1024 * 1024)
+    stages = StageRunner(params, files, cache)
+    stages.add('test', stage)
+    ran = stages.run_all()
+    return ran == ['test'], dict(files.items())
+
+
+def example_stage(params, files):
+    params['metadata'].get('general', 'basename')
+    record_file(os.path.join(params['baseDir'], 'external.txt'))
+    files['lib/out.js'] = files['lib/a.js'].upper() + params['version']
+    files['lib/unicode.js'] = u'\u2026'
+    del files['lib/old.js']
+
+
+def test_stage_replay(build):
+    ran, expected = run_build(build, example_stage)
+    assert ran
+    assert expected['lib/out.js'] == 'VAR A;1.0'
+    assert 'lib/old.js' not in expected
+
+    ran, result = run_build(build, example_stage)
+    assert not ran
+    assert result == expected
+    assert isinstance(result['lib/unicode.js'], unicode)
+
+
+@pytest.mark.parametrize('change,reruns', [
+    (lambda build: build.join('lib', 'b.js').write('var c;'), False),
+    (lambda build: build.join('lib', 'a.js').write('var c;'), True),
+    (lambda build: build.join('lib', 'c.js').write('var c;'), False),
+    (lambda build: build.join('external.txt').write('bar'), True),
+    (lambda build: build.join('metadata.chrome').write(
+        '[general]\nbasename = test\n[other]\nfoo = baz\n',
+    ), False),
+    (lambda build: build.join('metadata.chrome').write(
+        '[general]\nbasename = other\n[other]\nfoo = bar\n',
+    ), True),
+])
+def test_stage_inputs(build, change, reruns):
+    run_build(build, example_stage)
+    change(build)
+    ran, result = run_build(build, example_stage)
+
+    assert ran == reruns
+    assert result['lib/out.js'] == result['lib/a.js'].upper() + '1.0'
+
+
+def test_stage_listing(build):
+    def stage(params, files):
+        files['lib/count.js'] = str(len(list(files)))
+
+    run_build(build, stage)
+    build.join('lib', 'c.js').write('var c;')
+    ran, result = run_build(build, stage)
+
+    assert ran
+    assert result['lib/count.js'] == '4'
+
+
+def test_concurrent_stages(build):
+    files = packager.Files({'lib'}, set())
+    files.read(str(build))
+    params = {'type': 'chrome',
+              'metadata': packager.readMetadata(str(build), 'chrome')}
+    started = threading.Event()
+
+    def slow(params, files):
+        # Only finishes if the other stages run at the same time.
+        assert started.wait(5)
+        files['lib/a.js'] = 'slow'
+        files['lib/slow.js'] = 'slow'
+
+    def fast(params, files):
+        started.set()
+        files['lib/a.js'] = 'fast'
+
+    def reader(params, files):
+        files['lib/read.js'] = files['lib/a.js']
+
+    def dependent(params, files):
+        files['lib/dependent.js'] = files['lib/slow.js']
+
+    stages = StageRunner(params, files)
+    stages.add('slow', slow)
+    stages.add('fast', fast)
+    stages.add('reader', reader)
+    stages.add('dependent', dependent, after=('slow',))
+    ran = stages.run_all(jobs=4)
+
+    assert ran == ['slow', 'fast', 'reader', 'dependent']
+    assert files['lib/a.js'] == 'fast'
+    assert files['lib/read.js'] == 'fast'
+    assert files['lib/dependent.js'] == 'slow'
+
+
+def test_job_budget(build):
+    files = packager.Files({'lib'}, set())
+    params = {'type': 'chrome', 'job_budget': packager.JobBudget(4),
+              'metadata': packager.readMetadata(str(build), 'chrome')}
+    started = threading.Event()
+    taken = threading.Event()
+    finished = threading.Event()
+    jobs = {}
+
+    def pool(params, files):
+        assert started.wait(5)
+        with packager.get_job_budget(params).take() as jobs['pool']:
+            taken.set()
+            # The other stage gets no further processes meanwhile.
+            assert finished.wait(5)
+
+    def other(params, files):
+        started.set()
+        assert taken.wait(5)
+        with packager.get_job_budget(params).take() as jobs['other']:
+            pass
+        finished.set()
+
+    stages = StageRunner(params, files)
+    stages.add('pool', pool)
+    stages.add('other', other)
+    stages.run_all(jobs=4)
+
+    # Each stage holds one job, and the pool takes the two left over.
+    assert jobs == {'pool': 3, 'other': 1}
+    with params['job_budget'].take() as available:
+        assert available == 4
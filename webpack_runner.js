@@ -4,40 +4,124 @@
 
 "use strict";
 
+const crypto = require("crypto");
+const fs = require("fs");
 const path = require("path");
 const process = require("process");
 
+// Anything webpack or the loaders log must not end up between our frames.
+const stdout = process.stdout;
+console.log = console.info = console.error;
+
 const MemoryFS = require("memory-fs");
 const webpack = require("webpack");
 
-// We read the configuration from STDIN rather than as an argument to improve
-// the output on error. Otherwise the (fairly huge) configuration is printed
-// along with the actual error message.
-let inputChunks = [];
-process.stdin.setEncoding("utf-8");
-process.stdin.on("data", chunk => { inputChunks.push(chunk); });
-process.stdin.on("end", () =>
+// The cost of starting Node.js and loading all the modules is hugely larger
+// than actually producing bundles. So rather than running once per build, we
+// keep running as a worker, and create bundles whenever we are asked to, until
+// STDIN is closed. Requests and responses are sent as frames: the length of
+// the payload (4 bytes, big endian), followed by the payload, which is JSON,
+// except for the content of the bundles (see below).
+// Requests are read from STDIN rather than passed as arguments to improve the
+// output on error. Otherwise the (fairly huge) configuration is printed along
+// with the actual error message.
+
+// As long as we keep running, the modules webpack compiled are kept, and
+// only compiled again if the content of the files they were created from
+// changed. The modules are kept for each combination of settings that bundles
+// were created with, as these affect how modules are compiled. Modules are
+// always resolved again though, as new files might change the outcome.
+const MAX_MODULE_CACHES = 16;
+let moduleCaches = new Map();
+
+function getModuleCache(extensionPath, bundleName, resolvePaths, aliases)
 {
-  let {bundles, extension_path,
-       info_module, resolve_paths, aliases} = JSON.parse(inputChunks.join(""));
+  let key = JSON.stringify([extensionPath, bundleName, resolvePaths, aliases]);
+  let moduleCache = moduleCaches.get(key);
+  if (moduleCache)
+    moduleCaches.delete(key);
+  else
+    moduleCache = {cache: {}, hashes: new Map()};
 
-  // The contents of the info module is passed to us as a string from the Python
-  // packager and we pass it through to our custom loader now so it is available
-  // at bundle time.
-  require("./info-loader").setInfoModule(info_module);
+  // The most recently used caches come last.
+  moduleCaches.set(key, moduleCache);
+  if (moduleCaches.size > MAX_MODULE_CACHES)
+    moduleCaches.delete(moduleCaches.keys().next().value);
+  return moduleCache;
+}
+
+function hashFile(file)
+{
+  try
+  {
+    return crypto.createHash("sha1").update(fs.readFileSync(file))
+                                    .digest("hex");
+  }
+  catch (e)
+  {
+    return null;
+  }
+}
+
+function getFileTimestamps(hashes)
+{
+  // webpack only keeps track of changes in watch mode, otherwise it doesn't
+  // know when files changed and compiles all modules again. So we tell it
+  // that files whose content is the same as before haven't changed since
+  // forever. Modules depending on any other file are compiled again.
+  let timestamps = {};
+  for (let [file, hash] of hashes)
+  {
+    let currentHash = hashFile(file);
+    if (currentHash != null && currentHash == hash)
+      timestamps[file] = 1;
+    hashes.set(file, currentHash);
+  }
+  return timestamps;
+}
+
+function updateFileHashes(hashes, files)
+{
+  let known = new Map();
+  for (let file of files)
+  {
+    let hash = hashes.get(file);
+    known.set(file, hash == null ? hashFile(file) : hash);
+  }
+  return known;
+}
 
-  // Since the cost of starting Node.js and loading all the modules is hugely
-  // larger than actually producing bundles we avoid paying it multiple times,
-  // instead producing all the bundles in one go.
+function createBundles({bundles, extension_path}, onBundle, callback)
+{
+  // We avoid paying the cost of compiling multiple times, producing all the
+  // bundles in one go instead. Bundles might be for different platforms, so
+  // each comes with its own info module and module resolution settings.
   let options = [];
-  for (let {bundle_name, entry_points} of bundles)
+  let usedCaches = [];
+  for (let {bundle_name, entry_points, info_module,
+            resolve_paths, aliases} of bundles)
   {
+    let moduleCache = getModuleCache(extension_path, bundle_name,
+                                     resolve_paths, aliases);
+    usedCaches.push(moduleCache);
     options.push({
+      cache: moduleCache.cache,
       context: extension_path,
       module: {
         rules: [{
           include: path.join(__dirname, "info.js"),
-          use: ["info-loader"]
+          use: [{
+            // The contents of the info module is passed to us as a string
+            // from the Python packager and we pass it through to our custom
+            // loader so it is available at bundle time. The ident, which
+            // identifies the cached module, changes along with it.
+            loader: "info-loader",
+            options: {
+              infoModule: info_module,
+              ident: "info-" + crypto.createHash("sha1")
+                                     .update(info_module).digest("hex")
+            }
+          }]
         }]
       },
       entry: entry_points,
@@ -96,49 +180,161 @@ process.stdin.on("end", () =>
   let webpackCompiler = webpack(options);
 
   webpackCompiler.outputFileSystem = memoryFS;
+  webpackCompiler.compilers.forEach((compiler, i) =>
+  {
+    compiler.fileTimestamps = getFileTimestamps(usedCaches[i].hashes);
+  });
+  webpackCompiler.compilers.forEach((compiler, i) =>
+  {
+    // Each bundle is passed on as soon as it has been created, so that the
+    // packager can process it while the other bundles are still compiled.
+    compiler.plugin("done", stats =>
+    {
+      if (!stats.hasErrors())
+        onBundle(getBundle(extension_path, options[i], memoryFS, stats));
+    });
+  });
   webpackCompiler.run((err, stats) =>
   {
     // Error handling is based on this example
     // https://webpack.js.org/api/node/#error-handling
+    if (err || stats.hasErrors())
+    {
+      // Don't keep modules which might have failed to compile.
+      for (let moduleCache of usedCaches)
+      {
+        moduleCache.cache = {};
+        moduleCache.hashes = new Map();
+      }
+    }
+
     if (err)
     {
       let reason = err.stack || err;
       if (err.details)
         reason += "\n" + err.details;
-      throw new Error(reason);
+      callback(reason);
     }
     else if (stats.hasErrors())
-      throw new Error(stats.toJson().errors.join("\n"));
+      callback(stats.toJson("errors-only").errors.join("\n"));
     else
     {
-      let output = {};
-      let files = output.files = {};
-
-      for (let config of options)
+      stats.stats.forEach((childStats, i) =>
       {
-        let filepath = path.join(config.output.path, config.output.filename);
-        let relativeFilepath = path.relative("", config.output.filename);
-        files[relativeFilepath] = memoryFS.readFileSync(filepath, "utf-8");
-      }
+        usedCaches[i].hashes = updateFileHashes(
+          usedCaches[i].hashes, childStats.compilation.fileDependencies
+        );
+      });
+      callback(null);
+    }
+  });
+}
 
-      // We provide a list of all the bundled files, so the packager can avoid
-      // including them again outside of a bundle. Otherwise we end up including
-      // duplicate copies in our builds.
-      let included = new Set();
-      for (let bundle of stats.toJson().children)
+function getBundle(extensionPath, config, memoryFS, stats)
+{
+  let {compilation} = stats;
+
+  // We provide a list of all the bundled files, so the packager can avoid
+  // including them again outside of a bundle. Otherwise we end up including
+  // duplicate copies in our builds. Modules created by loaders (e.g. the info
+  // module) and the modules for multiple entry points don't correspond to
+  // any file.
+  let included = new Set();
+  for (let chunk of compilation.chunks)
+  {
+    chunk.forEachModule(module =>
+    {
+      if (module.resource && module.loaders.length == 0)
       {
-        for (let chunk of bundle.chunks)
-        {
-          for (let module of chunk.modules)
-          {
-            if (!module.name.startsWith("multi "))
-              included.add(path.relative(extension_path, module.name));
-          }
-        }
+        let file = module.resource.split("?")[0];
+        included.add(path.relative(extensionPath, file));
       }
-      output.included = Array.from(included);
+    });
+  }
 
-      console.log(JSON.stringify(output));
-    }
-  });
+  // We also provide a list of all files webpack looked at, or looked for, so
+  // that the packager can tell whether bundles have to be created again for
+  // the next build.
+  let dependencies = new Set(compilation.fileDependencies);
+  for (let dependency of compilation.missingDependencies)
+    dependencies.add(dependency);
+
+  let filepath = path.join(config.output.path, config.output.filename);
+  return {
+    name: path.relative("", config.output.filename),
+    included: Array.from(included),
+    dependencies: Array.from(dependencies),
+    // How long compiling took allows the packager to balance bundles over
+    // several workers next time.
+    time: (stats.endTime - stats.startTime) / 1000,
+    content: memoryFS.readFileSync(filepath)
+  };
+}
+
+function writeFrame(payload)
+{
+  let header = Buffer.alloc(4);
+  header.writeUInt32BE(payload.length, 0);
+  stdout.write(Buffer.concat([header, payload]));
+}
+
+function writeMessage(message)
+{
+  writeFrame(Buffer.from(JSON.stringify(message), "utf-8"));
+}
+
+// Requests are handled one after another, as they arrive. For each bundle
+// created we send a message with its name, the files included in it and the
+// files it depends on, followed by a frame with its content as it is. Once
+// all bundles have been created, we send a message saying so, or the error
+// which occured.
+let requests = [];
+let busy = false;
+
+function handleNext()
+{
+  if (busy || requests.length == 0)
+    return;
+
+  busy = true;
+  let request = requests.shift();
+  let sendBundle = ({name, included, dependencies, time, content}) =>
+  {
+    writeMessage({bundle: name, included, dependencies, time});
+    writeFrame(content);
+  };
+  let respond = error =>
+  {
+    if (error)
+      writeMessage({error: String(error)});
+    else
+      writeMessage({done: true});
+    busy = false;
+    handleNext();
+  };
+
+  try
+  {
+    createBundles(request, sendBundle, respond);
+  }
+  catch (e)
+  {
+    respond(e.stack || e);
+  }
+}
+
+let input = Buffer.alloc(0);
+process.stdin.on("data", chunk =>
+{
+  input = Buffer.concat([input, chunk]);
+  while (input.length >= 4)
+  {
+    let length = input.readUInt32BE(0);
+    if (input.length < 4 + length)
+      break;
+
+    requests.push(JSON.parse(input.toString("utf-8", 4, 4 + length)));
+    input = input.slice(4 + length);
+  }
+  handleNext();
 });